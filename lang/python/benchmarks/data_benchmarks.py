@@ -0,0 +1,276 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of the data operations on synthetic CSV files.
+
+Usage (from `lang/python`):
+
+    python -m benchmarks.data_benchmarks --sizes 10k,1m --output report.json
+    python -m benchmarks.data_benchmarks --sizes 10k --baseline report.json
+
+The CSV and MetaCSV files are generated in `--data-dir` (reused if they
+exist). Every operation is timed `--repeat` times on a fresh copy of the
+data, and the best time is kept. The JSON report is compared to a baseline:
+an operation is a regression if its best wall time is above the baseline
+time by more than `--tolerance` (a ratio); the exit status is then 1.
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Mapping, Any, Optional, Sequence, Tuple
+
+from csv_inspector import read_csv
+
+REPORT_VERSION = 1
+DEFAULT_TOLERANCE = 0.2
+SIZE_BY_NAME = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+CATEGORIES = [f"category {i}" for i in range(20)]
+MAX_KEYS = 100_000
+
+MCSV = """domain,key,value
+file,encoding,utf-8
+csv,delimiter,","
+data,col/0/type,integer
+data,col/1/type,integer
+data,col/3/type,float//.
+data,col/4/type,boolean/true/false
+data,col/5/type,date/yyyy-MM-dd
+"""
+KEYS_MCSV = """domain,key,value
+file,encoding,utf-8
+csv,delimiter,","
+data,col/0/type,integer
+"""
+
+
+def key_count(row_count: int) -> int:
+    return max(1, min(row_count // 10, MAX_KEYS))
+
+
+def generate(data_dir: Path, row_count: int) -> Tuple[Path, Path]:
+    """
+    Generate a CSV file with typed columns (id, key, category, value, flag,
+    day, label; 5% of the values are null) and a CSV file of keys.
+
+    :return: the paths of the CSV files
+    """
+    path = data_dir / f"bench-{row_count}.csv"
+    keys_path = data_dir / f"bench-{row_count}-keys.csv"
+    if path.is_file() and keys_path.is_file():
+        return path, keys_path
+
+    rand = random.Random(row_count)
+    keys = key_count(row_count)
+    start_day = datetime.date(2020, 1, 1)
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "key", "category", "value", "flag", "day",
+                         "label"])
+        for i in range(row_count):
+            value = rand.random()
+            writer.writerow([
+                i, rand.randrange(keys), rand.choice(CATEGORIES),
+                "" if value < 0.05 else repr(value),
+                "true" if value < 0.5 else "false",
+                (start_day + datetime.timedelta(days=i % 1000)).isoformat(),
+                f"label {i}, {rand.randrange(1000)}"])
+    path.with_suffix(".mcsv").write_text(MCSV, encoding="utf-8")
+    os.replace(temp_path, path)
+
+    with open(keys_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["key", "name"])
+        # half of the keys, and keys that are not in the data
+        for key in range(0, keys * 3 // 2, 3):
+            writer.writerow([key, f"name {key}"])
+    keys_path.with_suffix(".mcsv").write_text(KEYS_MCSV, encoding="utf-8")
+    return path, keys_path
+
+
+def _group(data):
+    grouper = data[2].grouper()
+    grouper[0].agg("count")
+    grouper[3].agg("mean")
+    grouper.group()
+
+
+def operations(save_path: Path
+               ) -> List[Tuple[str, Callable[[Any, Any], Any]]]:
+    """
+    :return: the name and the function of every operation on a data and the
+    data of the keys
+    """
+    return [
+        ("filter", lambda data, _: data[3].filter(
+            lambda v: v is not None and v > 0.5)),
+        ("filter_expr", lambda data, _: data[3].filter_expr("c3 > 0.5")),
+        ("sort", lambda data, _: data[2].sort()),
+        ("create", lambda data, _: data[0, 3].create(
+            lambda i, v: None if v is None else i * v, "product", float)),
+        ("ijoin", lambda data, keys: data[1].ijoin(keys[0])),
+        ("ljoin", lambda data, keys: data[1].ljoin(keys[0])),
+        ("rjoin", lambda data, keys: data[1].rjoin(keys[0])),
+        ("ojoin", lambda data, keys: data[1].ojoin(keys[0])),
+        ("group", lambda data, _: _group(data)),
+        ("stats", lambda data, _: data.stats()),
+        ("show", lambda data, _: data.show()),
+        ("save_as", lambda data, _: data.save_as(save_path)),
+    ]
+
+
+def _time(func: Callable[..., Any], repeat: int,
+          setup: Callable[[], Sequence[Any]] = tuple) -> Mapping[str, Any]:
+    """
+    :param setup: the function that returns the arguments of `func`. It is
+    not timed.
+    :return: the best wall and CPU times, and the wall times of the runs
+    """
+    wall_times = []
+    cpu_times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            args = setup()
+            with contextlib.redirect_stdout(devnull):
+                wall_start = time.perf_counter()
+                cpu_start = time.process_time()
+                func(*args)
+                cpu_times.append(time.process_time() - cpu_start)
+                wall_times.append(time.perf_counter() - wall_start)
+    return {"wall_time": min(wall_times), "cpu_time": min(cpu_times),
+            "runs": wall_times}
+
+
+def run_benchmarks(row_counts: Sequence[int], data_dir: Path,
+                   repeat: int = 3) -> Mapping[str, Any]:
+    """:return: the report"""
+    results = []
+    for row_count in row_counts:
+        path, keys_path = generate(data_dir, row_count)
+        data = read_csv(path, nrows=-1)
+        keys_data = read_csv(keys_path, nrows=-1)
+        save_path = data_dir / f"bench-{row_count}-saved.csv"
+        timed_operations = [("read_csv",
+                             lambda *_: read_csv(path, nrows=-1))]
+        timed_operations += operations(save_path)
+        for name, operation in timed_operations:
+            results.append(dict(
+                _time(operation, repeat,
+                      lambda: (data.copy(), keys_data.copy())),
+                operation=name, rows=row_count))
+            print(f"{row_count} rows, {name}: "
+                  f"{results[-1]['wall_time'] * 1000:.1f} ms",
+                  file=sys.stderr)
+    return {
+        "version": REPORT_VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(report: Mapping[str, Any], baseline: Mapping[str, Any],
+            tolerance: float = DEFAULT_TOLERANCE
+            ) -> List[Tuple[str, int, float, float]]:
+    """
+    :return: the regressions: operation, rows, baseline time and time
+
+    >>> baseline = {"results": [{"operation": "sort", "rows": 10,
+    ...                          "wall_time": 1.0}]}
+    >>> report = {"results": [{"operation": "sort", "rows": 10,
+    ...                        "wall_time": 1.1}]}
+    >>> compare(report, baseline)
+    []
+    >>> compare(report, baseline, 0.05)
+    [('sort', 10, 1.0, 1.1)]
+    """
+    baseline_time_by_key = {(result["operation"], result["rows"]):
+                                result["wall_time"]
+                            for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        key = (result["operation"], result["rows"])
+        baseline_time = baseline_time_by_key.get(key)
+        if (baseline_time is not None
+                and result["wall_time"] > baseline_time * (1 + tolerance)):
+            regressions.append((*key, baseline_time, result["wall_time"]))
+    return regressions
+
+
+def _row_count(size: str) -> int:
+    try:
+        return SIZE_BY_NAME[size.lower()]
+    except KeyError:
+        return int(size)
+
+
+def main(args: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the data operations")
+    parser.add_argument("--sizes", default="10k",
+                        help="the row counts: 10k, 1m, 10m or a number, "
+                             "separated by commas (default: 10k)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", type=Path,
+                        help="the directory of the generated files "
+                             "(default: a temporary directory)")
+    parser.add_argument("--output", type=Path, help="the JSON report")
+    parser.add_argument("--baseline", type=Path,
+                        help="a JSON report to compare to")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="the max slowdown ratio (default: 0.2)")
+    parsed = parser.parse_args(args)
+
+    row_counts = [_row_count(size) for size in parsed.sizes.split(",")]
+    if parsed.data_dir is None:
+        with tempfile.TemporaryDirectory() as data_dir:
+            report = run_benchmarks(row_counts, Path(data_dir),
+                                    parsed.repeat)
+    else:
+        parsed.data_dir.mkdir(parents=True, exist_ok=True)
+        report = run_benchmarks(row_counts, parsed.data_dir, parsed.repeat)
+
+    text = json.dumps(report, indent=2)
+    if parsed.output is None:
+        print(text)
+    else:
+        parsed.output.write_text(text, encoding="utf-8")
+
+    if parsed.baseline is None:
+        return 0
+    baseline = json.loads(parsed.baseline.read_text(encoding="utf-8"))
+    regressions = compare(report, baseline, parsed.tolerance)
+    for operation, rows, baseline_time, wall_time in regressions:
+        print(f"Regression: {operation}, {rows} rows: "
+              f"{baseline_time * 1000:.1f} ms -> {wall_time * 1000:.1f} ms",
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,5 +17,31 @@
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from csv_inspector.inspector import read_csv
-from csv_inspector.util import begin_info, end_info
\ No newline at end of file
+# The modules are imported on the first access to their names (PEP 562):
+# `import csv_inspector` does not import MetaCSV, and the server starts fast.
+import importlib
+
+_MODULE_BY_NAME = {
+    "read_csv": "csv_inspector.inspector",
+    "begin_info": "csv_inspector.protocol",
+    "end_info": "csv_inspector.protocol",
+    "enable_profiling": "csv_inspector.instrument",
+    "disable_profiling": "csv_inspector.instrument",
+}
+
+__all__ = list(_MODULE_BY_NAME)
+
+
+def __getattr__(name: str):
+    try:
+        module_name = _MODULE_BY_NAME[name]
+    except KeyError:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
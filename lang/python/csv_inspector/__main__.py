@@ -17,43 +17,13 @@
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-import sys
-import traceback
+import time
 
-from csv_inspector.util import (executed, execute_script, END_SCRIPT,
-                                BEGIN_SCRIPT)
+start = time.perf_counter()
+from csv_inspector.server import Server, serve
 
-IGNORE = 0
-SCRIPT = 1
-
-state = IGNORE
-script_lines = []
-
-# REPL version, but need one dict per window.
-vars = {}
-
-# This is the main server!
-while True:
-    line = sys.stdin.readline().rstrip()
-    stripped_line = line.lstrip()
-    if state == IGNORE:
-        # here: read the window id and the mode (REPL or not)
-        if stripped_line == BEGIN_SCRIPT:
-            state = SCRIPT
-            script_lines = []
-        else:
-            print(f"Garbage {stripped_line}", file=sys.stderr)
-    elif state == SCRIPT:
-        if stripped_line == END_SCRIPT:
-            script = "\n".join(script_lines)
-            print("server/execute script: {} chars".format(len(script)))
-            try:
-                execute_script(script, vars)
-            except Exception as e:
-                traceback.print_exc()
-
-            print("server/script executed")
-            executed()
-            state = IGNORE
-        else:
-            script_lines.append(line)
+# This is the main server! One session (namespace and worker process) per
+# window.
+server = Server()
+server.timings["server startup"] = time.perf_counter() - start
+serve(server=server)
@@ -0,0 +1,244 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Incremental aggregators: the state of a group is updated value by value,
+hence the values of the group are never stored.
+
+`sum`, `min`, `max` and `mean` ignore the nulls and return a null if there
+is no value; `count` is the number of rows, `count_distinct` the number of
+distinct values; `first` and `last` are the values of the first and last
+rows.
+"""
+from decimal import Decimal
+from typing import Any, Optional, Type, Mapping, Iterable
+
+
+class Aggregator:
+    """
+    An aggregator. The states of two parts of a group can be merged.
+
+    >>> aggregator = get_aggregator("mean")
+    >>> state = aggregator.init()
+    >>> for v in [1, None, 2]:
+    ...     state = aggregator.update(state, v)
+    >>> other_state = aggregator.update(aggregator.init(), 6)
+    >>> aggregator.result(aggregator.merge(state, other_state))
+    3.0
+    """
+    name = None
+    col_type: Optional[Type] = None  # None: the type of the column
+
+    def init(self) -> Any:
+        return None
+
+    def update(self, state: Any, value: Any) -> Any:
+        raise NotImplementedError()
+
+    def merge(self, state: Any, other_state: Any) -> Any:
+        raise NotImplementedError()
+
+    def result(self, state: Any) -> Any:
+        return state
+
+    def aggregate(self, values: Iterable[Any]) -> Any:
+        state = self.init()
+        for value in values:
+            state = self.update(state, value)
+        return self.result(state)
+
+    def merges_exactly(self, col_type: Type) -> bool:
+        """
+        :return: True if the merge of the states of two parts of a group
+        gives the same result as the update with all the values.
+        """
+        return True
+
+    def result_type(self, col_type: Optional[Type]) -> Optional[Type]:
+        """
+        :return: the type of the results for a column of type `col_type`
+        """
+        return self.col_type or col_type
+
+
+class CountAggregator(Aggregator):
+    name = "count"
+    col_type = int
+
+    def init(self):
+        return 0
+
+    def update(self, state, value):
+        return state + 1
+
+    def merge(self, state, other_state):
+        return state + other_state
+
+
+class SumAggregator(Aggregator):
+    name = "sum"
+
+    def update(self, state, value):
+        if value is None:
+            return state
+        if state is None:
+            return 0 + value  # same as the builtin `sum`
+        return state + value
+
+    def merge(self, state, other_state):
+        if other_state is None:
+            return state
+        return self.update(state, other_state)
+
+    def merges_exactly(self, col_type):
+        return col_type in (bool, int)  # float addition is not associative
+
+
+class MinAggregator(Aggregator):
+    name = "min"
+
+    def update(self, state, value):
+        if value is None:
+            return state
+        if state is None or value < state:
+            return value
+        return state
+
+    merge = update
+
+
+class MaxAggregator(Aggregator):
+    name = "max"
+
+    def update(self, state, value):
+        if value is None:
+            return state
+        if state is None or value > state:
+            return value
+        return state
+
+    merge = update
+
+
+class MeanAggregator(Aggregator):
+    name = "mean"
+    col_type = float
+
+    def init(self):
+        return 0, 0
+
+    def update(self, state, value):
+        if value is None:
+            return state
+        count, total = state
+        return count + 1, total + value
+
+    def merge(self, state, other_state):
+        return state[0] + other_state[0], state[1] + other_state[1]
+
+    def merges_exactly(self, col_type):
+        return col_type in (bool, int)
+
+    def result_type(self, col_type):
+        """
+        >>> MeanAggregator().result_type(int)
+        <class 'float'>
+        >>> MeanAggregator().result_type(Decimal)
+        <class 'decimal.Decimal'>
+        """
+        return Decimal if col_type is Decimal else float
+
+    def result(self, state):
+        count, total = state
+        if count == 0:
+            return None
+        return total / count
+
+
+class FirstAggregator(Aggregator):
+    """The state is a tuple to distinguish a null value from no value"""
+    name = "first"
+
+    def init(self):
+        return ()
+
+    def update(self, state, value):
+        return state or (value,)
+
+    def merge(self, state, other_state):
+        return state or other_state
+
+    def result(self, state):
+        return state[0] if state else None
+
+
+class LastAggregator(FirstAggregator):
+    name = "last"
+
+    def update(self, state, value):
+        return (value,)
+
+    def merge(self, state, other_state):
+        return other_state or state
+
+
+class CountDistinctAggregator(Aggregator):
+    name = "count_distinct"
+    col_type = int
+
+    def init(self):
+        return set()
+
+    def update(self, state, value):
+        state.add(value)
+        return state
+
+    def merge(self, state, other_state):
+        state.update(other_state)
+        return state
+
+    def result(self, state):
+        return len(state)
+
+
+AGGREGATOR_BY_NAME: Mapping[str, Aggregator] = {
+    aggregator.name: aggregator for aggregator in (
+        CountAggregator(), SumAggregator(), MinAggregator(), MaxAggregator(),
+        MeanAggregator(), FirstAggregator(), LastAggregator(),
+        CountDistinctAggregator())
+}
+
+
+def get_aggregator(name: str) -> Aggregator:
+    """
+    >>> get_aggregator("sum").name
+    'sum'
+    >>> get_aggregator("median")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown aggregator median
+    """
+    try:
+        return AGGREGATOR_BY_NAME[name]
+    except KeyError:
+        raise ValueError(f"Unknown aggregator {name}")
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -16,10 +16,50 @@
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
 import csv
+import datetime
+import sqlite3
+import time
 from abc import ABCMeta, abstractmethod
+from decimal import Decimal
 from encodings import normalize_encoding
+from itertools import islice
 from pathlib import Path
-from typing import Sequence
+from typing import Sequence, Optional, List, Any, BinaryIO, Tuple
+
+import mcsv
+from mcsv import data_type_to_field_description
+from mcsv.field_description import DataType, FieldDescription
+from mcsv.field_processors import ReadError
+
+from csv_inspector import pg_copy
+from csv_inspector.cancel import checked
+from csv_inspector.util import to_standard
+
+SQLITE_TYPE_BY_DATA_TYPE = {
+    DataType.BOOLEAN: "INTEGER",
+    DataType.INTEGER: "INTEGER",
+    DataType.CURRENCY_INTEGER: "INTEGER",
+    DataType.FLOAT: "REAL",
+    DataType.PERCENTAGE_FLOAT: "REAL",
+    DataType.DECIMAL: "NUMERIC",
+    DataType.CURRENCY_DECIMAL: "NUMERIC",
+    DataType.PERCENTAGE_DECIMAL: "NUMERIC",
+    DataType.DATE: "TEXT",
+    DataType.DATETIME: "TEXT",
+}
+SQLITE_BATCH_SIZE = 50000
+# the table is rebuilt if the load fails: no journal on disk, no fsync
+SQLITE_LOAD_PRAGMAS = {"synchronous": "OFF", "journal_mode": "MEMORY",
+                       "cache_size": "-65536", "temp_store": "MEMORY"}
+
+
+def _read_header(file: Path, mcsv_path: Optional[Path]
+                 ) -> Tuple[List[str], Sequence[FieldDescription]]:
+    """:return: the standard names and the descriptions of the columns"""
+    with mcsv.open_csv(file, "r", mcsv_path) as mcsv_reader:
+        header = next(mcsv_reader)
+        descriptions = mcsv_reader.descriptions
+    return [to_standard(name) for name in header], descriptions
 
 
 class SQLBulkProvider(metaclass=ABCMeta):
@@ -51,18 +91,28 @@ class SQLBulkProvider(metaclass=ABCMeta):
 
 class PostgreSQLBulkProvider(SQLBulkProvider):
     def __init__(self, encoding: str, dialect: csv.Dialect, file: Path,
-                 table_name: str, force_null: Sequence[str]):
+                 table_name: str, force_null: Sequence[str],
+                 mcsv_path: Optional[Path] = None):
         self._encoding = encoding
         self._dialect = dialect
         self._file = file
         self._table_name = table_name
         self._force_null = force_null
+        self._mcsv_path = mcsv_path
 
     def drop_table(self):
         return f'DROP TABLE IF EXISTS "{self._table_name}";'
 
     def create_schema(self):
-        return f'not implemented yet;'
+        """
+        The types of the columns are given by the MetaCSV file (see
+        `pg_copy.PG_TYPE_BY_DATA_TYPE`).
+        """
+        names, descriptions = _read_header(self._file, self._mcsv_path)
+        columns = ", ".join(
+            f'"{name}" {pg_copy.pg_type(description.get_data_type())}'
+            for name, description in zip(names, descriptions))
+        return f'CREATE TABLE "{self._table_name}" ({columns});'
 
     def prepare_copy(self) -> str:
         return f'TRUNCATE "{self._table_name}";'
@@ -98,12 +148,161 @@ class PostgreSQLBulkProvider(SQLBulkProvider):
             return "E'\\\''"
         return f"'{text}'"
 
+    def copy_binary_stream(self) -> str:
+        """:return: the COPY statement for the data of `write_binary_copy`"""
+        return f'COPY "{self._table_name}" FROM STDIN WITH (FORMAT binary);'
+
+    def write_binary_copy(self, stream: BinaryIO) -> pg_copy.PGCopyWriter:
+        """
+        Write the file in the binary COPY format, e.g. to the stdin of the
+        COPY command: the server does not parse the values and the file does
+        not need to be on the server.
+
+        :return: the writer, with the counts of rows and errors
+        """
+        return pg_copy.write_csv(self._file, stream, self._mcsv_path)
+
     def finalize_copy(self) -> str:
         return f'ANALYZE "{self._table_name}";'
 
 
+class LoadReport:
+    def __init__(self, row_count: int, error_count: int, seconds: float):
+        self.row_count = row_count
+        self.error_count = error_count
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.row_count / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"{self.row_count} rows loaded in {self.seconds:.2f} s "
+                f"({self.rows_per_second:.0f} rows/s, "
+                f"{self.error_count} errors)")
+
+
+def _to_sqlite(value: Any) -> Any:
+    """
+    The values that sqlite3 does not adapt: the dates are ISO 8601 texts,
+    the decimals are texts (hence NUMERIC keeps the exact value if possible)
+    and the errors are nulls.
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, ReadError):
+        return None
+    return value
+
+
+class SQLiteBulkProvider(SQLBulkProvider):
+    """
+    Create a SQLite table from the MetaCSV description of a CSV file, and
+    load the file: the typed rows of the MetaCSV reader are inserted by
+    batches, hence the file is never fully in memory.
+    """
+
+    def __init__(self, file: Path, table_name: Optional[str] = None,
+                 mcsv_path: Optional[Path] = None):
+        self._file = file
+        self._mcsv_path = mcsv_path
+        self._table_name = (to_standard(file.stem) if table_name is None
+                            else table_name)
+        self._names, self._descriptions = _read_header(file, mcsv_path)
+
+    def drop_table(self) -> str:
+        return f'DROP TABLE IF EXISTS "{self._table_name}";'
+
+    def create_schema(self) -> str:
+        """
+        >>> provider = SQLiteBulkProvider.__new__(SQLiteBulkProvider)
+        >>> provider._table_name = "t"
+        >>> provider._names = ["a", "b"]
+        >>> provider._descriptions = [
+        ...     data_type_to_field_description(DataType.INTEGER),
+        ...     data_type_to_field_description(DataType.TEXT)]
+        >>> provider.create_schema()
+        'CREATE TABLE "t" ("a" INTEGER, "b" TEXT);'
+        """
+        columns = ", ".join(
+            f'"{name}" {self._sqlite_type(description)}'
+            for name, description in zip(self._names, self._descriptions))
+        return f'CREATE TABLE "{self._table_name}" ({columns});'
+
+    def _sqlite_type(self, description: FieldDescription) -> str:
+        return SQLITE_TYPE_BY_DATA_TYPE.get(description.get_data_type(),
+                                            "TEXT")
+
+    def prepare_copy(self) -> str:
+        return f'DELETE FROM "{self._table_name}";'
+
+    def copy_stream(self) -> str:
+        """:return: the insert statement of a row"""
+        placeholders = ", ".join(["?"] * len(self._names))
+        return f'INSERT INTO "{self._table_name}" VALUES ({placeholders});'
+
+    def finalize_copy(self) -> str:
+        return f'ANALYZE "{self._table_name}";'
+
+    def load(self, connection: sqlite3.Connection,
+             batch_size: int = SQLITE_BATCH_SIZE) -> LoadReport:
+        """
+        (Re)create the table and load the file, one transaction per batch of
+        rows.
+
+        :return: the number of rows and the duration of the load
+        """
+        start = time.perf_counter()
+        old_pragmas = {name: connection.execute(f"PRAGMA {name}").fetchone()[0]
+                       for name in SQLITE_LOAD_PRAGMAS}
+        for name, value in SQLITE_LOAD_PRAGMAS.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        row_count = 0
+        error_count = 0
+        try:
+            with connection:
+                connection.execute(self.drop_table())
+                connection.execute(self.create_schema())
+            insert = self.copy_stream()
+            width = len(self._names)
+            with mcsv.open_csv(self._file, "r", self._mcsv_path
+                               ) as mcsv_reader:
+                next(mcsv_reader)  # header
+                while True:
+                    rows = list(checked(islice(mcsv_reader, batch_size)))
+                    if not rows:
+                        break
+                    error_count += sum(isinstance(value, ReadError)
+                                       for row in rows for value in row)
+                    batch = [self._to_sqlite_row(row, width) for row in rows]
+                    with connection:
+                        connection.executemany(insert, batch)
+                    row_count += len(batch)
+            connection.execute(self.finalize_copy())
+        finally:
+            for name, value in old_pragmas.items():
+                connection.execute(f"PRAGMA {name} = {value}")
+        return LoadReport(row_count, error_count, time.perf_counter() - start)
+
+    def _to_sqlite_row(self, row: List[Any], width: int) -> List[Any]:
+        row = [_to_sqlite(value) for value in row[:width]]
+        if len(row) < width:  # short record
+            row += [None] * (width - len(row))
+        return row
+
+
 def get_provider(provider_name: str = 'pg') -> SQLBulkProvider:
-    if provider_name in ('pg'):
+    if provider_name in ('pg',):
         return PostgreSQLBulkProvider
+    elif provider_name in ('sqlite',):
+        return SQLiteBulkProvider
     else:
         raise ValueError(provider_name)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,150 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Cooperative cancellation of a script. The server sets a flag (shared with
+the worker of the session) or the script has a deadline; the long loops of
+the operations call `check` every `CHECK_INTERVAL` iterations.
+
+The flag is the number of the last cancelled script: the server and the
+worker count the scripts, hence a cancel sent while the script is queued
+is not lost, and it does not cancel the next scripts.
+
+The script of a worker is cancelled too if the server died (the worker is
+then an orphan).
+
+An operation computes the new values before it replaces the columns: if it
+is cancelled, the data is unchanged.
+"""
+import os
+import time
+from typing import Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+CHECK_INTERVAL = 1024
+
+# The flag (e.g. a `multiprocessing.Value`) set by the server
+_cancel_flag = None
+# The pid of the server, if the script is executed by a worker
+_parent_pid: Optional[int] = None
+# The number of the scripts started
+_script_count = 0
+# True if a script is executed
+_in_script = False
+# The deadline of the current script (see `time.monotonic`)
+_deadline: Optional[float] = None
+
+
+class Cancelled(Exception):
+    """The script was cancelled or its deadline is passed"""
+
+
+def set_cancel_flag(cancel_flag, parent_pid: Optional[int] = None):
+    """
+    :param cancel_flag: an object with a `value` attribute, the number of
+    the last cancelled script
+    :param parent_pid: the pid of the server, or None
+
+    >>> import sys
+    >>> from types import SimpleNamespace
+    >>> flag = SimpleNamespace(value=0)
+    >>> set_cancel_flag(flag)
+    >>> # cancel the next script before it starts
+    >>> flag.value = sys.modules[__name__]._script_count + 1
+    >>> start_script()
+    >>> check()
+    Traceback (most recent call last):
+    ...
+    Cancelled: cancelled
+    >>> end_script()
+    >>> start_script()
+    >>> check()
+    >>> end_script()
+    >>> set_cancel_flag(None)
+    """
+    global _cancel_flag, _parent_pid
+
+    _cancel_flag = cancel_flag
+    _parent_pid = parent_pid
+
+
+def start_script(timeout: Optional[float] = None):
+    """
+    Count the script and set its deadline.
+
+    :param timeout: the max duration of the script in seconds, or None
+    """
+    global _deadline, _script_count, _in_script
+
+    _script_count += 1
+    _in_script = True
+    _deadline = None if timeout is None else time.monotonic() + timeout
+
+
+def end_script():
+    global _deadline, _in_script
+
+    _in_script = False
+    _deadline = None
+
+
+def check():
+    """
+    Raise `Cancelled` if the script was cancelled or its deadline is passed.
+
+    >>> start_script(0)
+    >>> check()
+    Traceback (most recent call last):
+    ...
+    Cancelled: deadline passed
+    >>> end_script()
+    >>> check()
+    """
+    if (_in_script and _cancel_flag is not None
+            and _cancel_flag.value >= _script_count):
+        raise Cancelled("cancelled")
+    if _parent_pid is not None and os.getppid() != _parent_pid:
+        raise Cancelled("server died")
+    if _deadline is not None and time.monotonic() >= _deadline:
+        raise Cancelled("deadline passed")
+
+
+def checked(iterable: Iterable[T]) -> Iterator[T]:
+    """
+    Yield the items and `check` every `CHECK_INTERVAL` items.
+
+    >>> list(checked(range(3)))
+    [0, 1, 2]
+    """
+    if _cancel_flag is None and _deadline is None:
+        yield from iterable
+        return
+
+    count = CHECK_INTERVAL
+    for item in iterable:
+        count -= 1
+        if not count:
+            count = CHECK_INTERVAL
+            check()
+        yield item
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
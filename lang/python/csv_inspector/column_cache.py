@@ -0,0 +1,194 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A cache of the parsed columns of a CSV file: the typed columns are stored in
+a `.mcsvcache` file (an exact frame, see `csv_inspector.frame`), next to the
+MetaCSV file or in a cache directory.
+
+The cache file is valid if the size, the content of the CSV file and the
+content of the MetaCSV file did not change. The content of the CSV file is
+hashed only if the mtime changed. The frame is hashed too: a corrupt cache
+file is ignored.
+
+The size of a cache directory is limited: the least recently used files
+are removed.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Optional, Sequence, List, Mapping, Any
+
+from csv_inspector.frame import encode_frame, decode_frame_columns
+from csv_inspector.util import Column, ColInfo
+
+CACHE_SUFFIX = ".mcsvcache"
+MAGIC = b"MCSVCACHE"
+VERSION = 2
+MAX_CACHE_DIR_SIZE = 4 * 1024 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+_KEY_SIZE = struct.Struct("<I")
+
+
+def cache_path(csv_path: Path, mcsv_path: Path,
+               cache_dir: Optional[Path] = None) -> Path:
+    """
+    :return: the path of the cache file: `mcsv_path` with the suffix
+    `.mcsvcache`, or a file named after the CSV file in the cache directory.
+
+    >>> cache_path(Path("/data/a.csv"), Path("/data/a.mcsv"))
+    PosixPath('/data/a.mcsvcache')
+    >>> cache_path(Path("/data/a.csv"), Path("/data/a.mcsv"), Path("/tmp"))
+    PosixPath('/tmp/a-....mcsvcache')
+    """
+    if cache_dir is None:
+        return mcsv_path.with_suffix(CACHE_SUFFIX)
+    path_hash = hashlib.sha1(str(csv_path.absolute()).encode("utf-8"))
+    return cache_dir / f"{csv_path.stem}-{path_hash.hexdigest()[:16]}" \
+                       f"{CACHE_SUFFIX}"
+
+
+def _file_hash(path: Path) -> str:
+    file_hash = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _bytes_hash(data) -> str:
+    return hashlib.blake2b(data).hexdigest()
+
+
+def _key(csv_path: Path, mcsv_path: Path) -> Mapping[str, Any]:
+    """The key without the hash of the content of the CSV file"""
+    stat = csv_path.stat()
+    return {"version": VERSION, "size": stat.st_size,
+            "mtime": stat.st_mtime_ns, "mcsv": _file_hash(mcsv_path)}
+
+
+def load_columns(path: Path, csv_path: Path, mcsv_path: Path,
+                 col_infos: Sequence[ColInfo]) -> Optional[List[Column]]:
+    """
+    :param col_infos: the descriptions of the columns of the MetaCSV file
+    :return: the columns, or None if the cache file is missing or invalid.
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0,
+                                              access=mmap.ACCESS_READ
+                                              ) as buffer:
+            if buffer[:len(MAGIC)] != MAGIC:
+                return None
+            key_size, = _KEY_SIZE.unpack_from(buffer, len(MAGIC))
+            frame_start = len(MAGIC) + _KEY_SIZE.size + key_size
+            stored_key = json.loads(buffer[len(MAGIC) + _KEY_SIZE.size:
+                                           frame_start].decode("utf-8"))
+            if not _is_valid(stored_key, csv_path, mcsv_path):
+                return None
+            with memoryview(buffer) as view, view[frame_start:] as frame:
+                if stored_key.get("frame") != _bytes_hash(frame):
+                    return None
+                columns_values = decode_frame_columns(frame)
+            if len(columns_values) > len(col_infos):
+                return None
+            columns = [Column(name, col_info, col_values)
+                       for (name, _, col_values), col_info
+                       in zip(columns_values, col_infos)]
+    except Exception:  # missing or corrupt: the CSV file will be parsed
+        return None
+
+    try:
+        os.utime(path)  # the most recently used
+    except OSError:  # e.g. read only: the columns are valid
+        pass
+    return columns
+
+
+def _is_valid(stored_key: Mapping[str, Any], csv_path: Path,
+              mcsv_path: Path) -> bool:
+    key = _key(csv_path, mcsv_path)
+    if any(stored_key.get(name) != key[name]
+           for name in ("version", "size", "mcsv")):
+        return False
+    return (stored_key.get("mtime") == key["mtime"]
+            or stored_key.get("hash") == _file_hash(csv_path))
+
+
+def store_columns(path: Path, csv_path: Path, mcsv_path: Path,
+                  columns: Sequence[Column],
+                  max_cache_dir_size: Optional[int] = None) -> bool:
+    """
+    Store the columns in the cache file. If `max_cache_dir_size` is not
+    None, remove the least recently used cache files of the directory.
+
+    :return: True if the cache file was written
+    """
+    try:
+        frame = encode_frame([col.name for col in columns],
+                             [str(col.col_type) for col in columns],
+                             [col.col_values for col in columns], exact=True)
+    except TypeError:  # a type that can't be encoded
+        return False
+    key = dict(_key(csv_path, mcsv_path), hash=_file_hash(csv_path),
+               frame=_bytes_hash(frame))
+    encoded_key = json.dumps(key).encode("utf-8")
+
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(_KEY_SIZE.pack(len(encoded_key)))
+            f.write(encoded_key)
+            f.write(frame)
+        os.replace(temp_path, path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        return False
+
+    if max_cache_dir_size is not None:
+        evict(path.parent, max_cache_dir_size)
+    return True
+
+
+def evict(cache_dir: Path, max_cache_dir_size: int = MAX_CACHE_DIR_SIZE):
+    """
+    Remove the least recently used cache files of the directory until
+    their total size is below `max_cache_dir_size`.
+    """
+    stats = []
+    for path in cache_dir.glob(f"*{CACHE_SUFFIX}"):
+        try:
+            stats.append((path, path.stat()))
+        except OSError:  # removed by another process
+            pass
+    stats.sort(key=lambda path_stat: path_stat[1].st_mtime_ns)
+    total_size = sum(stat.st_size for _, stat in stats)
+    for path, stat in stats:
+        if total_size <= max_cache_dir_size:
+            break
+        path.unlink(missing_ok=True)
+        total_size -= stat.st_size
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,254 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Server side cursors: `show()` registers a cursor over the columns and the
+client asks for pages of rows, without executing the script again.
+
+The protocol (stdin of the server):
+
+* `{TOKEN}page:<cursor id>:<offset>:<count>[:<sort key>]`: show `count`
+rows from `offset`. The sort key is the index of a column of the cursor,
+with a `-` prefix for a descending order;
+* `{TOKEN}close cursor:<cursor id>`: forget the cursor.
+
+The server answers on stdout with `{TOKEN}cursor:<cursor id>:<row count>`
+followed by the rows (see `show_columns`) and `{TOKEN}executed`.
+"""
+import csv
+import itertools
+import sys
+from collections import OrderedDict
+from decimal import Decimal
+from typing import (List, Optional, Tuple, Any, Collection, Sequence,
+                    MutableMapping)
+
+from mcsv.field_processors import ReadError
+
+from csv_inspector.frame import encode_frame
+from csv_inspector.util import (TOKEN, Column, TypedValues,
+                                CategoricalValues, begin_csv, end_csv,
+                                executed, frames_accepted, send_frame,
+                                take_values)
+
+PAGE = f"{TOKEN}page:"
+CLOSE_CURSOR = f"{TOKEN}close cursor:"
+MAX_CURSORS = 16
+
+
+class Cursor:
+    """
+    A snapshot of the columns: the later modifications of the data replace
+    the values of the columns and are not seen by the cursor.
+
+    >>> cursor = Cursor([Column("A", int, [3, None, 1, 2])])
+    >>> cursor.row_count()
+    4
+    >>> [list(values) for values in cursor.page(1, 2)]
+    [[None, 1]]
+    >>> [list(values) for values in cursor.page(0, 3, "0")]
+    [[1, 2, 3]]
+    >>> [list(values) for values in cursor.page(0, 10, "-0")]
+    [[3, 2, 1, None]]
+    >>> cursor = Cursor([Column("A", Any,
+    ...                         ["b", ReadError("x"), 2, None, 1.5])])
+    >>> [list(values) for values in cursor.page(0, 10, "0")]
+    [[1.5, 2, 'b', ReadError('x'), None]]
+    """
+
+    def __init__(self, columns: Sequence[Column]):
+        self.names = [col.name for col in columns]
+        self.col_types = [col.col_type for col in columns]
+        self._columns_values = [col.col_values for col in columns]
+        self._order_by_sort_key = {}
+
+    def row_count(self) -> int:
+        return min((len(col_values) for col_values in self._columns_values),
+                   default=0)
+
+    def page(self, offset: int, count: int, sort_key: Optional[str] = None
+             ) -> List[Collection[Any]]:
+        """
+        :return: the values of the columns, from `offset` to
+        `offset + count`. The order of the rows by a sort key is computed
+        once.
+        """
+        end = min(offset + count, self.row_count())
+        if sort_key is None:
+            return [col_values[offset:end]
+                    for col_values in self._columns_values]
+
+        indices = self._order(sort_key)[offset:end]
+        return [TypedValues.create(col_type, take_values(col_values, indices))
+                for col_type, col_values in zip(self.col_types,
+                                                 self._columns_values)]
+
+    def _order(self, sort_key: str) -> List[int]:
+        try:
+            return self._order_by_sort_key[sort_key]
+        except KeyError:
+            pass
+
+        reverse = sort_key.startswith("-")
+        col_values = self._columns_values[int(sort_key.lstrip("-"))]
+        if isinstance(col_values, CategoricalValues):  # sorted categories
+            keys, null = col_values.codes, -1
+        else:
+            keys, null = col_values, None
+        row_count = self.row_count()
+        null_indices = [i for i in range(row_count) if keys[i] == null]
+        error_indices = [i for i in range(row_count)
+                         if isinstance(keys[i], ReadError)]
+        indices = [i for i in range(row_count)
+                   if keys[i] != null and not isinstance(keys[i], ReadError)]
+        try:
+            order = sorted(indices, key=lambda i: _sort_key(keys[i]),
+                           reverse=reverse)
+        except (TypeError, ArithmeticError):  # e.g. Decimal("NaN")
+            order = sorted(indices, key=lambda i: _text_sort_key(keys[i]),
+                           reverse=reverse)
+        # the errors and the nulls are always at the end
+        order.extend(error_indices)
+        order.extend(null_indices)
+        self._order_by_sort_key[sort_key] = order
+        return order
+
+
+def _sort_key(value: Any) -> Tuple[int, str, Any]:
+    """The numbers are compared together, the other values by type"""
+    if isinstance(value, (int, float, Decimal)):
+        return 0, "", value
+    return 1, type(value).__name__, value
+
+
+def _text_sort_key(value: Any) -> Tuple[int, str, Any]:
+    """For the values that are not comparable"""
+    return 0, type(value).__name__, str(value)
+
+
+class CursorRegistry:
+    """
+    The cursors of the session. The least recently used cursors are
+    forgotten, since a cursor keeps the values of the columns alive.
+
+    >>> registry = CursorRegistry(max_cursors=1)
+    >>> registry.register([Column("A", int, [1])])
+    1
+    >>> registry.register([Column("A", int, [2])])
+    2
+    >>> registry.get(1) is None
+    True
+    """
+
+    def __init__(self, max_cursors: int = MAX_CURSORS):
+        self._max_cursors = max_cursors
+        self._cursor_by_id: MutableMapping[int, Cursor] = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def register(self, columns: Sequence[Column]) -> int:
+        cursor_id = next(self._ids)
+        self._cursor_by_id[cursor_id] = Cursor(columns)
+        while len(self._cursor_by_id) > self._max_cursors:
+            self._cursor_by_id.popitem(last=False)
+        return cursor_id
+
+    def get(self, cursor_id: int) -> Optional[Cursor]:
+        cursor = self._cursor_by_id.get(cursor_id)
+        if cursor is not None:
+            self._cursor_by_id.move_to_end(cursor_id)
+        return cursor
+
+    def close(self, cursor_id: int):
+        self._cursor_by_id.pop(cursor_id, None)
+
+
+cursors = CursorRegistry()
+
+
+def show_columns(names: Sequence[str], col_types: Sequence[Any],
+                 columns_values: Sequence[Collection[Any]],
+                 limit: Optional[int] = None):
+    """
+    Show the columns: a binary frame if the client accepts frames, else a
+    CSV with comma (the types, the names and the rows).
+    """
+    if frames_accepted():
+        send_frame(encode_frame(names, [str(t) for t in col_types],
+                                columns_values, limit))
+        return
+
+    writer = csv.writer(sys.stdout, delimiter=',')
+    begin_csv()
+    writer.writerow(col_types)
+    writer.writerow(names)
+    writer.writerows(itertools.islice(zip(*columns_values), limit))
+    sys.stdout.flush()
+    end_csv()
+
+
+def print_cursor(cursor_id: int, cursor: Cursor):
+    print(f"{TOKEN}cursor:{cursor_id}:{cursor.row_count()}")
+
+
+def show_page(cursor_id: int, offset: int, count: int,
+              sort_key: Optional[str] = None):
+    cursor = cursors.get(cursor_id)
+    if cursor is None:
+        print(f"Unknown cursor {cursor_id}", file=sys.stderr)
+        return
+    columns_values = cursor.page(offset, count, sort_key)
+    print_cursor(cursor_id, cursor)
+    show_columns(cursor.names, cursor.col_types, columns_values)
+
+
+def parse_page_command(line: str) -> Tuple[int, int, int, Optional[str]]:
+    """
+    >>> parse_page_command(PAGE + "1:100:50:-2")
+    (1, 100, 50, '-2')
+    >>> parse_page_command(PAGE + "1:0:50")
+    (1, 0, 50, None)
+    """
+    cursor_id, offset, count, *sort_key = line[len(PAGE):].split(":", 3)
+    return (int(cursor_id), int(offset), int(count),
+            sort_key[0] if sort_key else None)
+
+
+def handle_cursor_command(line: str) -> bool:
+    """
+    :return: True if the line is a cursor command
+    """
+    if line.startswith(PAGE):
+        try:
+            show_page(*parse_page_command(line))
+        except (ValueError, IndexError, TypeError) as e:
+            print(f"Bad page command {line}: {e}", file=sys.stderr)
+        finally:  # the client waits for the end of the command
+            executed()
+        return True
+    elif line.startswith(CLOSE_CURSOR):
+        try:
+            cursors.close(int(line[len(CLOSE_CURSOR):]))
+        except ValueError:
+            print(f"Bad cursor id {line}", file=sys.stderr)
+        return True
+    return False
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
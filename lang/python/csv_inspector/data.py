@@ -17,11 +17,11 @@
 #
 import csv
 import itertools
-import statistics
+import operator
 import sys
-from itertools import islice
 from pathlib import Path
-from typing import List, Any, Mapping, Type, Union
+from typing import (List, Any, Mapping, Type, Union, Sequence, Optional,
+                    Dict, Tuple)
 
 from mcsv import data_type_to_field_description, open_csv
 from mcsv.field_description import (DataType, FieldDescription,
@@ -29,8 +29,22 @@ from mcsv.field_description import (DataType, FieldDescription,
 from mcsv.field_descriptions import TextFieldDescription
 from mcsv.meta_csv_data import MetaCSVData, MetaCSVDataBuilder
 
-from csv_inspector.util import (begin_csv, end_csv, ColumnGroup, to_indices,
-                                Column, ColInfo)
+from csv_inspector.aggregators import Aggregator, get_aggregator
+from csv_inspector.cancel import checked
+from csv_inspector.join import (key_func, hash_join, nested_loop_join,
+                                band_join, COMPARISON_FUNC_BY_ON)
+from csv_inspector.cursor import cursors, print_cursor, show_columns
+from csv_inspector.expr import Expression
+from csv_inspector.frame import encode_frame
+from csv_inspector.instrument import (instrumented, records, show_records,
+                                      OperationRecord)
+from csv_inspector.lazy import LazyData
+from csv_inspector.parallel import map_ranges
+from csv_inspector.stats import columns_stats, EXACT
+from csv_inspector.util import (begin_csv, end_csv, frames_accepted,
+                                send_frame, ColumnGroup, to_indices,
+                                CategoricalValues, key_values, Column,
+                                ColInfo, get_return_type)
 
 
 class DataSource:
@@ -107,8 +121,12 @@ class DataGrouperHandle:
 
     def agg(self, func, col_type=None):
         """
-        Add a new aggregation.
+        Add a new aggregation. `func` is a function of the list of values, or
+        the name of an incremental aggregator: "count", "sum", "min", "max",
+        "mean", "first", "last" or "count_distinct".
         """
+        if isinstance(func, str):
+            func = get_aggregator(func)
         self._data_grouper._new_agg(Agg(
             self._indices, self._column_group, func, col_type))
 
@@ -128,9 +146,44 @@ class DataGrouper:
     def _new_agg(self, agg: Agg):
         self._aggs.append(agg)
 
-    def group(self):
+    def _aggregate_range(self, key_cols: List[int], agg_cols: List[int],
+                         aggregators: List[Optional[Aggregator]],
+                         start: int, end: int) -> Dict[Tuple, List[Any]]:
+        """
+        :return: the states of the aggregations by key, in the order of the
+        first occurrence of the keys. The state of a function is the list of
+        the values.
+        """
+        columns = self._data_column_group.columns
+        columns_values = [key_values(columns[i].col_values) for i in key_cols]
+        columns_values += [columns[i].col_values for i in agg_cols]
+        if start > 0 or end < self._data_column_group.row_count():
+            columns_values = [col_values[start:end]
+                              for col_values in columns_values]
+        key_len = len(key_cols)
+        states_by_key = {}
+        for row in checked(zip(*columns_values)):
+            key = row[:key_len]
+            states = states_by_key.get(key)
+            if states is None:
+                states = [[] if aggregator is None else aggregator.init()
+                          for aggregator in aggregators]
+                states_by_key[key] = states
+            for c, aggregator in enumerate(aggregators):
+                if aggregator is None:
+                    states[c].append(row[key_len + c])
+                else:
+                    states[c] = aggregator.update(states[c], row[key_len + c])
+        return states_by_key
+
+    @instrumented
+    def group(self, workers: int = 1):
         """
         Group the agg columns by Grouper columns.
+
+        If `workers` > 1, the rows are split in `workers` ranges, the ranges
+        are aggregated by a pool of processes and the partial results are
+        merged. The result is the same.
         """
         indices = set(self._indices)
         funcs = {}
@@ -139,6 +192,9 @@ class DataGrouper:
             for c in agg.indices:
                 funcs[c] = agg.func
                 col_type = agg.col_type
+                if col_type is None and isinstance(agg.func, Aggregator):
+                    col_type = agg.func.result_type(
+                        self._data_column_group[c].col_type)
                 if col_type is not None:
                     col_types[c] = col_type
         agg_cols = sorted(funcs)
@@ -146,60 +202,149 @@ class DataGrouper:
             if c in agg_cols:
                 agg_cols.remove(c)
 
-        vs_list_by_key = {}
-        for row in self._data_column_group.rows():
-            key = tuple([row[i] for i in indices])
-            if key not in vs_list_by_key:
-                vs_list_by_key[key] = [[] for _ in agg_cols]
-            for c, col in enumerate(agg_cols):
-                vs_list_by_key[key][c].append(row[col])
+        aggregators = [funcs[c] if isinstance(funcs[c], Aggregator) else None
+                       for c in agg_cols]
+        key_cols = list(indices)
+        row_count = self._data_column_group.row_count()
+
+        states_by_key = None
+        if workers > 1:
+            # the values are gathered if the partial states can't be merged
+            columns = self._data_column_group.columns
+            range_aggregators = []
+            for c, aggregator in zip(agg_cols, aggregators):
+                if (aggregator is not None
+                        and aggregator.merges_exactly(columns[c].col_type)):
+                    range_aggregators.append(aggregator)
+                else:
+                    range_aggregators.append(None)
+
+            def aggregate_range(start, end):
+                return self._aggregate_range(key_cols, agg_cols,
+                                             range_aggregators, start, end)
+
+            partial_states_by_key_list = map_ranges(aggregate_range,
+                                                    row_count, workers)
+            if partial_states_by_key_list is not None:
+                states_by_key = {}
+                for partial_states_by_key in partial_states_by_key_list:
+                    _merge_states(states_by_key, partial_states_by_key,
+                                  range_aggregators)
+        if states_by_key is None:
+            range_aggregators = aggregators
+            states_by_key = self._aggregate_range(
+                key_cols, agg_cols, aggregators, 0, row_count)
 
         new_rows = []
-        for key, vs_list in vs_list_by_key.items():
+        for key, states in states_by_key.items():
             xs = [None] * len(agg_cols)
-            for c, vs in enumerate(vs_list):
-                func = funcs[agg_cols[c]]
-                xs[c] = func(vs)
+            for c, state in enumerate(states):
+                if range_aggregators[c] is not None:
+                    xs[c] = range_aggregators[c].result(state)
+                elif aggregators[c] is not None:
+                    xs[c] = aggregators[c].aggregate(state)
+                else:
+                    xs[c] = funcs[agg_cols[c]](state)
             new_rows.append(key + tuple(xs))
 
-        columns = [col for i, col in enumerate(self._data_column_group) if
-                   i in indices or i in agg_cols]
-        for c in agg_cols:
-            if c in col_types:
-                columns[c].col_type = col_types[c]
-        for col, col_values in zip(columns, zip(*new_rows)):
-            col.col_values = col_values
+        source_cols = key_cols + agg_cols
+        columns_values = list(zip(*new_rows)) or [()] * len(source_cols)
+        col_values_by_index = dict(zip(source_cols, columns_values))
+        columns = []
+        for i, col in enumerate(self._data_column_group):
+            if i in col_values_by_index:
+                col_values = col_values_by_index[i]
+                if i in indices:
+                    if isinstance(col.col_values, CategoricalValues):
+                        # the keys are codes
+                        col_values = col.col_values.from_codes(col_values)
+                elif i in col_types:
+                    col.col_type = col_types[i]
+                col.col_values = col_values
+                columns.append(col)
 
         self._data_column_group.replace_columns(columns)
 
 
+def _merge_states(states_by_key: Dict[Tuple, List[Any]],
+                  other_states_by_key: Dict[Tuple, List[Any]],
+                  aggregators: List[Optional[Aggregator]]):
+    """
+    Merge the states of the next rows into `states_by_key`.
+    """
+    for key, other_states in other_states_by_key.items():
+        states = states_by_key.get(key)
+        if states is None:
+            states_by_key[key] = other_states
+            continue
+        for c, aggregator in enumerate(aggregators):
+            if aggregator is None:
+                states[c].extend(other_states[c])
+            else:
+                states[c] = aggregator.merge(states[c], other_states[c])
+
+
+def _categorical_mask(func, handle_values: List[CategoricalValues]
+                      ) -> List[Any]:
+    """
+    Call `func` once for every distinct tuple of codes.
+    """
+    if len(handle_values) == 1:
+        table = handle_values[0].lookup_table()
+        truth_by_code = {}
+        mask = []
+        for code in checked(handle_values[0].codes):
+            try:
+                truth = truth_by_code[code]
+            except KeyError:
+                truth = func(table[code])
+                truth_by_code[code] = truth
+            mask.append(truth)
+        return mask
+
+    tables = [col_values.lookup_table() for col_values in handle_values]
+    truth_by_codes = {}
+    mask = []
+    for codes in checked(zip(*[col_values.codes
+                               for col_values in handle_values])):
+        try:
+            truth = truth_by_codes[codes]
+        except KeyError:
+            truth = func(*[table[code] for table, code in zip(tables, codes)])
+            truth_by_codes[codes] = truth
+        mask.append(truth)
+    return mask
+
+
 class DataHandle:
     def __init__(self, data_column_group: ColumnGroup, indices: List[int]):
         self._indices = indices
         self._data_column_group = data_column_group
 
-    def show(self, limit: int = 100):
+    @instrumented
+    def show(self, limit: int = 100) -> int:
         """
         Show the first rows of this DataHandle.
-        Expected format: CSV with comma
+        Expected format: CSV with comma, or a binary frame if the client
+        accepts frames.
+
+        The columns are registered as a server side cursor: the client may
+        ask for other pages (see `csv_inspector.cursor`).
+
+        :return: the cursor id
         """
-        writer = csv.writer(sys.stdout, delimiter=',')
-        begin_csv()
-        writer.writerow(
-            [col.col_type for i, col in enumerate(self._data_column_group) if
-             i in self._indices])
-        writer.writerow(
-            [col.name for i, col in enumerate(self._data_column_group) if
-             i in self._indices])
-        writer.writerows(self._rows(limit))
-        sys.stdout.flush()
-        end_csv()
+        columns = [col for i, col in enumerate(self._data_column_group) if
+                   i in self._indices]
+        cursor_id = cursors.register(columns)
+        print_cursor(cursor_id, cursors.get(cursor_id))
+        show_columns([col.name for col in columns],
+                     [col.col_type for col in columns],
+                     [col.col_values for col in columns], limit)
+        return cursor_id
 
     # TODO: __getitem__ -> row
 
-    def _rows(self, limit: int = 100):
-        return islice(self._data_column_group.rows(self._indices), limit)
-
+    @instrumented
     def select(self):
         """
         Select the indices of the handle and drop the other indices.
@@ -225,6 +370,7 @@ class DataHandle:
             [col for i, col in enumerate(self._data_column_group) if
              i in self._indices])
 
+    @instrumented
     def drop(self):
         """
         Drop the indices of the handle and select the other indices.
@@ -250,6 +396,7 @@ class DataHandle:
                    if i not in self._indices]
         self._data_column_group.replace_columns(columns)
 
+    @instrumented
     def swap(self, other_handle: "DataHandle"):
         """
         Swap two handles. Those handles may be backed by the same data or not.
@@ -285,6 +432,7 @@ class DataHandle:
                 columns[j] = other_columns[k]
                 other_columns[k] = temp
 
+    @instrumented
     def update(self, func, col_name=None, col_type=None):
         """
         Update some column using a function.
@@ -318,8 +466,40 @@ class DataHandle:
 
         columns = self._data_column_group.columns
         columns[index] = Column(col_name, col_type,
-                                [func(v) for v in column.col_values])
+                                [func(v) for v in checked(column.col_values)])
+
+    @instrumented
+    def update_expr(self, expr: str, col_name=None, col_type=None):
+        """
+        Update some column using an expression. The expression is evaluated
+        on whole columns (see `filter_expr`).
+
+        Syntax: `data[x].update_expr(expr)`
+
+        * `x` is an index
+        * `expr` is an expression on `c<x>`
+
+        >>> test_data = original_test_data.copy()
+        >>> test_data[1].update_expr("c1 * 3")
+        >>> print(test_data)
+         A  B C D
+         1  9 2 4
+         5  6 2 7
+         3 12 7 8
+        """
+        assert len(self._indices) == 1
+        index = self._indices[0]
+        column = self._data_column_group[index]
+        col_values = self._evaluate(expr)
+        if col_type is None:
+            col_type = _get_values_type(col_values, column.col_type)
+        if col_name is None:
+            col_name = column.name
+
+        columns = self._data_column_group.columns
+        columns[index] = Column(col_name, col_type, col_values)
 
+    @instrumented
     def create(self, func, col_name, col_type=None, index=None):
         """
         Create a new col
@@ -349,8 +529,8 @@ class DataHandle:
 
         columns = self._data_column_group.columns
         column = Column(col_name, col_type,
-                        [func(*vs) for vs in
-                         self._data_column_group.rows(self._indices)])
+                        [func(*vs) for vs in checked(
+                            self._data_column_group.rows(self._indices))])
 
         if index is None:
             columns.append(column)
@@ -359,13 +539,63 @@ class DataHandle:
 
         self._data_column_group.replace_columns(columns)
 
+    @instrumented
+    def create_expr(self, expr: str, col_name, col_type=None, index=None):
+        """
+        Create a new col using an expression. The expression is evaluated
+        on whole columns (see `filter_expr`).
+
+        Syntax: `data[x].create_expr(expr, col_name, [col_type, [index]])`
+
+        * `x` is an index, slice or tuple of slices/indices of column_index
+        * `expr` is an expression on `c<i>` for `i` in `x`
+        * `col_name` is the name of the new column
+        * `col_type` is the type of the new column
+        * `index` is the index of the new column
+
+        >>> test_data = original_test_data.copy()
+        >>> test_data[:3].create_expr("c0 + c1 + c2", "E", int, 1)
+        >>> print(test_data)
+         A  E B C D
+         1  6 3 2 4
+         5  9 2 2 7
+         3 14 4 7 8
+        """
+        col_values = self._evaluate(expr)
+        if col_type is None:
+            col_type = _get_values_type(col_values, Any)
+
+        columns = self._data_column_group.columns
+        column = Column(col_name, col_type, col_values)
+        if index is None:
+            columns.append(column)
+        else:
+            columns.insert(index, column)
+
+        self._data_column_group.replace_columns(columns)
+
+    def _expression(self, expr: str) -> Expression:
+        expression = Expression(expr)
+        unknown_indices = expression.indices - set(self._indices)
+        if unknown_indices:
+            raise ValueError(
+                f"Indices not in the handle: {sorted(unknown_indices)}")
+        return expression
+
+    def _evaluate(self, expr: str) -> List[Any]:
+        expression = self._expression(expr)
+        return expression.evaluate(self._col_values_by_index(expression),
+                                   self._data_column_group.row_count())
+
+    def _col_values_by_index(self, expression: Expression
+                             ) -> Mapping[int, Sequence[Any]]:
+        return {i: self._data_column_group[i].col_values
+                for i in expression.indices}
+
     def _get_new_col_type(self, func, default_col_type):
-        try:
-            col_type = func.__annotations__['return']
-        except (KeyError, AttributeError):
-            col_type = default_col_type
-        return col_type
+        return get_return_type(func, default_col_type)
 
+    @instrumented
     def merge(self, func, col_name, col_type=None):
         """
         Create a new col by merging some columns. Those columns are
@@ -398,13 +628,14 @@ class DataHandle:
         columns = [col for i, col in enumerate(self._data_column_group.columns)
                    if i not in self._indices[1:]]
         column = Column(col_name, col_type,
-                        [func(*vs) for vs in
-                         self._data_column_group.rows(self._indices)])
+                        [func(*vs) for vs in checked(
+                            self._data_column_group.rows(self._indices))])
 
         columns[self._indices[0]] = column
 
         self._data_column_group.replace_columns(columns)
 
+    @instrumented
     def move_after(self, index):
         """
         Move some column_group after a given index.
@@ -429,6 +660,7 @@ class DataHandle:
          """
         self._move_before(index + 1)
 
+    @instrumented
     def move_before(self, index):
         """
         Move some column_group before a given index.
@@ -468,6 +700,7 @@ class DataHandle:
 
         self._data_column_group.replace_columns(columns)
 
+    @instrumented
     def filter(self, func):
         """
         Filter data on a function.
@@ -488,15 +721,52 @@ class DataHandle:
          A B C D
          5 2 2 7
         """
-        indices = set(self._indices)
-        new_rows = []
-        for row in self._data_column_group.rows():
-            vs = [row[i] for i in indices]
-            if func(*vs):
-                new_rows.append(row)
+        columns = self._data_column_group.columns
+        handle_values = [columns[i].col_values for i in set(self._indices)]
+        if handle_values and all(isinstance(col_values, CategoricalValues)
+                                 for col_values in handle_values):
+            mask = _categorical_mask(func, handle_values)
+        else:
+            mask = [func(*vs) for vs in checked(zip(*handle_values))]
+        self._data_column_group.compress_rows(mask)
+
+    @instrumented
+    def filter_expr(self, expr: str):
+        """
+        Filter data on an expression. The expression is evaluated on whole
+        columns: this is faster than `filter`, especially on numeric columns
+        if NumPy is installed.
+
+        In the expression, `c<i>` is the column of index i. The operators
+        are the arithmetic operators, the comparisons, `in`, `not in`,
+        `is None`, `is not None`, `and`, `or` and `not`. A comparison or an
+        arithmetic operation on a null is null, except `==` and `!=`; a null
+        is false.
+
+        Syntax: `data[x].filter_expr(expr)`
+
+        * `x` is an index, slice or tuple of slices/indices.
+        * `expr` is an expression on `c<i>` for `i` in `x`, e.g. `"c2 > 10"`
 
-        self._data_column_group.replace_rows(new_rows)
+        >>> test_data = original_test_data.copy()
+        >>> test_data[1:3].filter_expr("c1 == c2")
+        >>> print(test_data)
+         A B C D
+         5 2 2 7
+        >>> test_data = original_test_data.copy()
+        >>> test_data[0, 3].filter_expr("c0 * 2 < c3")
+        >>> print(test_data)
+         A B C D
+         1 3 2 4
+         3 4 7 8
+        """
+        expression = self._expression(expr)
+        mask = expression.evaluate_truth(
+            self._col_values_by_index(expression),
+            self._data_column_group.row_count())
+        self._data_column_group.compress_rows(mask)
 
+    @instrumented
     def sort(self, func=None, reverse=False):
         """
         Sort the rows.
@@ -520,18 +790,21 @@ class DataHandle:
          3 4 7 8
         """
         indices = set(self._indices)
-        if func is None:
-            def key_func(row):
-                return tuple([row[i] for i in indices])
+        if not indices:
+            return
+        columns = self._data_column_group.columns
+        if func is None:  # the codes have the order of the values
+            keys = list(zip(*[key_values(columns[i].col_values, ordered=True)
+                              for i in indices]))
         else:
-            def key_func(row):
-                handle_row = [row[i] for i in indices]
-                return func(*handle_row)
+            keys = [func(*vs) for vs in
+                    checked(zip(*[columns[i].col_values for i in indices]))]
 
-        new_rows = sorted(self._data_column_group.rows(), key=key_func,
-                          reverse=reverse)
-        self._data_column_group.replace_rows(new_rows)
+        order = sorted(range(len(keys)), key=keys.__getitem__,
+                       reverse=reverse)
+        self._data_column_group.take_rows(order)
 
+    @instrumented
     def rsort(self, func=None):
         """
         Sort the rows in reverse order.
@@ -556,6 +829,7 @@ class DataHandle:
         """
         self.sort(func, reverse=True)
 
+    @instrumented
     def rename(self, names):
         """
         Rename one or more columns
@@ -582,16 +856,21 @@ class DataHandle:
         for i, name in zip(self._indices, names):
             self._data_column_group.rename(i, name)
 
-    def ijoin(self, other_handle: "DataHandle", func=None):
+    @instrumented
+    def ijoin(self, other_handle: "DataHandle", func=None, on=None):
         """
         Make an inner join between two data sets.
 
-        Syntax: `data1[x].ijoin(data2[y], func)`
+        Syntax: `data1[x].ijoin(data2[y], [func | on=op])`
 
         * `x` is the index, slice or tuple of slices/indices of the key
         * `data2` is another `Data` object
         * `y` is the index, slice or tuple of slices/indices of the other key
         * `func` is the function to compare the `x` and `y` values
+          (default: the keys are equal; a hash join is used)
+        * `op` is one of "==", "<", "<=", ">", ">=" (compare the `x` key to
+          the `y` key) or "between" (`y` is a pair of columns: low, high).
+          Both sides are sorted and merged: faster than the `func` version.
 
         >>> test_data1 = original_test_data.copy()
         >>> test_data2 = original_test_data.copy()
@@ -606,42 +885,133 @@ class DataHandle:
          A B C D A' B' C' D'
          5 2 2 7  1  3  2  4
          5 2 2 7  5  2  2  7
+        >>> test_data1 = original_test_data.copy()
+        >>> test_data1[0].ijoin(test_data2[1, 3], on="between")
+        >>> print(test_data1)
+         A B C D A' B' C' D'
+         5 2 2 7  5  2  2  7
+         5 2 2 7  3  4  7  8
+         3 4 7 8  1  3  2  4
+         3 4 7 8  5  2  2  7
         """
-        if func is None:
-            def func(vs1, vs2):
-                return vs1 == vs2
+        self._put_pairs(other_handle, self._join_pairs(other_handle, func, on))
 
-        indices = set(self._indices)
-        other_indices = set(other_handle._indices)
-        new_rows = []
-        for row in self._data_column_group.rows():
-            key = tuple([row[i] for i in indices])
-            for other_row in other_handle._data_column_group.rows():
-                other_key = tuple([other_row[i] for i in other_indices])
-                if func(key, other_key):
-                    new_rows.append(row + other_row)
+    def _join_pairs(self, other_handle: "DataHandle", func, on,
+                    keep_left=False, keep_right=False, right_major=False):
+        """
+        Join the rows with a band join if `on` is a comparison, with a hash
+        join if `func` is None, with a nested loop otherwise. Return the list
+        of (row, other_row) pairs.
 
+        If `right_major` is True, pairs are ordered by other row.
+        """
+        if func is not None and on is not None:
+            raise ValueError("Expected either func or on")
+        if on == "==":
+            on = None
+        elif on is not None and on not in COMPARISON_FUNC_BY_ON:
+            raise ValueError(f"Unknown comparison {on}")
+
+        if right_major and on is None:
+            if func is None:
+                reversed_func = None
+            else:
+                def reversed_func(other_key, key):
+                    return func(key, other_key)
+
+            other_pairs = other_handle._join_pairs(
+                self, reversed_func, None, keep_right, keep_left)
+            return [(row, other_row) for other_row, row in other_pairs]
+
+        rows = list(self._data_column_group.rows())
+        other_rows = list(other_handle._data_column_group.rows())
+        if on is None and func is None:
+            code_keys = self._code_keys(other_handle)
+            if code_keys is not None:
+                keys, other_keys = code_keys
+                index_pairs = hash_join(
+                    range(len(rows)), range(len(other_rows)),
+                    keys.__getitem__, other_keys.__getitem__,
+                    keep_left, keep_right)
+                return [(None if i is None else rows[i],
+                         None if j is None else other_rows[j])
+                        for i, j in checked(index_pairs)]
+
+        key = key_func(set(self._indices))
+        other_key = key_func(set(other_handle._indices))
+        if on is not None:
+            pairs = band_join(rows, other_rows, key, other_key, on,
+                              keep_left, keep_right, right_major)
+        elif func is None:
+            try:
+                pairs = hash_join(rows, other_rows, key, other_key,
+                                  keep_left, keep_right)
+            except TypeError:  # unhashable key
+                pairs = nested_loop_join(rows, other_rows, key, other_key,
+                                         operator.eq, keep_left, keep_right)
+        else:
+            pairs = nested_loop_join(rows, other_rows, key, other_key, func,
+                                     keep_left, keep_right)
+        return pairs
+
+    def _code_keys(self, other_handle: "DataHandle"
+                   ) -> Optional[Tuple[List[Tuple], List[Tuple]]]:
+        """
+        If the key columns of both handles are categorical, return the keys
+        of the rows as tuples of codes: the codes of the other handle are
+        translated to the codes of this handle. Else return None.
+        """
+        col_values_list = [self._data_column_group[i].col_values
+                           for i in set(self._indices)]
+        other_col_values_list = [
+            other_handle._data_column_group[i].col_values
+            for i in set(other_handle._indices)]
+        if (len(col_values_list) != len(other_col_values_list)
+                or not all(isinstance(col_values, CategoricalValues)
+                           for col_values in itertools.chain(
+                        col_values_list, other_col_values_list))):
+            return None
+
+        codes_list = [col_values.codes for col_values in col_values_list]
+        other_codes_list = [
+            col_values.translate(other_col_values)
+            for col_values, other_col_values
+            in zip(col_values_list, other_col_values_list)]
+        return list(zip(*codes_list)), list(zip(*other_codes_list))
+
+    def _put_pairs(self, other_handle: "DataHandle", pairs):
+        none_row = tuple([None] * len(self._data_column_group))
+        other_none_row = tuple([None] * len(other_handle._data_column_group))
+        new_rows = [(none_row if row is None else row)
+                    + (other_none_row if other_row is None else other_row)
+                    for row, other_row in checked(pairs)]
         self._append_other_columns_and_put_rows(other_handle, new_rows)
 
     def _append_other_columns_and_put_rows(self, other_handle: "DataHandle",
                                            new_rows):
-        columns = [Column(col.name, col.col_type, []) for col in
-                   itertools.chain(self._data_column_group,
-                                   other_handle._data_column_group)]
+        # an empty slice keeps the categories
+        columns = [Column(col.name, col.col_type, col.col_values[:0])
+                   for col in itertools.chain(self._data_column_group,
+                                              other_handle._data_column_group)]
         column_group = ColumnGroup(columns)
         column_group.replace_rows(new_rows)
         self._data_column_group.replace_columns(column_group.columns)
 
-    def ljoin(self, other_handle: "DataHandle", func=None):
+    @instrumented
+    def ljoin(self, other_handle: "DataHandle", func=None, on=None):
         """
         Make an inner join between two data sets.
 
-        Syntax: `data1[x].ljoin(data2[y], func)`
+        Syntax: `data1[x].ljoin(data2[y], [func | on=op])`
 
         * `x` is the index, slice or tuple of slices/indices of the key
         * `data2` is another `Data` object
         * `y` is the index, slice or tuple of slices/indices of the other key
         * `func` is the function to compare the `x` and `y` values
+          (default: the keys are equal; a hash join is used)
+        * `op` is one of "==", "<", "<=", ">", ">=" (compare the `x` key to
+          the `y` key) or "between" (`y` is a pair of columns: low, high).
+          Both sides are sorted and merged: faster than the `func` version.
 
         >>> test_data1 = original_test_data.copy()
         >>> test_data2 = original_test_data.copy()
@@ -659,38 +1029,24 @@ class DataHandle:
          5 2 2 7    5    2    2    7
          3 4 7 8 None None None None
         """
-        if func is None:
-            def func(vs1, vs2):
-                return vs1 == vs2
+        pairs = self._join_pairs(other_handle, func, on, keep_left=True)
+        self._put_pairs(other_handle, pairs)
 
-        indices = set(self._indices)
-        other_indices = set(other_handle._indices)
-        new_rows = []
-        for row in self._data_column_group.rows():
-            key = tuple([row[i] for i in indices])
-            found = False
-            for other_row in other_handle._data_column_group.rows():
-                other_key = tuple(
-                    [other_row[i] for i in other_indices])
-                if func(key, other_key):
-                    found = True
-                    new_rows.append(row + other_row)
-            if not found:
-                new_rows.append(
-                    row + tuple([None] * len(other_handle._data_column_group)))
-
-        self._append_other_columns_and_put_rows(other_handle, new_rows)
-
-    def rjoin(self, other_handle: "DataHandle", func=None):
+    @instrumented
+    def rjoin(self, other_handle: "DataHandle", func=None, on=None):
         """
         Make an right join between two data sets.
 
-        Syntax: `data1[x].rjoin(data2[y], func)`
+        Syntax: `data1[x].rjoin(data2[y], [func | on=op])`
 
         * `x` is the index, slice or tuple of slices/indices of the key
         * `data2` is another `Data` object
         * `y` is the index, slice or tuple of slices/indices of the other key
         * `func` is the function to compare the `x` and `y` values
+          (default: the keys are equal; a hash join is used)
+        * `op` is one of "==", "<", "<=", ">", ">=" (compare the `x` key to
+          the `y` key) or "between" (`y` is a pair of columns: low, high).
+          Both sides are sorted and merged: faster than the `func` version.
 
         >>> test_data1 = original_test_data.copy()
         >>> test_data2 = original_test_data.copy()
@@ -707,37 +1063,25 @@ class DataHandle:
             5    2    2    7  5  2  2  7
          None None None None  3  4  7  8
          """
-        if func is None:
-            def func(vs1, vs2):
-                return vs1 == vs2
-
-        indices = set(self._indices)
-        other_indices = set(other_handle._indices)
-        new_rows = []
-        for other_row in other_handle._data_column_group.rows():
-            other_key = tuple([other_row[i] for i in other_indices])
-            found = False
-            for row in self._data_column_group.rows():
-                key = tuple([row[i] for i in indices])
-                if func(key, other_key):
-                    found = True
-                    new_rows.append(row + other_row)
-            if not found:
-                new_rows.append(
-                    tuple([None] * len(self._data_column_group)) + other_row)
+        pairs = self._join_pairs(other_handle, func, on, keep_right=True,
+                                 right_major=True)
+        self._put_pairs(other_handle, pairs)
 
-        self._append_other_columns_and_put_rows(other_handle, new_rows)
-
-    def ojoin(self, other_handle: "DataHandle", func=None):
+    @instrumented
+    def ojoin(self, other_handle: "DataHandle", func=None, on=None):
         """
         Make an outer join between two data sets.
 
-        Syntax: `data1[x].ojoin(data2[y], func)`
+        Syntax: `data1[x].ojoin(data2[y], [func | on=op])`
 
         * `x` is the index, slice or tuple of slices/indices of the key
         * `data2` is another `Data` object
         * `y` is the index, slice or tuple of slices/indices of the other key
         * `func` is the function to compare the `x` and `y` values
+          (default: the keys are equal; a hash join is used)
+        * `op` is one of "==", "<", "<=", ">", ">=" (compare the `x` key to
+          the `y` key) or "between" (`y` is a pair of columns: low, high).
+          Both sides are sorted and merged: faster than the `func` version.
 
         >>> test_data1 = original_test_data.copy()
         >>> test_data2 = original_test_data.copy()
@@ -756,33 +1100,9 @@ class DataHandle:
             3    4    7    8 None None None None
          None None None None    3    4    7    8
          """
-        if func is None:
-            def func(vs1, vs2):
-                return vs1 == vs2
-
-        indices = set(self._indices)
-        other_indices = set(other_handle._indices)
-        new_rows = []
-        other_rows = list(other_handle._data_column_group.rows())
-        other_rows_not_found = list(other_rows)
-        for row in self._data_column_group.rows():
-            key = tuple([row[i] for i in indices])
-            found = False
-            for i, other_row in enumerate(other_rows):
-                other_key = tuple([other_row[i] for i in other_indices])
-                if func(key, other_key):
-                    found = True
-                    other_rows_not_found[i] = None
-                    new_rows.append(row + other_row)
-            if not found:
-                new_rows.append(
-                    row + tuple([None] * len(other_handle._data_column_group)))
-
-        for other_row in filter(None, other_rows_not_found):
-            new_rows.append(
-                tuple([None] * len(self._data_column_group)) + other_row)
-
-        self._append_other_columns_and_put_rows(other_handle, new_rows)
+        pairs = self._join_pairs(other_handle, func, on, keep_left=True,
+                                 keep_right=True)
+        self._put_pairs(other_handle, pairs)
 
     def grouper(self) -> DataGrouper:
         """
@@ -794,11 +1114,17 @@ class DataHandle:
         g.group()
         ```
 
+        The incremental aggregators do not store the values of the groups:
+        "count", "sum", "min", "max", "mean", "first", "last",
+        "count_distinct". "sum", "min", "max" and "mean" ignore the nulls.
+
+        `g.group(workers=n)` splits the rows between `n` processes.
+
         Syntax: `g = data[x].grouper()`
 
         * `x` is the index, slice or tuple of slices/indices of the rows
         * `y` is the index, slice or tuple of slices/indices of the aggregate columns
-        * `func` is aggregate function
+        * `func` is aggregate function or the name of an incremental aggregator
 
         >>> test_data = original_test_data.copy()
         >>> test_data[0].update(lambda x: x%2)
@@ -815,56 +1141,78 @@ class DataHandle:
         >>> print(test_data)
          A B C  D
          1 4 2 19
+        >>> test_data = original_test_data.copy()
+        >>> g = test_data[2].grouper()
+        >>> g[0].agg("mean")
+        >>> g[1].agg("count")
+        >>> g[3].agg("sum")
+        >>> g.group()
+        >>> print(test_data)
+           A B C  D
+         3.0 2 2 11
+         3.0 1 7  8
         """
         return DataGrouper(self._data_column_group, self._indices)
 
-    def stats(self):
+    @instrumented
+    def stats(self, quantiles: str = EXACT, workers: int = 1):
         """
         Show stats on the data
 
         Syntax: `data.stats()`
         """
 
-        def aggregate(func, vs):
-            try:
-                return func(vs)
-            except:
-                return "-"
+        def to_cell(value):
+            return "-" if value is None else value
 
-        writer = csv.writer(sys.stdout, delimiter=',')
-        begin_csv()
-        writer.writerow(
-            ["str", "object", "type", "int", "comparable", "comparable",
-             "comparable", "comparable"])
-        writer.writerow(
-            ["key", "value", "type", "null count", "min", "max", "mean",
-             "median"])
-        writer.writerow(
+        type_row = ["str", "object", "type", "int", "comparable",
+                    "comparable", "comparable", "comparable"]
+        name_row = ["key", "value", "type", "null count", "min", "max",
+                    "mean", "median"]
+        rows = [
             ["line count", len(self._data_column_group.columns[0]),
-             "-", "-", "-", "-", "-"])
-        writer.writerow(
+             "-", "-", "-", "-", "-"],
             ["column count", len(self._data_column_group),
-             "-", "-", "-", "-", "-"])
-        for i, column in enumerate(self._data_column_group):
-            vs = [v for v in column.col_values if v is not None]
-            null_count = len(column.col_values) - len(vs)
-            if column.col_type == str:
-                writer.writerow(
-                    [f"column {i}", column.name, column.col_type, null_count,
-                     "-", "-", "-", "-"])
-            else:
-                vs_min = aggregate(min, vs)
-                vs_max = aggregate(max, vs)
-                vs_mean = aggregate(statistics.mean, vs)
-                vs_median = aggregate(statistics.median, vs)
-                writer.writerow(
-                    [f"column {i}", column.name, column.col_type, null_count,
-                     vs_min, vs_max, vs_mean, vs_median])
+             "-", "-", "-", "-", "-"]
+        ]
+        stats_list = columns_stats(self._data_column_group.columns, quantiles,
+                                   workers)
+        for i, (column, column_stats) in enumerate(
+                zip(self._data_column_group, stats_list)):
+            rows.append(
+                [f"column {i}", column.name, column.col_type,
+                 column_stats.null_count, to_cell(column_stats.min),
+                 to_cell(column_stats.max), to_cell(column_stats.mean),
+                 to_cell(column_stats.median)])
+
+        if frames_accepted():
+            columns_values = [[row[j] if j < len(row) else "-" for row in rows]
+                              for j in range(len(name_row))]
+            send_frame(encode_frame(name_row, type_row, columns_values))
+            return
 
+        writer = csv.writer(sys.stdout, delimiter=',')
+        begin_csv()
+        writer.writerow(type_row)
+        writer.writerow(name_row)
+        writer.writerows(rows)
         sys.stdout.flush()
         end_csv()
 
 
+def _get_values_type(col_values: Sequence[Any], default_col_type):
+    """
+    >>> _get_values_type([1, None, 2], Any)
+    <class 'int'>
+    >>> _get_values_type([1, "a"], Any)
+    typing.Any
+    """
+    value_types = {type(v) for v in col_values} - {type(None)}
+    if len(value_types) == 1:
+        return value_types.pop()
+    return default_col_type
+
+
 class Data:
     def __init__(self, column_group: ColumnGroup, data_source: DataSource):
         self._column_group = column_group
@@ -876,18 +1224,25 @@ class Data:
             [self._column_group[i] for i in indices])
         return DataHandle(self._column_group, indices)
 
-    def show(self, limit: int = 100):
+    @instrumented
+    def show(self, limit: int = 100) -> int:
         """
         Show the first rows of this DataHandle.
         Expected format: CSV with comma
         """
-        self.as_handle().show(limit)
+        return self.as_handle().show(limit)
 
-    def stats(self):
+    @instrumented
+    def stats(self, quantiles: str = EXACT, workers: int = 1):
         """
-        Show stats on the data
+        Show stats on the data.
+
+        :param quantiles: "exact" or "tdigest" (approximate median, bounded
+        memory)
+        :param workers: the number of processes that compute the stats of the
+        columns
         """
-        self.as_handle().stats()
+        self.as_handle().stats(quantiles, workers)
 
     def grouper(self) -> DataGrouper:
         """
@@ -895,22 +1250,46 @@ class Data:
         """
         return DataGrouper(self._column_group, [])
 
+    def lazy(self) -> LazyData:
+        """
+        Return a lazy version of this data object: the `filter`, `create`,
+        `update`, `select`, `drop`, `rename` and `sort` operations are
+        recorded and executed on `collect()` or `show()`.
+        """
+        return LazyData(self)
+
     def as_handle(self) -> DataHandle:
         return DataHandle(self._column_group,
                           list(range(len(self._column_group))))
 
+    @instrumented
     def copy(self) -> "Data":
         """
         Return a copy of this data object.
         """
         return Data(self._column_group.copy(), self._data_source)
 
+    def __deepcopy__(self, memo) -> "Data":
+        return self.copy()
+
+    def profile(self) -> List[OperationRecord]:
+        """
+        Show the records of the operations on this data object in an info
+        block (see `csv_inspector.enable_profiling`).
+
+        :return: the records
+        """
+        operation_records = records(self._column_group)
+        show_records(operation_records)
+        return operation_records
+
     def __str__(self) -> str:
         return str(self._column_group)
 
     def __repr__(self) -> str:
         return f"Data{self._column_group}"
 
+    @instrumented
     def save_as(self, path: Union[str, Path], canonical=True):
         """
         :param canonical: if true, fields format is canonical. If false,
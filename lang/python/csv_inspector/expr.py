@@ -0,0 +1,442 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Expressions on whole columns, e.g. `"c2 > 10 and c5 != ''"`: `c<i>` is the
+column of index i.
+
+Nulls: `==` and `!=` follow the Python semantics (None is only equal to
+None); `is None` and `is not None` are available; the other comparisons and
+the arithmetic operations return null if an operand is null; `and`, `or` and
+`not` return booleans and a null is false. In a bool, int or float column,
+a read error is a null.
+
+If NumPy is available, the operations on bool, int and float columns are
+vectorized.
+"""
+import ast
+import operator
+import re
+from itertools import repeat
+from typing import Any, Mapping, Sequence, Set, List, Optional
+
+from csv_inspector.util import TypedValues
+
+np = None  # imported on the first use: the import is slow
+_numpy_imported = False
+
+COLUMN_NAME_PATTERN = re.compile(r"^c(\d+)$")
+SAFE_INT = 2 ** 53  # an int64 value that converts exactly to a float64
+
+BINARY_FUNC_BY_OP = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod, ast.Pow: operator.pow,
+}
+COMPARISON_FUNC_BY_OP = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+UNARY_FUNC_BY_OP = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+NUMPY_SAFE_OPS = {operator.add, operator.sub, operator.mul, operator.truediv,
+                  operator.floordiv, operator.mod, operator.eq, operator.ne,
+                  operator.lt, operator.le, operator.gt, operator.ge}
+
+
+class Scalar:
+    def __init__(self, value: Any):
+        self.value = value
+
+
+class ListVector:
+    """The values, with None for nulls"""
+
+    def __init__(self, values: Sequence[Any]):
+        self.values = values
+
+
+class ArrayVector:
+    """A numpy array of bool, int or float, and a mask of nulls (or errors)"""
+
+    def __init__(self, values, nulls=None):
+        self.values = values
+        self.nulls = nulls
+
+    def int_bound(self) -> int:
+        """The max absolute value if values are int, else 0."""
+        if self.values.dtype.kind != "i" or not len(self.values):
+            return 0
+        return max(abs(int(self.values.max())), abs(int(self.values.min())))
+
+    def to_list_vector(self) -> ListVector:
+        values = self.values.tolist()
+        if self.nulls is not None:
+            values = [None if n else v
+                      for v, n in zip(values, self.nulls.tolist())]
+        return ListVector(values)
+
+
+def _has_numpy() -> bool:
+    """Import NumPy on the first call"""
+    global np, _numpy_imported
+
+    if not _numpy_imported:
+        _numpy_imported = True
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+    return np is not None
+
+
+def to_vector(col_values: Sequence[Any]):
+    """
+    Wrap the values of a column. The values of a `TypedValues` are not
+    copied.
+    """
+    if isinstance(col_values, TypedValues) and _has_numpy():
+        values, nulls = col_values.buffers()
+        array = np.frombuffer(values, dtype={
+            "b": np.int8, "q": np.int64, "d": np.float64}[values.typecode])
+        if values.typecode == "b":
+            array = array.astype(bool)
+        if nulls is not None:
+            nulls = np.frombuffer(nulls, dtype=np.uint8).astype(bool)
+        vector = ArrayVector(array, nulls)
+        if vector.int_bound() < SAFE_INT:
+            return vector
+    if isinstance(col_values, TypedValues) and col_values.error_count():
+        _, invalid = col_values.buffers()
+        col_values = [None if n else v for v, n in zip(col_values, invalid)]
+    return ListVector(col_values)
+
+
+class Expression:
+    """
+    A compiled expression.
+
+    >>> expression = Expression("c0 * 2 > c1 and c2 != ''")
+    >>> sorted(expression.indices)
+    [0, 1, 2]
+    >>> columns = {0: [1, 2, None], 1: [1, 5, 2], 2: ["a", "b", "c"]}
+    >>> expression.evaluate(columns, 3)
+    [True, False, False]
+    >>> Expression("c0 + c1").evaluate(columns, 3)
+    [2, 7, None]
+    >>> Expression("c0 is None or c2 in ('a', 'b')").evaluate(columns, 3)
+    [True, True, True]
+    >>> Expression("c0.real")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unsupported expression: c0.real
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self._tree = ast.parse(text.strip(), mode="eval").body
+        self.indices: Set[int] = set()
+        self._check(self._tree)
+
+    def _check(self, node: ast.AST):
+        if isinstance(node, ast.Name):
+            m = COLUMN_NAME_PATTERN.match(node.id)
+            if m is None:
+                raise ValueError(f"Unknown name: {node.id}")
+            self.indices.add(int(m.group(1)))
+        elif isinstance(node, ast.Constant):
+            pass
+        elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            if not all(isinstance(e, ast.Constant) for e in node.elts):
+                raise ValueError(f"Unsupported expression: {self.text}")
+        elif isinstance(node, (ast.BoolOp, ast.BinOp, ast.UnaryOp,
+                               ast.Compare)):
+            for child in ast.iter_child_nodes(node):
+                if not isinstance(child, (ast.operator, ast.unaryop,
+                                          ast.cmpop, ast.boolop)):
+                    self._check(child)
+        else:
+            raise ValueError(f"Unsupported expression: {self.text}")
+
+    def evaluate(self, col_values_by_index: Mapping[int, Sequence[Any]],
+                 length: int) -> List[Any]:
+        """
+        :return: the list of values, with None for nulls
+        """
+        vector = self._evaluate_vector(col_values_by_index, length)
+        return _to_list(vector, length)
+
+    def evaluate_truth(self, col_values_by_index: Mapping[int, Sequence[Any]],
+                       length: int) -> List[bool]:
+        """
+        :return: the list of the truth values (a null is false)
+        """
+        vector = self._evaluate_vector(col_values_by_index, length)
+        return _to_list(_truth(vector, length), length)
+
+    def _evaluate_vector(self, col_values_by_index, length):
+        vectors_by_index = {i: to_vector(col_values_by_index[i])
+                            for i in self.indices}
+        return _Evaluator(vectors_by_index, length).visit(self._tree)
+
+
+class _Evaluator(ast.NodeVisitor):
+    def __init__(self, vectors_by_index, length: int):
+        self._vectors_by_index = vectors_by_index
+        self._length = length
+
+    def visit_Name(self, node: ast.Name):
+        return self._vectors_by_index[int(node.id[1:])]
+
+    def visit_Constant(self, node: ast.Constant):
+        return Scalar(node.value)
+
+    def visit_Tuple(self, node):
+        return Scalar(frozenset(e.value for e in node.elts))
+
+    visit_List = visit_Tuple
+    visit_Set = visit_Tuple
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Not):
+            return _not(_truth(operand, self._length))
+        if isinstance(node.op, ast.Invert):
+            raise ValueError("Unsupported operator: ~")
+        func = UNARY_FUNC_BY_OP[type(node.op)]
+        if isinstance(operand, Scalar):
+            return Scalar(None if operand.value is None
+                          else func(operand.value))
+        if isinstance(operand, ArrayVector) and operand.values.dtype != bool:
+            return ArrayVector(func(operand.values), operand.nulls)
+        return ListVector([None if v is None else func(v)
+                           for v in _list_values(operand)])
+
+    def visit_BinOp(self, node: ast.BinOp):
+        try:
+            func = BINARY_FUNC_BY_OP[type(node.op)]
+        except KeyError:
+            raise ValueError(f"Unsupported operator: {node.op}")
+        return self._apply(func, self.visit(node.left),
+                           self.visit(node.right))
+
+    def visit_Compare(self, node: ast.Compare):
+        if len(node.ops) == 1:  # keep the nulls
+            return self._compare(node.ops[0], self.visit(node.left),
+                                 self.visit(node.comparators[0]))
+
+        result = None
+        left = self.visit(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = self.visit(comparator)
+            vector = self._compare(op, left, right)
+            if result is None:
+                result = _truth(vector, self._length)
+            else:
+                result = _and(result, _truth(vector, self._length))
+            left = right
+        return result
+
+    def _compare(self, op: ast.cmpop, left, right):
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            if not (isinstance(right, Scalar) and right.value is None):
+                raise ValueError("Expected `is None` or `is not None`")
+            vector = _is_null(left)
+            if isinstance(op, ast.IsNot):
+                vector = _not(vector)
+            return vector
+        return self._apply(COMPARISON_FUNC_BY_OP[type(op)], left, right)
+
+    def visit_BoolOp(self, node: ast.BoolOp):
+        combine = _and if isinstance(node.op, ast.And) else _or
+        result = None
+        for value in node.values:
+            truth = _truth(self.visit(value), self._length)
+            result = truth if result is None else combine(result, truth)
+        return result
+
+    def _apply(self, func, left, right):
+        if isinstance(left, Scalar) and isinstance(right, Scalar):
+            return Scalar(_apply_scalar(func, left.value, right.value))
+        if _has_numpy():
+            vector = _apply_numpy(func, left, right)
+            if vector is not None:
+                return vector
+
+        if func in (operator.eq, operator.ne):
+            def apply(a, b):
+                return func(a, b)
+        else:
+            def apply(a, b):
+                return _apply_scalar(func, a, b)
+
+        lefts = _list_values(left, self._length)
+        rights = _list_values(right, self._length)
+        return ListVector([apply(a, b) for a, b in zip(lefts, rights)])
+
+
+def _apply_scalar(func, a, b):
+    if func in (operator.eq, operator.ne):
+        return func(a, b)
+    if a is None or b is None:
+        return None
+    return func(a, b)
+
+
+def _apply_numpy(func, left, right) -> Optional[ArrayVector]:
+    """
+    :return: the result, or None if the NumPy result could be different
+    from the Python result.
+    """
+    if func not in NUMPY_SAFE_OPS:
+        return None
+    is_arithmetic = func in BINARY_FUNC_BY_OP.values()
+    operands = []
+    nulls = []
+    product_bound = 1
+    for operand in (left, right):
+        if isinstance(operand, ArrayVector):
+            int_bound = operand.int_bound()
+            if int_bound >= SAFE_INT:
+                return None
+            values = operand.values
+            if is_arithmetic and values.dtype == bool:
+                values = values.astype(np.int64)  # True + True == 2
+            operands.append(values)
+            nulls.append(operand.nulls)
+            product_bound *= max(int_bound, 1)
+        elif (isinstance(operand, Scalar)
+              and type(operand.value) in (bool, int, float)
+              and abs(operand.value) < SAFE_INT):
+            operands.append(operand.value)
+            nulls.append(None)
+            product_bound *= max(abs(int(operand.value)), 1)
+        else:
+            return None
+    if func is operator.mul and product_bound >= SAFE_INT:
+        return None
+    a, b = operands
+    if func in (operator.truediv, operator.floordiv, operator.mod):
+        divisors = b if isinstance(b, np.ndarray) else np.array([b])
+        if nulls[1] is not None:
+            divisors = divisors[~nulls[1]]
+        if (divisors == 0).any():
+            return None  # let Python raise the ZeroDivisionError
+    # null divisors; a float overflow is inf, as in Python
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        values = func(a, b)
+
+    null_a, null_b = nulls
+    if null_a is None:
+        result_nulls = null_b
+    elif null_b is None:
+        result_nulls = null_a
+    else:
+        result_nulls = null_a | null_b
+    if func in (operator.eq, operator.ne) and result_nulls is not None:
+        # None == None, None != 1
+        a_is_null = null_a if null_a is not None else False
+        b_is_null = null_b if null_b is not None else False
+        both_nulls = a_is_null & b_is_null
+        if func is operator.eq:
+            values = np.where(result_nulls, both_nulls, values)
+        else:
+            values = np.where(result_nulls, ~both_nulls, values)
+        result_nulls = None
+    return ArrayVector(values, result_nulls)
+
+
+def _list_values(vector, length: int = 0) -> Sequence[Any]:
+    if isinstance(vector, Scalar):
+        return repeat(vector.value, length)
+    if isinstance(vector, ArrayVector):
+        vector = vector.to_list_vector()
+    return vector.values
+
+
+def _is_null(vector):
+    if isinstance(vector, Scalar):
+        return Scalar(vector.value is None)
+    if isinstance(vector, ArrayVector):
+        if vector.nulls is None:
+            return ArrayVector(np.zeros(len(vector.values), dtype=bool))
+        return ArrayVector(vector.nulls)
+    return ListVector([v is None for v in vector.values])
+
+
+def _truth(vector, length: int):
+    """A vector of bools, without nulls"""
+    if isinstance(vector, Scalar):
+        return Scalar(bool(vector.value))
+    if isinstance(vector, ArrayVector):
+        values = vector.values.astype(bool)
+        if vector.nulls is not None:
+            values &= ~vector.nulls
+        return ArrayVector(values)
+    return ListVector([bool(v) for v in vector.values])
+
+
+def _not(vector):
+    if isinstance(vector, Scalar):
+        return Scalar(not vector.value)
+    if isinstance(vector, ArrayVector):
+        return ArrayVector(~vector.values)
+    return ListVector([not v for v in vector.values])
+
+
+def _and(vector, other_vector):
+    return _combine(vector, other_vector, operator.and_)
+
+
+def _or(vector, other_vector):
+    return _combine(vector, other_vector, operator.or_)
+
+
+def _combine(vector, other_vector, func):
+    """Combine two vectors of bools"""
+    if isinstance(vector, Scalar) and isinstance(other_vector, Scalar):
+        return Scalar(func(vector.value, other_vector.value))
+    if isinstance(vector, ArrayVector) and isinstance(other_vector,
+                                                      (ArrayVector, Scalar)):
+        return ArrayVector(func(vector.values, _numpy_operand(other_vector)))
+    if isinstance(vector, Scalar) and isinstance(other_vector, ArrayVector):
+        return ArrayVector(func(vector.value, other_vector.values))
+    length = max(len(v.values) for v in (vector, other_vector)
+                 if not isinstance(v, Scalar))
+    return ListVector([func(a, b) for a, b in
+                       zip(_list_values(vector, length),
+                           _list_values(other_vector, length))])
+
+
+def _numpy_operand(vector):
+    if isinstance(vector, Scalar):
+        return vector.value
+    return vector.values
+
+
+def _to_list(vector, length: int) -> List[Any]:
+    if isinstance(vector, Scalar):
+        return [vector.value] * length
+    if isinstance(vector, ArrayVector):
+        vector = vector.to_list_vector()
+    return list(vector.values)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
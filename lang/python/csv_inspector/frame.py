@@ -0,0 +1,308 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A binary frame for a table, an alternative to the text CSV. All integers are
+little endian.
+
+```
+frame = "CSVF" version:u8 column_count:u32 row_count:u32 column*
+column = name:str type_name:str tag:u8 block_size:u32 block
+str = size:u32 utf-8 bytes
+block = has_validity:u8 [validity: row_count bytes, 1 for a null] payload
+```
+
+The payload depends on the tag:
+
+* `BOOL`: row_count int8;
+* `INT`: row_count int64;
+* `FLOAT`: row_count float64;
+* `TEXT`: (row_count + 1) u32 offsets, then the utf-8 bytes of the values;
+* `DICTIONARY`: category_count:u32, a `TEXT` payload of the categories, then
+row_count int32 codes;
+* `VALUES`: row_count u8 kinds, then a `TEXT` payload of the values (exact
+frames only). The kind of a value is its type (see `KIND_BY_TYPE`) and the
+text is decoded by the kind: nothing is executed on decoding.
+
+The arrays of typed columns are copied as is. The values of other columns
+are converted to text with `str`, unless the frame is exact.
+"""
+import datetime
+import json
+import struct
+import sys
+from array import array
+from decimal import Decimal
+from itertools import islice
+from typing import (Any, Collection, List, Sequence, Tuple, Optional,
+                    Iterable)
+
+from mcsv.field_processors import ReadError
+
+from csv_inspector.util import TypedValues, CategoricalValues
+
+MAGIC = b"CSVF"
+VERSION = 1
+
+TEXT = 0
+BOOL = 1
+INT = 2
+FLOAT = 3
+DICTIONARY = 4
+VALUES = 6
+
+TAG_BY_TYPECODE = {"b": BOOL, "q": INT, "d": FLOAT}
+TYPECODE_BY_TAG = {BOOL: "b", INT: "q", FLOAT: "d"}
+TYPE_BY_TAG = {BOOL: bool, INT: int, FLOAT: float}
+
+_U32 = struct.Struct("<I")
+_HEADER = struct.Struct("<4sBII")
+
+
+def _encode_error(error: ReadError) -> str:
+    """The attributes of the error, if they are texts"""
+    attributes = vars(error)
+    if not all(type(v) is str for v in attributes.values()):
+        raise TypeError(f"Can't encode {error!r}")
+    return json.dumps(attributes)
+
+
+def _decode_error(text: str) -> ReadError:
+    attributes = json.loads(text)
+    if not all(type(v) is str for v in attributes.values()):
+        raise ValueError(f"Bad error {text}")
+    error = ReadError.__new__(ReadError)
+    error.__dict__.update(attributes)
+    return error
+
+
+# kind -> (type, to text, from text)
+_VALUE_CODECS = [
+    (type(None), lambda v: "", lambda t: None),
+    (str, str, str),
+    (bool, lambda v: "1" if v else "0", lambda t: t == "1"),
+    (int, str, int),
+    (float, repr, float),
+    (Decimal, str, Decimal),
+    (datetime.date, datetime.date.isoformat, datetime.date.fromisoformat),
+    (datetime.datetime, datetime.datetime.isoformat,
+     datetime.datetime.fromisoformat),
+    (ReadError, _encode_error, _decode_error),
+]
+KIND_BY_TYPE = {value_type: kind
+                for kind, (value_type, _, _) in enumerate(_VALUE_CODECS)}
+
+
+def encode_frame(names: Sequence[str], type_names: Sequence[str],
+                 columns_values: Sequence[Collection[Any]],
+                 limit: Optional[int] = None, exact: bool = False) -> bytes:
+    """
+    Encode the first `limit` rows of the columns.
+
+    :param exact: if True, the values of the columns that are not only
+    texts are encoded with their types (see `VALUES`) instead of converted
+    to text. A `TypeError` is raised if a type is not supported.
+
+    >>> values = TypedValues.create(int, [1, None, 3])
+    >>> frame = encode_frame(["A", "B"], ["int", "str"],
+    ...                      [values, ["a", "b", None]])
+    >>> decode_frame(frame)
+    [('A', 'int', [1, None, 3]), ('B', 'str', ['a', 'b', None])]
+    """
+    row_count = min((len(col_values) for col_values in columns_values),
+                    default=0)
+    if limit is not None:
+        row_count = min(row_count, limit)
+    parts = [_HEADER.pack(MAGIC, VERSION, len(columns_values), row_count)]
+    for name, type_name, col_values in zip(names, type_names,
+                                           columns_values):
+        tag, block = _encode_block(col_values, row_count, exact)
+        parts.append(_encode_str(name))
+        parts.append(_encode_str(type_name))
+        parts.append(bytes([tag]))
+        parts.append(_U32.pack(len(block)))
+        parts.append(block)
+    return b"".join(parts)
+
+
+def _encode_str(text: str) -> bytes:
+    data = text.encode("utf-8")
+    return _U32.pack(len(data)) + data
+
+
+def _encode_block(col_values: Collection[Any], row_count: int,
+                  exact: bool) -> Tuple[int, bytes]:
+    if isinstance(col_values, TypedValues) and not col_values.error_count():
+        values, invalid = col_values[:row_count].buffers()
+        return (TAG_BY_TYPECODE[values.typecode],
+                _encode_validity(invalid) + _little_endian(values))
+    if (isinstance(col_values, CategoricalValues)
+            and all(type(c) is str for c in col_values.categories)):
+        codes = col_values.codes[:row_count]
+        categories = _encode_text_payload(col_values.categories)
+        return DICTIONARY, (b"\0" + _U32.pack(len(col_values.categories))
+                            + categories + _little_endian(codes))
+    if exact and not all(v is None or type(v) is str
+                         for v in islice(col_values, row_count)):
+        return VALUES, _encode_values_block(col_values, row_count)
+    return TEXT, _encode_text_block(col_values, row_count)
+
+
+def _encode_values_block(col_values: Iterable[Any], row_count: int) -> bytes:
+    """
+    >>> values = [None, "a", True, 2 ** 70, 0.1, Decimal("1.10"),
+    ...           datetime.date(2020, 1, 2)]
+    >>> _decode_block(VALUES, _encode_values_block(values, 7), 7) == values
+    True
+    """
+    kinds = bytearray()
+    texts = []
+    for value in islice(col_values, row_count):
+        try:
+            kind = KIND_BY_TYPE[type(value)]
+        except KeyError:
+            raise TypeError(f"Can't encode {value!r}") from None
+        kinds.append(kind)
+        texts.append(_VALUE_CODECS[kind][1](value))
+    return b"\0" + bytes(kinds) + _encode_text_payload(texts)
+
+
+def _encode_validity(invalid: Optional[bytearray]) -> bytes:
+    if invalid is None:
+        return b"\0"
+    return b"\1" + bytes(1 if n else 0 for n in invalid)
+
+
+def _encode_text_block(col_values: Iterable[Any], row_count: int) -> bytes:
+    values = list(islice(col_values, row_count))
+    if any(v is None for v in values):
+        validity = b"\1" + bytes(v is None for v in values)
+    else:
+        validity = b"\0"
+    return validity + _encode_text_payload(
+        ["" if v is None else str(v) for v in values])
+
+
+def _encode_text_payload(texts: Sequence[str]) -> bytes:
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = array("I", [0])
+    offset = 0
+    for data in encoded:
+        offset += len(data)
+        offsets.append(offset)
+    return _little_endian(offsets) + b"".join(encoded)
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def decode_frame(frame: bytes) -> List[Tuple[str, str, List[Any]]]:
+    """
+    Decode a frame.
+
+    :return: a list of (name, type name, values)
+    """
+    return [(name, type_name, list(col_values))
+            for name, type_name, col_values in decode_frame_columns(frame)]
+
+
+def decode_frame_columns(frame) -> List[Tuple[str, str, Collection[Any]]]:
+    """
+    Decode a frame. The typed and dictionary blocks are decoded to
+    `TypedValues` and `CategoricalValues`.
+
+    :param frame: the bytes, or a memoryview (e.g. of a mmap)
+    :return: a list of (name, type name, values)
+    """
+    magic, version, column_count, row_count = _HEADER.unpack_from(frame, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unknown frame: {magic}, {version}")
+    pos = _HEADER.size
+    columns = []
+    for _ in range(column_count):
+        name, pos = _decode_str(frame, pos)
+        type_name, pos = _decode_str(frame, pos)
+        tag = frame[pos]
+        size, = _U32.unpack_from(frame, pos + 1)
+        pos += 1 + _U32.size
+        block = frame[pos:pos + size]
+        pos += size
+        columns.append((name, type_name, _decode_block(tag, block, row_count)))
+    return columns
+
+
+def _decode_str(frame: bytes, pos: int) -> Tuple[str, int]:
+    size, = _U32.unpack_from(frame, pos)
+    pos += _U32.size
+    return str(frame[pos:pos + size], "utf-8"), pos + size
+
+
+def _decode_block(tag: int, block: bytes, row_count: int
+                  ) -> Collection[Any]:
+    if block[0]:
+        validity = block[1:1 + row_count]
+        pos = 1 + row_count
+    else:
+        validity = None
+        pos = 1
+    if tag == TEXT:
+        values, _ = _decode_text_payload(block, pos, row_count)
+    elif tag == DICTIONARY:
+        category_count, = _U32.unpack_from(block, pos)
+        categories, pos = _decode_text_payload(block, pos + _U32.size,
+                                               category_count)
+        codes = _from_little_endian("i", block[pos:pos + 4 * row_count])
+        return CategoricalValues(categories, codes)
+    elif tag == VALUES:
+        kinds = block[pos:pos + row_count]
+        texts, _ = _decode_text_payload(block, pos + row_count, row_count)
+        return [_VALUE_CODECS[kind][2](text)
+                for kind, text in zip(kinds, texts)]
+    else:
+        values = _from_little_endian(TYPECODE_BY_TAG[tag], block[pos:])
+        return TypedValues(TYPE_BY_TAG[tag], values,
+                           None if validity is None else bytearray(validity))
+    if validity is not None:
+        values = [None if n else v for v, n in zip(values, validity)]
+    return values
+
+
+def _decode_text_payload(block: bytes, pos: int, count: int
+                         ) -> Tuple[List[str], int]:
+    offsets = _from_little_endian("I", block[pos:pos + 4 * (count + 1)])
+    pos += 4 * (count + 1)
+    texts = [str(block[pos + start:pos + end], "utf-8")
+             for start, end in zip(offsets, offsets[1:])]
+    return texts, pos + offsets[-1]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
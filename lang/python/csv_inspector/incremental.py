@@ -0,0 +1,326 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Incremental execution of the scripts. The GUI sends the whole script every
+time: the script is split into top-level statements, and the namespace is
+saved after the expensive statements (see `MIN_DURATION`). A snapshot is
+identified by the fingerprint of the prefix of the script (the source of the
+statements) and stores the size and the modification time of the files
+opened by the statements of the prefix (an audit hook records the paths,
+whatever the expression of the path is). On the next execution, the
+namespace is restored from the snapshot of the longest unchanged prefix
+whose files did not change, and only the remaining statements are executed.
+
+A snapshot is taken only if the previous statements of the script wrote
+nothing (the warnings excepted), because the output of the skipped
+statements (e.g. `show()`) is not sent again. The `Data` objects are
+copied, the other values are deep copied, the modules, functions and classes
+are shared. If a value can't be copied, there is no snapshot.
+"""
+import ast
+import copy
+import hashlib
+import os
+import pickle
+import sys
+import time
+import warnings
+from collections import OrderedDict
+from types import ModuleType, FunctionType, BuiltinFunctionType
+from typing import List, Dict, Any, Optional, Tuple, Set
+
+from csv_inspector.data import Data
+from csv_inspector.util import (TOKEN, Column, TypedValues,
+                                CategoricalValues)
+
+MIN_DURATION = 0.5
+MAX_SNAPSHOTS_SIZE = 1024 * 1024 * 1024
+
+SHARED_TYPES = (ModuleType, FunctionType, BuiltinFunctionType, type)
+
+# path -> (size, mtime) or None if the file does not exist
+FileStates = Dict[str, Optional[Tuple[int, int]]]
+
+# the paths of the files opened by the current statement, or None
+_opened_paths: Optional[Set[str]] = None
+_audit_hook_added = False
+
+
+class Statement:
+    """A group of top-level statements that begin on the same line"""
+
+    def __init__(self, source: str, code):
+        self.source = source
+        self.code = code
+
+
+def split_statements(script: str) -> List[Statement]:
+    """
+    Raise a `SyntaxError` if the script is not valid.
+
+    >>> [s.source for s in split_statements(
+    ...     "import os\\n\\n@f\\ndef g():\\n    pass\\n# x\\nx = 1; y = 2\\n")]
+    ['import os', '@f\\ndef g():\\n    pass\\n# x', 'x = 1; y = 2']
+    """
+    tree = ast.parse(script, "<string>")
+    nodes_by_line: Dict[int, List[ast.stmt]] = {}
+    for node in tree.body:
+        first_line = min([node.lineno]
+                         + [d.lineno for d in
+                            getattr(node, "decorator_list", [])])
+        nodes_by_line.setdefault(first_line, []).append(node)
+
+    lines = script.splitlines()
+    first_lines = list(nodes_by_line)
+    statements = []
+    for first_line, next_line in zip(first_lines,
+                                     first_lines[1:] + [len(lines) + 1]):
+        source = "\n".join(lines[first_line - 1:next_line - 1]).rstrip()
+        module = ast.Module(body=nodes_by_line[first_line], type_ignores=[])
+        statements.append(Statement(source, compile(module, "<string>",
+                                                    "exec")))
+    return statements
+
+
+def _audit_hook(event: str, args: Tuple):
+    if event == "open" and _opened_paths is not None:
+        try:
+            path = args[0]
+            if not isinstance(path, int):  # not a file descriptor
+                _opened_paths.add(os.path.abspath(os.fsdecode(path)))
+        except Exception:  # a hook must not fail
+            pass
+
+
+def _add_audit_hook():
+    """A hook can't be removed: it is added once"""
+    global _audit_hook_added
+
+    if not _audit_hook_added:
+        sys.addaudithook(_audit_hook)
+        _audit_hook_added = True
+
+
+def file_states(paths: Set[str]) -> FileStates:
+    states = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            states[path] = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            states[path] = None
+    return states
+
+
+def fingerprints(statements: List[Statement]) -> List[bytes]:
+    """
+    :return: for every statement, the fingerprint of the prefix of the
+    script that ends with this statement
+    """
+    fingerprint = b""
+    prefix_fingerprints = []
+    for statement in statements:
+        statement_hash = hashlib.blake2b(fingerprint)
+        statement_hash.update(statement.source.encode("utf-8"))
+        fingerprint = statement_hash.digest()
+        prefix_fingerprints.append(fingerprint)
+    return prefix_fingerprints
+
+
+def _column_size(column: Column) -> int:
+    if column._load is not None:  # deferred: the values are not read yet
+        return 0
+    col_values = column.col_values
+    if isinstance(col_values, TypedValues):
+        values, invalid = col_values.buffers()
+        return (values.itemsize * len(values)
+                + (0 if invalid is None else len(invalid)))
+    if isinstance(col_values, CategoricalValues):
+        codes = col_values.codes
+        return (codes.itemsize * len(codes)
+                + sum(map(sys.getsizeof, col_values.categories)))
+    return sys.getsizeof(col_values) + sum(map(sys.getsizeof, col_values))
+
+
+def copy_namespace(namespace: Dict[str, Any]
+                   ) -> Optional[Tuple[Dict[str, Any], int]]:
+    """
+    :return: a copy of the namespace and its approximate size in bytes, or
+    None if a value can't be copied.
+    """
+    memo = {}
+    copied_namespace = {}
+    size = 0
+    for name, value in namespace.items():
+        if name == "__builtins__" or isinstance(value, SHARED_TYPES):
+            copied_namespace[name] = value
+            continue
+        try:
+            copied_namespace[name] = copy.deepcopy(value, memo)
+        except (TypeError, copy.Error, pickle.PicklingError, RecursionError):
+            return None
+        size += sys.getsizeof(value)
+    for value in memo.values():
+        if isinstance(value, Data):
+            size += sum(_column_size(column)
+                        for column in value._column_group.columns)
+    return copied_namespace, size
+
+
+class SnapshotCache:
+    """
+    The snapshots of a session, by fingerprint. The least recently used
+    snapshots are removed when the total size is above `max_size`.
+    """
+
+    def __init__(self, max_size: int = MAX_SNAPSHOTS_SIZE):
+        self._max_size = max_size
+        self._size = 0
+        # fingerprint -> (namespace, size, file states)
+        self._snapshot_by_fingerprint = OrderedDict()
+
+    def __contains__(self, fingerprint: bytes) -> bool:
+        return fingerprint in self._snapshot_by_fingerprint
+
+    def __len__(self) -> int:
+        return len(self._snapshot_by_fingerprint)
+
+    def restore(self, fingerprint: bytes
+                ) -> Tuple[Dict[str, Any], FileStates]:
+        """
+        :return: a copy of the namespace of the snapshot, and the states of
+        the files opened by the statements
+        """
+        self._snapshot_by_fingerprint.move_to_end(fingerprint)
+        namespace, _, states = self._snapshot_by_fingerprint[fingerprint]
+        return copy_namespace(namespace)[0], dict(states)
+
+    def is_valid(self, fingerprint: bytes) -> bool:
+        """:return: True if the files opened by the statements are unchanged"""
+        _, _, states = self._snapshot_by_fingerprint[fingerprint]
+        return file_states(set(states)) == states
+
+    def store(self, fingerprint: bytes, namespace: Dict[str, Any],
+              states: Optional[FileStates] = None) -> bool:
+        """:return: True if the snapshot was stored"""
+        copied = copy_namespace(namespace)
+        if copied is None or copied[1] > self._max_size:
+            return False
+        self.discard(fingerprint)
+        self._snapshot_by_fingerprint[fingerprint] = (*copied,
+                                                      dict(states or {}))
+        self._size += copied[1]
+        while self._size > self._max_size:
+            _, (_, size, _) = self._snapshot_by_fingerprint.popitem(
+                last=False)
+            self._size -= size
+        return True
+
+    def discard(self, fingerprint: bytes):
+        snapshot = self._snapshot_by_fingerprint.pop(fingerprint, None)
+        if snapshot is not None:
+            self._size -= snapshot[1]
+
+    def clear(self):
+        self._snapshot_by_fingerprint.clear()
+        self._size = 0
+
+
+class _WatchedOutput:
+    """A stream that remembers if something was written"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.written = False
+        self.watched = True
+
+    def write(self, text: str) -> int:
+        self.written = self.written or (self.watched and bool(text))
+        return self._stream.write(text)
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+def execute_incrementally(script: str, namespace: Dict[str, Any],
+                          snapshots: SnapshotCache,
+                          min_duration: float = MIN_DURATION) -> int:
+    """
+    Execute the script in the namespace. If a snapshot of a prefix of the
+    script exists, the namespace is replaced by the snapshot and the
+    statements of the prefix are skipped.
+
+    :return: the number of skipped statements
+    """
+    global _opened_paths
+
+    _add_audit_hook()
+    statements = split_statements(script)
+    prefix_fingerprints = fingerprints(statements)
+    start = 0
+    states: FileStates = {}
+    for i in reversed(range(len(statements))):
+        fingerprint = prefix_fingerprints[i]
+        if fingerprint in snapshots:
+            if snapshots.is_valid(fingerprint):
+                start = i + 1
+                break
+            snapshots.discard(fingerprint)  # a file changed
+    if start:
+        namespace.clear()
+        restored, states = snapshots.restore(prefix_fingerprints[start - 1])
+        namespace.update(restored)
+    namespace["TOKEN"] = TOKEN
+
+    stdout, stderr = sys.stdout, sys.stderr
+    watched_outputs = [_WatchedOutput(stdout), _WatchedOutput(stderr)]
+    sys.stdout, sys.stderr = watched_outputs
+    showwarning = warnings.showwarning
+
+    def show_warning(*args, **kwargs):  # a warning is not an output
+        watched_outputs[1].watched = False
+        try:
+            showwarning(*args, **kwargs)
+        finally:
+            watched_outputs[1].watched = True
+
+    warnings.showwarning = show_warning
+    try:
+        for statement, fingerprint in zip(statements[start:],
+                                          prefix_fingerprints[start:]):
+            start_time = time.perf_counter()
+            _opened_paths = set()
+            try:
+                exec(statement.code, namespace)
+            finally:
+                opened_paths, _opened_paths = _opened_paths, None
+            states.update(file_states(opened_paths))
+            if (time.perf_counter() - start_time >= min_duration
+                    and not any(output.written for output in watched_outputs)
+                    and fingerprint not in snapshots):
+                snapshots.store(fingerprint, namespace, states)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        warnings.showwarning = showwarning
+    return start
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
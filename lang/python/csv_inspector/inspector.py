@@ -17,22 +17,55 @@
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+from functools import partial
 from itertools import islice
 from pathlib import Path
-from typing import (Union, Optional)
+from typing import (Union, Optional, Iterator, Sequence, Any)
 
 import mcsv
 
+from csv_inspector.column_cache import (cache_path, load_columns,
+                                        store_columns, MAX_CACHE_DIR_SIZE)
 from csv_inspector.data import Data, DataSource
-from csv_inspector.util import to_standard, ColumnGroup, missing_mcsv, Column
+from csv_inspector.instrument import instrumented
+from csv_inspector.mmap_reader import create_reader
+from csv_inspector.parallel import read_in_parallel
+from csv_inspector.util import (to_standard, ColumnGroup, missing_mcsv,
+                                ColumnBuilder, Column)
 
+@instrumented
 def read_csv(csv_path: Union[str, Path],
              mcsv_path: Optional[Union[str, Path]] = None,
-             nrows=100) -> Optional[Data]:
+             nrows=100, chunk_size=10000, workers=1,
+             cache: Union[bool, str, Path] = False,
+             backend: str = "csv") -> Optional[Data]:
+    """
+    Read a CSV file and its MetaCSV file. The text columns with few distinct
+    values are dictionary encoded (see `CategoricalValues`).
+
+    :param csv_path: the path to the CSV file
+    :param mcsv_path: the path to the MetaCSV file (default: same path as
+    `csv_path`, with the suffix ".mcsv")
+    :param nrows: the max number of rows, or -1 for the whole file
+    :param chunk_size: the rows are read by batches of `chunk_size` rows
+    :param workers: if `nrows` is -1, the number of processes that parse
+    the file
+    :param cache: if `nrows` is -1, True to store the parsed columns next to
+    the MetaCSV file, or the path of a cache directory (see
+    `csv_inspector.column_cache`). The next reads load the cached columns.
+    :param backend: "csv" or "mmap": the file is memory mapped and a column
+    is parsed on the first access to its values (see
+    `csv_inspector.mmap_reader`). If the dialect is not supported by the
+    "mmap" backend, the "csv" backend is used. The "mmap" backend reads the
+    cache but does not write it.
+    :return: the data or None if the MetaCSV file is missing
+    """
     if isinstance(csv_path, str):
         csv_path = Path(csv_path)
     if mcsv_path is None:
         mcsv_path = csv_path.with_suffix(".mcsv")
+    elif isinstance(mcsv_path, str):
+        mcsv_path = Path(mcsv_path)
 
     if not mcsv_path.is_file():
         missing_mcsv(csv_path)  # util command to open a window
@@ -43,12 +76,69 @@ def read_csv(csv_path: Union[str, Path],
             reader = islice(mcsv_reader, nrows)
         else:
             reader = mcsv_reader
+        data_source = DataSource.create(to_standard(csv_path.stem), csv_path,
+                                        mcsv_reader.meta_csv_data)
+        if cache and nrows < 0:
+            cache_dir = None if cache is True else Path(cache)
+            path = cache_path(csv_path, mcsv_path, cache_dir)
+            columns = load_columns(path, csv_path, mcsv_path,
+                                   mcsv_reader.descriptions)
+            if columns is not None:
+                return Data(ColumnGroup(columns), data_source)
+
+        if backend == "mmap":
+            mmap_reader = create_reader(csv_path, mcsv_reader.meta_csv_data)
+            if mmap_reader is not None:
+                return Data(_deferred_column_group(
+                    mmap_reader, mcsv_reader.descriptions, nrows),
+                    data_source)
+        elif backend != "csv":
+            raise ValueError(f"Unknown backend {backend}")
+
         header = [to_standard(n) for n in next(reader)]
-        column_group = ColumnGroup([Column(name, description, values)
-                                    for name, description, *values in
-                                    zip(header, mcsv_reader.descriptions,
-                                        *reader)])
-
-        return Data(column_group, DataSource.create(to_standard(csv_path.stem),
-                                                    csv_path,
-                                                    mcsv_reader.meta_csv_data))
+        builders = [ColumnBuilder(name, description)
+                    for name, description in
+                    zip(header, mcsv_reader.descriptions)]
+        width = None
+        if workers > 1 and nrows < 0:
+            width = read_in_parallel(csv_path, mcsv_reader.meta_csv_data,
+                                     mcsv_reader.descriptions, builders,
+                                     workers)
+        if width is None:
+            width = _read_by_chunks(reader, builders, chunk_size)
+
+        column_group = ColumnGroup([builder.build()
+                                    for builder in builders[:width]])
+        if cache and nrows < 0:
+            store_columns(path, csv_path, mcsv_path, column_group.columns,
+                          None if cache_dir is None else MAX_CACHE_DIR_SIZE)
+
+        return Data(column_group, data_source)
+
+
+def _deferred_column_group(mmap_reader, descriptions, nrows: int
+                           ) -> ColumnGroup:
+    row_count = None if nrows < 0 else max(nrows - 1, 0)  # with the header
+    return ColumnGroup([
+        Column.deferred(to_standard(name), description,
+                        partial(mmap_reader.column_values, i, description,
+                                row_count))
+        for i, (name, description) in enumerate(zip(mmap_reader.header(),
+                                                    descriptions))])
+
+
+def _read_by_chunks(reader: Iterator[Sequence[Any]],
+                    builders: Sequence[ColumnBuilder], chunk_size: int) -> int:
+    """
+    :return: the number of complete columns
+    """
+    width = len(builders)
+    while True:
+        rows = list(islice(reader, chunk_size))
+        if not rows:
+            break
+        columns_values = list(zip(*rows))
+        width = min(width, len(columns_values))
+        for builder, values in zip(builders, columns_values):
+            builder.extend(values)
+    return width
@@ -0,0 +1,212 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Profiling of the operations. When the profiling is enabled (see
+`enable_profiling`), every operation of a `Data`, a `DataHandle` or a
+`DataGrouper` records the wall time, the CPU time of the server process, the
+number of rows before and after the operation and, if the memory is traced,
+the peak of the allocated memory. The records of a data object are returned
+by `data.profile()`.
+
+When the profiling is disabled, an operation costs one more function call.
+"""
+import functools
+import time
+import tracemalloc
+import weakref
+from collections import deque
+from typing import Optional, List, Dict, Deque
+
+from csv_inspector.protocol import begin_info, end_info
+
+MAX_RECORDS = 1000
+
+_enabled = False
+_trace_memory = False
+_depth = 0  # the operations called by an operation are not recorded
+# id of the column group -> records
+_records_by_id: Dict[int, Deque["OperationRecord"]] = {}
+
+
+class OperationRecord:
+    def __init__(self, name: str, wall_time: float, cpu_time: float,
+                 rows_in: Optional[int], rows_out: Optional[int],
+                 peak_memory: Optional[int]):
+        self.name = name
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.peak_memory = peak_memory
+
+    def __repr__(self):
+        return (f"OperationRecord({self.name}, {self.wall_time:.6f}, "
+                f"{self.cpu_time:.6f}, {self.rows_in}, {self.rows_out}, "
+                f"{self.peak_memory})")
+
+
+def enable_profiling(trace_memory: bool = False):
+    """
+    Record the next operations.
+
+    :param trace_memory: if True, record the peak of the allocated memory
+    (with `tracemalloc`: the operations are slower)
+    """
+    global _enabled, _trace_memory
+
+    _enabled = True
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_profiling():
+    global _enabled, _trace_memory
+
+    _enabled = False
+    if _trace_memory:
+        tracemalloc.stop()
+        _trace_memory = False
+
+
+def _column_group_of(obj):
+    column_group = getattr(obj, "_data_column_group", None)
+    if column_group is None:
+        column_group = getattr(obj, "_column_group", None)
+    return column_group
+
+
+def _row_count(column_group) -> Optional[int]:
+    """
+    The deferred columns are not loaded: the row count is unknown (None) if
+    no column is loaded.
+    """
+    if column_group is None:
+        return None
+    for column in column_group.columns:
+        if column._load is None:
+            return len(column.col_values)
+    return None if column_group.columns else 0
+
+
+def _reset_peak():
+    if getattr(tracemalloc, "reset_peak", None) is not None:  # since 3.9
+        tracemalloc.reset_peak()
+    else:  # the traces are lost, but not the traced memory of the operation
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+def records(column_group) -> List[OperationRecord]:
+    """:return: the records of the operations on the column group"""
+    return list(_records_by_id.get(id(column_group), ()))
+
+
+def _add_record(column_group, record: OperationRecord):
+    column_group_id = id(column_group)
+    group_records = _records_by_id.get(column_group_id)
+    if group_records is None:
+        group_records = deque(maxlen=MAX_RECORDS)
+        _records_by_id[column_group_id] = group_records
+        weakref.finalize(column_group, _records_by_id.pop, column_group_id,
+                         None)
+    group_records.append(record)
+
+
+def instrumented(func):
+    """
+    Record the calls of an operation. The record is added to the column
+    group of the object (a method), or of the returned data (a function).
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _depth
+
+        if not _enabled or _depth:
+            return func(*args, **kwargs)
+
+        column_group = _column_group_of(args[0]) if args else None
+        rows_in = _row_count(column_group)
+        if _trace_memory:
+            _reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        _depth += 1
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            _depth -= 1
+        cpu_time = time.process_time() - cpu_start
+        wall_time = time.perf_counter() - wall_start
+        if _trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_start
+        else:
+            peak_memory = None
+
+        ret_column_group = _column_group_of(ret)
+        if column_group is None:
+            column_group = ret_column_group
+        if column_group is not None:
+            rows_out = _row_count(ret_column_group or column_group)
+            _add_record(column_group, OperationRecord(
+                func.__qualname__, wall_time, cpu_time, rows_in, rows_out,
+                peak_memory))
+        return ret
+
+    return wrapper
+
+
+def format_records(operation_records: List[OperationRecord]) -> str:
+    """
+    >>> print(format_records([OperationRecord("read_csv", 1.5, 1.25, None,
+    ...                                       100, None)]))
+    operation  wall (ms)  cpu (ms)  rows in  rows out  peak memory (KiB)
+    read_csv      1500.0    1250.0                100
+    """
+    rows = [("operation", "wall (ms)", "cpu (ms)", "rows in", "rows out",
+             "peak memory (KiB)")]
+    for record in operation_records:
+        rows.append((
+            record.name, f"{record.wall_time * 1000:.1f}",
+            f"{record.cpu_time * 1000:.1f}",
+            "" if record.rows_in is None else str(record.rows_in),
+            "" if record.rows_out is None else str(record.rows_out),
+            "" if record.peak_memory is None
+            else f"{record.peak_memory / 1024:.1f}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join([row[0].ljust(widths[0])]
+                  + [value.rjust(width)
+                     for value, width in zip(row[1:], widths[1:])]
+                  ).rstrip()
+        for row in rows)
+
+
+def show_records(operation_records: List[OperationRecord]):
+    """Write the records in an info block"""
+    begin_info()
+    print(format_records(operation_records))
+    end_info()
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,345 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Join algorithms. A join returns the list of (row, other_row) pairs, in the
+order of the historical nested loop: left rows in order, and for each left
+row, the matching right rows in order. A missing side is `None`.
+"""
+import heapq
+import operator
+from bisect import bisect_left, insort
+from typing import (Callable, Any, Sequence, List, Tuple, Optional, Iterable,
+                    Dict, Collection)
+
+from csv_inspector.cancel import check, checked
+
+Row = Tuple[Any, ...]
+Pair = Tuple[Optional[Row], Optional[Row]]
+KeyFunc = Callable[[Row], Tuple[Any, ...]]
+
+COMPARISON_FUNC_BY_ON = {
+    "==": operator.eq, "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+    "between": lambda key, other_key: other_key[0] <= key[0] <= other_key[1]
+}
+
+
+def key_func(indices: Iterable[int]) -> KeyFunc:
+    """
+    >>> key_func({2, 0})((1, 2, 3))
+    (1, 3)
+    """
+    indices = list(indices)
+
+    def key(row):
+        return tuple([row[i] for i in indices])
+
+    return key
+
+
+def nested_loop_join(rows: Sequence[Row], other_rows: Sequence[Row],
+                     key: KeyFunc, other_key: KeyFunc, func,
+                     keep_left: bool = False,
+                     keep_right: bool = False) -> List[Pair]:
+    """
+    The generic join: `func(key, other_key)` is called for every pair.
+
+    >>> rows = [(1, "a"), (2, "b")]
+    >>> other_rows = [(2, "x"), (3, "y")]
+    >>> k = key_func([0])
+    >>> nested_loop_join(rows, other_rows, k, k, lambda x, y: x == y, True, True)
+    [((1, 'a'), None), ((2, 'b'), (2, 'x')), (None, (3, 'y'))]
+    """
+    other_keys = [other_key(other_row) for other_row in other_rows]
+    other_found = bytearray(len(other_rows))
+    pairs = []
+    for row in rows:
+        check()  # a row is compared to all the other rows
+        k = key(row)
+        found = False
+        for j, other_k in enumerate(other_keys):
+            if func(k, other_k):
+                found = True
+                other_found[j] = 1
+                pairs.append((row, other_rows[j]))
+        if keep_left and not found:
+            pairs.append((row, None))
+    if keep_right:
+        pairs.extend(_not_found(other_rows, other_found))
+    return pairs
+
+
+def hash_join(rows: Sequence[Row], other_rows: Sequence[Row],
+              key: KeyFunc, other_key: KeyFunc,
+              keep_left: bool = False, keep_right: bool = False) -> List[Pair]:
+    """
+    An equi-join. The hash table is built on the smaller side, and the
+    other side is probed in one pass. The result is the same as
+    `nested_loop_join` with `func=lambda x, y: x == y`.
+
+    Raises a `TypeError` if a key is not hashable.
+
+    >>> rows = [(1, "a"), (2, "b"), (2, "c")]
+    >>> other_rows = [(2, "x"), (3, "y"), (2, "z")]
+    >>> k = key_func([0])
+    >>> hash_join(rows, other_rows, k, k, True, True)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [((1, 'a'), None), ((2, 'b'), (2, 'x')), ((2, 'b'), (2, 'z')),
+     ((2, 'c'), (2, 'x')), ((2, 'c'), (2, 'z')), (None, (3, 'y'))]
+    >>> hash_join(other_rows, rows, k, k, True, True)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [((2, 'x'), (2, 'b')), ((2, 'x'), (2, 'c')), ((3, 'y'), None),
+     ((2, 'z'), (2, 'b')), ((2, 'z'), (2, 'c')), (None, (1, 'a'))]
+    """
+    if len(other_rows) <= len(rows):
+        return _probe_left(rows, other_rows, key, other_key, keep_left,
+                           keep_right)
+    else:
+        return _probe_right(rows, other_rows, key, other_key, keep_left,
+                            keep_right)
+
+
+def _probe_left(rows, other_rows, key, other_key, keep_left, keep_right):
+    """Build on the right side, probe with the left rows"""
+    other_indices_by_key: Dict[Tuple, List[int]] = {}
+    for j, other_row in enumerate(other_rows):
+        other_indices_by_key.setdefault(other_key(other_row), []).append(j)
+
+    other_found = bytearray(len(other_rows))
+    pairs = []
+    for row in checked(rows):
+        other_indices = other_indices_by_key.get(key(row))
+        if other_indices is None:
+            if keep_left:
+                pairs.append((row, None))
+        else:
+            for j in other_indices:
+                pairs.append((row, other_rows[j]))
+                other_found[j] = 1
+    if keep_right:
+        pairs.extend(_not_found(other_rows, other_found))
+    return pairs
+
+
+def _probe_right(rows, other_rows, key, other_key, keep_left, keep_right):
+    """Build on the left side, probe with the right rows"""
+    indices_by_key: Dict[Tuple, List[int]] = {}
+    for i, row in enumerate(rows):
+        indices_by_key.setdefault(key(row), []).append(i)
+
+    other_rows_by_index: Dict[int, List[Row]] = {}
+    other_not_found = []
+    for other_row in checked(other_rows):
+        indices = indices_by_key.get(other_key(other_row))
+        if indices is None:
+            if keep_right:
+                other_not_found.append((None, other_row))
+        else:
+            for i in indices:
+                other_rows_by_index.setdefault(i, []).append(other_row)
+
+    pairs = []
+    for i, row in enumerate(rows):
+        matching_rows = other_rows_by_index.get(i)
+        if matching_rows is None:
+            if keep_left:
+                pairs.append((row, None))
+        else:
+            pairs.extend((row, other_row) for other_row in matching_rows)
+    pairs.extend(other_not_found)
+    return pairs
+
+
+def band_join(rows: Sequence[Row], other_rows: Sequence[Row],
+              key: KeyFunc, other_key: KeyFunc, on: str,
+              keep_left: bool = False, keep_right: bool = False,
+              right_major: bool = False) -> List[Pair]:
+    """
+    A join on a comparison: `on` is one of "<", "<=", ">", ">=" (the
+    predicate is `key <on> other_key`) or "between" (the predicate is
+    `other_key[0] <= key[0] <= other_key[1]`). The result is the same as
+    `nested_loop_join` with `func=COMPARISON_FUNC_BY_ON[on]`.
+
+    Both sides are sorted and swept once: the right rows become active when
+    their lower bound is reached and inactive after their upper bound.
+    Hence the cost is O(n log n + m log m + output). A NaN is not ordered:
+    the rows with a NaN in the key are not swept, but compared to every
+    row of the other side.
+
+    If `right_major` is True, pairs are ordered by right row, then left row
+    (this is the order of a right join).
+
+    >>> rows = [(3, "a"), (1, "b"), (2, "c")]
+    >>> other_rows = [(2, "x"), (1, "y"), (4, "z")]
+    >>> k = key_func([0])
+    >>> band_join(rows, other_rows, k, k, "<", True, True)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [((3, 'a'), (4, 'z')), ((1, 'b'), (2, 'x')), ((1, 'b'), (4, 'z')),
+     ((2, 'c'), (4, 'z')), (None, (1, 'y'))]
+    >>> intervals = [(1, 2, "x"), (2, 5, "y")]
+    >>> band_join(rows, intervals, k, key_func([0, 1]), "between")
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [((3, 'a'), (2, 5, 'y')), ((1, 'b'), (1, 2, 'x')), ((2, 'c'), (1, 2, 'x')),
+     ((2, 'c'), (2, 5, 'y'))]
+    """
+    if on not in COMPARISON_FUNC_BY_ON or on == "==":
+        raise ValueError(f"Unknown comparison {on}")
+    keys = [key(row) for row in rows]
+    other_keys = [other_key(other_row) for other_row in other_rows]
+    indices = [i for i, k in enumerate(keys) if not _has_nan(k)]
+    other_indices = [j for j, k in enumerate(other_keys) if not _has_nan(k)]
+    if len(indices) == len(keys) and len(other_indices) == len(other_keys):
+        other_indices_by_index = _sweep_keys(keys, other_keys, on)
+    else:
+        other_indices_by_index = [[] for _ in rows]
+        swept = _sweep_keys([keys[i] for i in indices],
+                            [other_keys[j] for j in other_indices], on)
+        for i, swept_indices in zip(indices, swept):
+            other_indices_by_index[i] = [other_indices[j]
+                                         for j in swept_indices]
+        _compare_nans(keys, other_keys, set(indices), set(other_indices),
+                      COMPARISON_FUNC_BY_ON[on], other_indices_by_index)
+
+    if right_major:
+        indices_by_other_index = [[] for _ in other_rows]
+        for i, other_indices in enumerate(other_indices_by_index):
+            for j in other_indices:
+                indices_by_other_index[j].append(i)
+        pairs = []
+        for j, indices in enumerate(indices_by_other_index):
+            if indices:
+                pairs.extend((rows[i], other_rows[j]) for i in indices)
+            elif keep_right:
+                pairs.append((None, other_rows[j]))
+        if keep_left:
+            pairs.extend((row, None) for row, other_indices
+                         in zip(rows, other_indices_by_index)
+                         if not other_indices)
+        return pairs
+
+    other_found = bytearray(len(other_rows))
+    pairs = []
+    for row, other_indices in zip(rows, other_indices_by_index):
+        if other_indices:
+            for j in other_indices:
+                pairs.append((row, other_rows[j]))
+                other_found[j] = 1
+        elif keep_left:
+            pairs.append((row, None))
+    if keep_right:
+        pairs.extend(_not_found(other_rows, other_found))
+    return pairs
+
+
+def _has_nan(key: Tuple[Any, ...]) -> bool:
+    """
+    >>> _has_nan((1, float("nan"))), _has_nan((1, 2.0))
+    (True, False)
+    """
+    return any(v != v for v in key)
+
+
+def _sweep_keys(keys: Sequence[Tuple[Any, ...]],
+                other_keys: Sequence[Tuple[Any, ...]], on: str
+                ) -> List[List[int]]:
+    if on == "between":
+        keys = [k[0] for k in keys]
+        lowers, lower_strict = [k[0] for k in other_keys], False
+        uppers, upper_strict = [k[1] for k in other_keys], False
+    elif on in ("<", "<="):  # key < other_key
+        lowers, lower_strict = None, False
+        uppers, upper_strict = other_keys, on == "<"
+    else:  # other_key < key
+        lowers, lower_strict = other_keys, on == ">"
+        uppers, upper_strict = None, False
+    return _sweep(keys, len(other_keys), lowers, lower_strict, uppers,
+                  upper_strict)
+
+
+def _compare_nans(keys: Sequence[Tuple[Any, ...]],
+                  other_keys: Sequence[Tuple[Any, ...]],
+                  ordered_indices: Collection[int],
+                  ordered_other_indices: Collection[int], func,
+                  other_indices_by_index: List[List[int]]):
+    """
+    Add the matching pairs that have a NaN in a key: `func` is called for
+    every such pair.
+    """
+    nan_other_indices = [j for j in range(len(other_keys))
+                         if j not in ordered_other_indices]
+    for i in checked(range(len(keys))):
+        if i in ordered_indices:
+            candidates = nan_other_indices
+        else:
+            candidates = range(len(other_keys))
+        found = [j for j in candidates if func(keys[i], other_keys[j])]
+        if found:
+            other_indices_by_index[i] = sorted(other_indices_by_index[i]
+                                               + found)
+
+
+def _sweep(keys: Sequence[Any], other_count: int,
+           lowers: Optional[Sequence[Any]], lower_strict: bool,
+           uppers: Optional[Sequence[Any]], upper_strict: bool
+           ) -> List[List[int]]:
+    """
+    For every key k, return the sorted list of indices j such that
+    `lowers[j] <= k <= uppers[j]` (`<` if strict; `None` means unbounded).
+    """
+    if lowers is None:
+        to_activate = []
+        active = list(range(other_count))
+    else:
+        to_activate = sorted(range(other_count), key=lowers.__getitem__,
+                             reverse=True)
+        active = []
+    if uppers is None:
+        to_deactivate = []
+    else:
+        to_deactivate = [(uppers[j], j) for j in active]
+        heapq.heapify(to_deactivate)
+
+    other_indices_by_index: List[List[int]] = [[] for _ in keys]
+    for i in checked(sorted(range(len(keys)), key=keys.__getitem__)):
+        k = keys[i]
+        while to_activate and (lowers[to_activate[-1]] < k
+                               or not lower_strict
+                               and lowers[to_activate[-1]] == k):
+            j = to_activate.pop()
+            insort(active, j)
+            if uppers is not None:
+                heapq.heappush(to_deactivate, (uppers[j], j))
+        while to_deactivate and (to_deactivate[0][0] < k
+                                 or upper_strict
+                                 and to_deactivate[0][0] == k):
+            _, j = heapq.heappop(to_deactivate)
+            del active[bisect_left(active, j)]
+        other_indices_by_index[i] = list(active)
+    return other_indices_by_index
+
+
+def _not_found(other_rows, other_found) -> List[Pair]:
+    return [(None, other_row)
+            for other_row, found in zip(other_rows, other_found)
+            if not found]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
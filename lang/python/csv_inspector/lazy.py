@@ -0,0 +1,287 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A lazy version of the `DataHandle` operations. The operations are recorded
+in a plan and executed on `collect()`: consecutive row operations (filter,
+create, update) are fused in one pass over the rows, and the columns that
+are not used are never read.
+"""
+from typing import List, Any, Optional, Sequence, Dict
+
+from csv_inspector.cancel import checked
+from csv_inspector.util import (to_indices, Column, ColumnGroup,
+                                get_return_type)
+
+FILTER = 0
+COMPUTE = 1
+SORT = 2
+
+
+class _ColumnRef:
+    """
+    A column of the plan: either a column of the data or a computed column.
+    """
+
+    def __init__(self, name: str, column: Optional[Column] = None,
+                 col_type=None):
+        self.name = name
+        self.column = column
+        self.col_type = col_type
+
+
+class _Step:
+    def __init__(self, kind: int, func, input_refs: Sequence[_ColumnRef],
+                 output_ref: Optional[_ColumnRef] = None,
+                 reverse: bool = False):
+        self.kind = kind
+        self.func = func
+        self.input_refs = input_refs
+        self.output_ref = output_ref
+        self.reverse = reverse
+
+
+class LazyData:
+    """
+    Syntax: `lazy_data = data.lazy()`
+
+    >>> test_data = original_test_data.copy()
+    >>> lazy_data = test_data.lazy()
+    >>> lazy_data[0, 1].create(lambda x, y: x + y, "E")
+    >>> lazy_data[4].filter(lambda x: x > 5)
+    >>> lazy_data[2].update(lambda x: x * 10)
+    >>> lazy_data[1, 3].drop()
+    >>> lazy_data.collect() is test_data
+    True
+    >>> print(test_data)
+     A  C E
+     5 20 7
+     3 70 7
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._schema = [_ColumnRef(col.name, col)
+                        for col in data._column_group]
+        self._steps = []
+
+    def __getitem__(self, item) -> "LazyDataHandle":
+        return LazyDataHandle(self, to_indices(len(self._schema), item))
+
+    def collect(self):
+        """
+        Execute the plan and return the data. If the execution fails (e.g.
+        a function raises or the script is cancelled), the data and the plan
+        are unchanged.
+        """
+        needed_refs = set(self._schema)
+        steps = []
+        for step in reversed(self._steps):
+            if step.kind == COMPUTE and step.output_ref not in needed_refs:
+                continue  # pruned
+            needed_refs.update(step.input_refs)
+            steps.append(step)
+        steps.reverse()
+
+        if steps:
+            values_by_ref = self._execute(steps, needed_refs)
+        else:
+            values_by_ref = {}
+        self._steps = []
+        for ref, values in values_by_ref.items():
+            if ref.column is None:
+                ref.column = Column(ref.name, ref.col_type, values)
+            else:
+                ref.column.col_values = values
+        for ref in self._schema:
+            ref.column.name = ref.name
+        self._data._column_group.replace_columns(
+            [ref.column for ref in self._schema])
+        self._schema = [_ColumnRef(col.name, col)
+                        for col in self._data._column_group]
+        return self._data
+
+    def _execute(self, steps: List[_Step], needed_refs
+                 ) -> Dict[_ColumnRef, List[Any]]:
+        """
+        :return: the new values of the columns of the schema. The columns
+        are not modified.
+        """
+        source_refs = [ref for ref in needed_refs if ref.column is not None]
+        computed_refs = [ref for ref in needed_refs if ref.column is None]
+        slot_by_ref = {ref: i
+                       for i, ref in enumerate(source_refs + computed_refs)}
+        padding = [None] * len(computed_refs)
+
+        if source_refs:
+            rows = [[*row, *padding]
+                    for row in zip(*[ref.column for ref in source_refs])]
+        else:
+            rows = [list(padding) for _ in self._data._column_group.rows()]
+        rows_changed = False
+        segment = []
+        for step in steps:
+            if step.kind == SORT:
+                rows = _execute_segment(rows, segment, slot_by_ref)
+                _sort_rows(rows, step, slot_by_ref)
+                rows_changed = True
+                segment = []
+            else:
+                rows_changed = rows_changed or step.kind == FILTER
+                segment.append(step)
+        rows = _execute_segment(rows, segment, slot_by_ref)
+
+        return {ref: [row[slot_by_ref[ref]] for row in rows]
+                for ref in self._schema
+                if ref.column is None or rows_changed}
+
+    def show(self, limit: int = 100) -> int:
+        """
+        Execute the plan and show the data.
+        """
+        return self.collect().show(limit)
+
+    def stats(self, quantiles: str = "exact", workers: int = 1):
+        """
+        Execute the plan and show stats on the data.
+        """
+        self.collect().stats(quantiles, workers)
+
+
+def _execute_segment(rows, steps: List[_Step], slot_by_ref):
+    """
+    Execute some fused row operations in a single pass.
+    """
+    if not steps:
+        return rows
+    compiled_steps = [
+        (step.kind, step.func,
+         [slot_by_ref[ref] for ref in step.input_refs],
+         None if step.output_ref is None else slot_by_ref[step.output_ref])
+        for step in steps]
+    new_rows = []
+    for row in checked(rows):
+        for kind, func, input_slots, output_slot in compiled_steps:
+            vs = [row[s] for s in input_slots]
+            if kind == FILTER:
+                if not func(*vs):
+                    break
+            else:
+                row[output_slot] = func(*vs)
+        else:
+            new_rows.append(row)
+    return new_rows
+
+
+def _sort_rows(rows, step: _Step, slot_by_ref):
+    input_slots = [slot_by_ref[ref] for ref in step.input_refs]
+    if step.func is None:
+        def key_func(row):
+            return tuple([row[s] for s in input_slots])
+    else:
+        def key_func(row):
+            return step.func(*[row[s] for s in input_slots])
+
+    rows.sort(key=key_func, reverse=step.reverse)
+
+
+class LazyDataHandle:
+    """
+    The lazy version of `DataHandle`: see the documentation of `DataHandle`.
+    """
+
+    def __init__(self, lazy_data: LazyData, indices: List[int]):
+        self._lazy_data = lazy_data
+        self._indices = indices
+
+    def _refs(self) -> List[_ColumnRef]:
+        """The refs, in the order of the `DataHandle.filter` values"""
+        schema = self._lazy_data._schema
+        return [schema[i] for i in set(self._indices)]
+
+    def _sorted_refs(self) -> List[_ColumnRef]:
+        """The refs, in the order of the `DataHandle.create` values"""
+        schema = self._lazy_data._schema
+        return [schema[i] for i in sorted(set(self._indices))]
+
+    def _add_step(self, step: _Step):
+        self._lazy_data._steps.append(step)
+
+    def filter(self, func):
+        self._add_step(_Step(FILTER, func, self._refs()))
+
+    def create(self, func, col_name, col_type=None, index=None):
+        if col_type is None:
+            col_type = get_return_type(func, Any)
+        ref = _ColumnRef(col_name, col_type=col_type)
+        self._add_step(_Step(COMPUTE, func, self._sorted_refs(), ref))
+        schema = self._lazy_data._schema
+        if index is None:
+            schema.append(ref)
+        else:
+            schema.insert(index, ref)
+
+    def update(self, func, col_name=None, col_type=None):
+        assert len(self._indices) == 1
+        index = self._indices[0]
+        schema = self._lazy_data._schema
+        old_ref = schema[index]
+        if col_type is None:
+            if old_ref.column is None:
+                col_type = get_return_type(func, old_ref.col_type)
+            else:
+                col_type = get_return_type(func, old_ref.column.col_type)
+        if col_name is None:
+            col_name = old_ref.name
+        ref = _ColumnRef(col_name, col_type=col_type)
+        self._add_step(_Step(COMPUTE, func, [old_ref], ref))
+        schema[index] = ref
+
+    def select(self):
+        schema = self._lazy_data._schema
+        self._lazy_data._schema = [ref for i, ref in enumerate(schema)
+                                   if i in self._indices]
+
+    def drop(self):
+        schema = self._lazy_data._schema
+        self._lazy_data._schema = [ref for i, ref in enumerate(schema)
+                                   if i not in self._indices]
+
+    def rename(self, names):
+        assert len(self._indices) == len(names)
+        schema = self._lazy_data._schema
+        for i, name in zip(self._indices, names):
+            schema[i].name = name
+
+    def sort(self, func=None, reverse=False):
+        self._add_step(_Step(SORT, func, self._refs(), reverse=reverse))
+
+    def rsort(self, func=None):
+        self.sort(func, reverse=True)
+
+
+if __name__ == "__main__":
+    import doctest
+    from csv_inspector.data import Data
+
+    doctest.testmod(
+        extraglobs={'original_test_data': Data(ColumnGroup([
+            Column("A", int, [1, 5, 3]),
+            Column("B", int, [3, 2, 4]),
+            Column("C", int, [2, 2, 7]),
+            Column("D", int, [4, 7, 8])
+        ]), None)})
@@ -0,0 +1,314 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A CSV reader that works on the bytes of a memory mapped file. The fields
+are found by a regular expression built from the dialect; only the fields
+of a given column are decoded and converted, hence the other columns never
+become Python objects.
+
+A column is read in one pass over the file, when its values are needed
+(see `Column.deferred`): the dropped columns are never read.
+
+If a record is not matched by the expression (e.g. a quote is not closed),
+the column is read by the `csv` module: the regular expression would
+resynchronize in the middle of a record.
+"""
+import codecs
+import csv
+import io
+import mmap
+import re
+from itertools import islice
+from pathlib import Path
+from typing import (Optional, Mapping, Any, List, Collection, Iterator,
+                    Pattern)
+
+from mcsv.field_description import FieldDescription
+from mcsv.meta_csv_data import MetaCSVData
+
+from csv_inspector.parallel import dialect_params
+from csv_inspector.util import ColumnBuilder
+
+CHUNK_SIZE = 64 * 1024
+UTF_8_NAMES = {"utf-8", "utf_8", "utf8", "u8", "utf-8-sig", "utf_8_sig"}
+
+
+class MalformedRecordError(ValueError):
+    """A record is not matched by the pattern of the reader"""
+
+
+def _to_byte(char: Optional[str], encoding: str) -> Optional[bytes]:
+    """:return: the byte of the char, or None if it's not a single byte"""
+    if char is None:
+        return None
+    try:
+        encoded = char.encode(encoding)
+    except (LookupError, UnicodeError):
+        return None
+    if len(encoded) != 1:
+        return None
+    return encoded
+
+
+class MmapCSVReader:
+    """
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     path = Path(tmpdir, "a.csv")
+    ...     _ = path.write_bytes(b'a,b,c\\r\\n1,"x\\n""y"" z",3\\n\\n4,z')
+    ...     reader = MmapCSVReader.create(path, "utf-8", {"delimiter": ","})
+    ...     reader.header(), reader.texts(1), reader.texts(2)
+    (['a', 'b', 'c'], ['x\\n"y" z', 'z'], ['3', None])
+
+    An unterminated quote: the file is read by the `csv` module.
+
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     path = Path(tmpdir, "a.csv")
+    ...     _ = path.write_bytes(b'a,b,c\\n1,"x,2,3\\n4,5,6')
+    ...     reader = MmapCSVReader.create(path, "utf-8", {"delimiter": ","})
+    ...     reader.texts(0), reader.texts(1), reader.texts(2)
+    (['1'], ['x,2,3\\n4,5,6'], [None])
+    """
+
+    @staticmethod
+    def create(path: Path, encoding: str, params: Mapping[str, Any],
+               null_value: str = "", bom: bool = False
+               ) -> Optional["MmapCSVReader"]:
+        """
+        :return: the reader, or None if the dialect or the encoding can't
+        be handled on the bytes (the fields are searched byte per byte).
+        """
+        if (params.get("skipinitialspace")
+                or params.get("quoting") == csv.QUOTE_NONE
+                or _to_byte("\n", encoding) != b"\n"
+                or _to_byte("\r", encoding) != b"\r"):
+            return None
+        delimiter = _to_byte(params.get("delimiter", ","), encoding)
+        quote = _to_byte(params.get("quotechar", '"'), encoding)
+        if params.get("doublequote", True):
+            escape = None
+        else:
+            escape = _to_byte(params.get("escapechar"), encoding)
+            if escape is None:
+                return None
+        if delimiter is None or quote is None:
+            return None
+        return MmapCSVReader(path, encoding, params, delimiter, quote,
+                             escape, null_value,
+                             bom or encoding.lower() in UTF_8_NAMES)
+
+    def __init__(self, path: Path, encoding: str, params: Mapping[str, Any],
+                 delimiter: bytes, quote: bytes, escape: Optional[bytes],
+                 null_value: str, skip_bom: bool):
+        self._path = path
+        self._encoding = encoding
+        self._params = params
+        self._null_value = null_value
+        self._skip_bom = skip_bom
+        self._quote = quote
+        self._escape = escape
+
+        d, q = re.escape(delimiter), re.escape(quote)
+        if escape is None:
+            quoted = q + b"(?:[^" + q + b"]|" + q + q + b")*" + q
+            after_quoted = b"[^" + d + q + b"\r\n]*"
+            unquoted = b"[^" + d + q + b"\r\n][^" + d + b"\r\n]*"
+            self._unescape = None
+        else:
+            e = re.escape(escape)
+            quoted = q + b"(?:[^" + q + e + b"]|" + e + b".)*" + q
+            after_quoted = b"(?:[^" + d + q + e + b"\r\n]|" + e + b".)*"
+            unquoted = (b"(?:[^" + d + q + e + b"\r\n]|" + e + b".)"
+                        b"(?:[^" + d + e + b"\r\n]|" + e + b".)*")
+            self._unescape = re.compile(e + b"(.)", re.DOTALL)
+        field = b"(?:" + quoted + after_quoted + b"|" + unquoted + b"|)"
+        self._field = field
+        self._delimiter = d
+        self._end = b"(?:\r\n?|\n|\\Z)"
+
+    def _record_pattern(self, index: int) -> Pattern:
+        """
+        :return: a pattern that matches a record and captures the field
+        `index`, if any.
+        """
+        f, d = self._field, self._delimiter
+        if index == 0:
+            pattern = b"(" + f + b")"
+        else:
+            pattern = (b"(?:(?:" + f + d + b"){" + str(index).encode()
+                       + b"}(" + f + b")|" + f + b"(?:" + d + f + b"){0,"
+                       + str(index - 1).encode() + b"})")
+        pattern += b"(?:" + d + f + b")*" + self._end
+        return re.compile(pattern, re.DOTALL)
+
+    def _open(self):
+        f = open(self._path, "rb")
+        try:
+            if not f.seek(0, io.SEEK_END):
+                return f, b""
+            return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            f.close()
+            raise
+
+    def _data_start(self, buffer) -> int:
+        if self._skip_bom and buffer[:3] == codecs.BOM_UTF8:
+            return 3
+        return 0
+
+    def _header_end(self, buffer, start: int) -> int:
+        match = self._record_pattern(0).match(buffer, start)
+        if match is None:
+            raise MalformedRecordError("Malformed header")
+        return match.end()
+
+    def header(self) -> List[str]:
+        f, buffer = self._open()
+        try:
+            start = self._data_start(buffer)
+            end = self._header_end(buffer, start)
+            text = buffer[start:end].decode(self._encoding)
+        except MalformedRecordError:
+            return next(self._csv_rows(), [])
+        finally:
+            f.close()
+            if buffer:
+                buffer.close()
+        return next(csv.reader(io.StringIO(text, newline=""),
+                               **self._params), [])
+
+    def _fields(self, index: int, nrows: Optional[int] = None
+                ) -> Iterator[Optional[bytes]]:
+        """
+        Yield the raw bytes of the field `index` of the records (the header
+        is skipped), or None if the record is too short.
+
+        :raise MalformedRecordError: if a record is not matched: `finditer`
+        skips the unmatched bytes.
+        """
+        f, buffer = self._open()
+        matches = None
+        try:
+            size = len(buffer)
+            start = self._data_start(buffer)
+            record_end = self._header_end(buffer, start)
+            matches = self._record_pattern(index).finditer(buffer, record_end)
+            for match in islice(matches, nrows):
+                record_start = match.start()
+                if record_start != record_end:
+                    raise MalformedRecordError(
+                        f"Malformed record at byte {record_end}")
+                record_end = match.end()
+                if record_start == size:
+                    break
+                if buffer[record_start] in b"\r\n":  # empty line
+                    continue
+                field_start, field_end = match.span(1)
+                if field_start == -1:
+                    yield None
+                else:
+                    yield buffer[field_start:field_end]
+        finally:
+            matches = match = None  # the iterator holds the buffer
+            f.close()
+            if buffer:
+                buffer.close()
+
+    def _decode(self, field: Optional[bytes]) -> Optional[str]:
+        if field is None:
+            return None
+        if field[:1] == self._quote:
+            closing = field.rfind(self._quote, 1)
+            if self._escape is None:
+                field = (field[1:closing].replace(self._quote * 2,
+                                                  self._quote)
+                         + field[closing + 1:])
+            else:
+                field = field[1:closing] + field[closing + 1:]
+        if self._unescape is not None:
+            field = self._unescape.sub(b"\\1", field)
+        return field.decode(self._encoding)
+
+    def _texts(self, index: int, nrows: Optional[int]
+               ) -> Iterator[Optional[str]]:
+        for field in self._fields(index, nrows):
+            yield None if field is None else self._decode(field)
+
+    def _csv_rows(self) -> Iterator[List[str]]:
+        """Yield the records, read by the `csv` module."""
+        with open(self._path, "rb") as f:
+            if not self._skip_bom or f.read(3) != codecs.BOM_UTF8:
+                f.seek(0)
+            with io.TextIOWrapper(f, self._encoding, newline="") as text:
+                yield from csv.reader(text, **self._params)
+
+    def _csv_texts(self, index: int, nrows: Optional[int]
+                   ) -> Iterator[Optional[str]]:
+        rows = self._csv_rows()
+        next(rows, None)  # header
+        for row in islice(rows, nrows):
+            if not row:  # empty line
+                continue
+            yield row[index] if index < len(row) else None
+
+    def texts(self, index: int, nrows: Optional[int] = None
+              ) -> List[Optional[str]]:
+        """:return: the texts of the column `index`"""
+        try:
+            return list(self._texts(index, nrows))
+        except MalformedRecordError:
+            return list(self._csv_texts(index, nrows))
+
+    def column_values(self, index: int, description: FieldDescription,
+                      nrows: Optional[int] = None) -> Collection[Any]:
+        """
+        :return: the typed values of the column `index`, as stored by a
+        `ColumnBuilder`
+        """
+        try:
+            return self._column_values(self._texts(index, nrows),
+                                       description)
+        except MalformedRecordError:
+            return self._column_values(self._csv_texts(index, nrows),
+                                       description)
+
+    def _column_values(self, texts: Iterator[Optional[str]],
+                       description: FieldDescription) -> Collection[Any]:
+        processor = description.to_field_processor(self._null_value)
+        builder = ColumnBuilder("", description)
+        while True:
+            chunk = [None if text is None else processor.to_object(text)
+                     for text in islice(texts, CHUNK_SIZE)]
+            if not chunk:
+                break
+            builder.extend(chunk)
+        return builder.build().col_values
+
+
+def create_reader(path: Path, meta_csv_data: MetaCSVData
+                  ) -> Optional[MmapCSVReader]:
+    return MmapCSVReader.create(path, meta_csv_data.encoding,
+                                dialect_params(meta_csv_data.dialect),
+                                meta_csv_data.null_value,
+                                getattr(meta_csv_data, "bom", False))
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
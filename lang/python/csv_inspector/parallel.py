@@ -0,0 +1,279 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Parallel parsing of a CSV file: the file is split into byte ranges on record
+boundaries, and every range is parsed by a process of a pool.
+"""
+import csv
+import io
+import mmap
+import re
+from pathlib import Path
+from typing import (List, Tuple, Sequence, Optional, Mapping, Any, Collection,
+                    Callable)
+
+from mcsv.field_description import FieldDescription
+from mcsv.meta_csv_data import MetaCSVData
+
+from csv_inspector.protocol import fork_context
+from csv_inspector.util import TypedValues, ColumnBuilder
+
+BLOCK_SIZE = 16 * 1024 * 1024
+DIALECT_ATTRIBUTES = ("delimiter", "quotechar", "escapechar", "doublequote",
+                      "skipinitialspace", "lineterminator", "quoting",
+                      "strict")
+
+
+def field_processors(meta_csv_data: MetaCSVData,
+                     descriptions: Sequence[FieldDescription]) -> List[Any]:
+    """
+    :return: the processors of the fields, with the null value of the
+    MetaCSV file, as the MetaCSV reader of `read_csv`
+    """
+    return [description.to_field_processor(meta_csv_data.null_value)
+            for description in descriptions]
+
+
+def dialect_params(dialect: csv.Dialect) -> Mapping[str, Any]:
+    """
+    A dialect may be an unpicklable class: return its attributes.
+    """
+    return {name: getattr(dialect, name) for name in DIALECT_ATTRIBUTES
+            if getattr(dialect, name, None) is not None}
+
+
+class RecordSplitter:
+    """
+    Find the record boundaries in a CSV file. A newline is a record boundary
+    if the number of unescaped quotes since the previous boundary is even.
+
+    >>> splitter = RecordSplitter("utf-8", {"quotechar": '"',
+    ...                                     "doublequote": True})
+    >>> text = b'a,b\\n"x\\ny",1\\n"z""\\n",2\\nt,3\\n'
+    >>> splitter.record_end(text, 0)
+    4
+    >>> splitter.record_end(text, 4, 5)
+    12
+    >>> splitter.record_end(text, 12, 13)
+    21
+    >>> splitter = RecordSplitter("utf-8", {"quotechar": '"',
+    ...                                     "doublequote": False,
+    ...                                     "escapechar": "\\\\"})
+    >>> text = b'"x\\\\"\\ny",1\\n"z\\\\\\\\",2\\n'
+    >>> splitter.record_end(text, 0, 1)
+    10
+    >>> splitter.record_end(text, 10, 11)
+    18
+    """
+
+    @staticmethod
+    def create(encoding: str, params: Mapping[str, Any]
+               ) -> Optional["RecordSplitter"]:
+        """
+        Return None if the encoding is not compatible with a byte search
+        (e.g. UTF-16).
+        """
+        try:
+            newline = "\n".encode(encoding)
+            quote = params.get("quotechar", '"').encode(encoding)
+            escape = (params.get("escapechar") or "\\").encode(encoding)
+        except (LookupError, UnicodeError):
+            return None
+        if newline != b"\n" or len(quote) != 1 or len(escape) != 1:
+            return None
+        return RecordSplitter(encoding, params)
+
+    def __init__(self, encoding: str, params: Mapping[str, Any]):
+        self._quote = params.get("quotechar", '"').encode(encoding)
+        escapechar = params.get("escapechar")
+        if params.get("doublequote", True) or escapechar is None:
+            self._escape = None
+            self._escaped_quote_pattern = None
+        else:
+            self._escape = escapechar.encode(encoding)
+            escape = re.escape(self._escape)
+            self._escaped_quote_pattern = re.compile(
+                b"(?<!" + escape + b")(?:" + escape + escape + b")*"
+                + escape + re.escape(self._quote))
+
+    def record_end(self, buffer, start: int, pos: Optional[int] = None
+                   ) -> int:
+        """
+        :param buffer: the bytes or the mmap
+        :param start: a record boundary
+        :param pos: the position to start the search of the next boundary
+        :return: the first record boundary after `pos`, or the length of the
+        buffer.
+        """
+        if pos is None:
+            pos = start
+        else:
+            pos = self._before_escapes(buffer, start, pos)
+        quote_count = self._count_quotes(buffer, start, pos)
+        while True:
+            newline_index = buffer.find(b"\n", pos)
+            if newline_index == -1:
+                return len(buffer)
+            quote_count += self._count_quotes(buffer, pos, newline_index)
+            if quote_count % 2 == 0:
+                return newline_index + 1
+            pos = newline_index + 1
+
+    def _before_escapes(self, buffer, start: int, pos: int) -> int:
+        """Do not split a sequence of escape chars"""
+        if self._escape is not None:
+            while pos > start and buffer[pos - 1:pos] == self._escape:
+                pos -= 1
+        return pos
+
+    def _count_quotes(self, buffer, start: int, end: int) -> int:
+        count = 0
+        while start < end:
+            block_end = self._before_escapes(buffer, start,
+                                             min(start + BLOCK_SIZE, end))
+            if block_end == start:
+                block_end = end
+            block = buffer[start:block_end]
+            count += block.count(self._quote)
+            if self._escaped_quote_pattern is not None:
+                count -= len(self._escaped_quote_pattern.findall(block))
+            start = block_end
+        return count
+
+
+def split_ranges(path: Path, splitter: RecordSplitter,
+                 count: int) -> List[Tuple[int, int]]:
+    """
+    Split the data (without the header) in at most `count` ranges.
+    """
+    with open(path, "rb") as f:
+        if not f.seek(0, io.SEEK_END):
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            size = len(buffer)
+            data_start = splitter.record_end(buffer, 0)
+            starts = [data_start]
+            for k in range(1, count):
+                target = data_start + (size - data_start) * k // count
+                if target <= starts[-1]:
+                    continue
+                start = splitter.record_end(buffer, starts[-1], target)
+                if start >= size:
+                    break
+                starts.append(start)
+    return [(start, end) for start, end in zip(starts, starts[1:] + [size])
+            if start < end]
+
+
+# The context of the parse: set before the fork of the pool, hence the
+# dialect and the processors are inherited, not pickled
+_parse_context = None
+
+
+def parse_range(start: int, end: int) -> List[Collection[Any]]:
+    """
+    Parse a range of a CSV file and return the values of the columns.
+    """
+    path, meta_csv_data, descriptions, processors = _parse_context
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode(meta_csv_data.encoding)
+    rows = [[processor.to_object(v) for processor, v in zip(processors, row)]
+            for row in csv.reader(io.StringIO(text, newline=""),
+                                  meta_csv_data.dialect)]
+    return [TypedValues.create(description.get_python_type(), values)
+            for description, values in zip(descriptions, zip(*rows))]
+
+
+def read_in_parallel(path: Path, meta_csv_data: MetaCSVData,
+                     descriptions: Sequence[FieldDescription],
+                     builders: Sequence[ColumnBuilder],
+                     workers: int) -> Optional[int]:
+    """
+    Parse the file in a pool of `workers` processes and extend the builders
+    with the values, in the order of the file.
+
+    :return: the number of complete columns, or None if the file can't be
+    parsed in parallel.
+    """
+    global _parse_context
+
+    context = fork_context()
+    params = dialect_params(meta_csv_data.dialect)
+    splitter = RecordSplitter.create(meta_csv_data.encoding, params)
+    if context is None or splitter is None:
+        return None
+
+    ranges = split_ranges(path, splitter, workers)
+    _parse_context = (path, meta_csv_data, descriptions,
+                      field_processors(meta_csv_data, descriptions))
+    try:
+        with context.Pool(min(workers, max(len(ranges), 1))) as pool:
+            results = pool.starmap(parse_range, ranges)
+    finally:
+        _parse_context = None
+
+    width = len(builders)
+    for columns_values in results:
+        width = min(width, len(columns_values))
+        for builder, values in zip(builders, columns_values):
+            builder.extend(values)
+    return width
+
+
+# The function of `map_ranges`: set before the fork of the pool
+_range_func = None
+
+
+def map_ranges(func: Callable[[int, int], Any], length: int,
+               workers: int) -> Optional[List[Any]]:
+    """
+    Call `func(start, end)` on at most `workers` consecutive ranges that
+    cover `range(length)`, in a pool of processes. The processes inherit
+    `func`: it may be a closure and it is not pickled.
+
+    :return: the results, in the order of the ranges, or None if the
+    processes can't be forked.
+    """
+    global _range_func
+
+    context = fork_context()
+    if context is None:
+        return None
+
+    ranges = [(length * k // workers, length * (k + 1) // workers)
+              for k in range(workers)]
+    ranges = [(start, end) for start, end in ranges if start < end]
+    if not ranges:
+        return []
+    _range_func = func
+    try:
+        with context.Pool(len(ranges)) as pool:
+            return pool.starmap(_call_range_func, ranges)
+    finally:
+        _range_func = None
+
+
+def _call_range_func(start: int, end: int) -> Any:
+    return _range_func(start, end)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
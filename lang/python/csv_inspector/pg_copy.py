@@ -0,0 +1,317 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+The binary format of the PostgreSQL `COPY` command (`COPY table FROM STDIN
+WITH (FORMAT binary)`): the server does not parse any text, and the file
+may be sent by the client. All integers are big endian.
+
+```
+file = signature flags:i32 extension_size:i32 row* trailer:i16 (-1)
+signature = "PGCOPY\\n\\xff\\r\\n\\0"
+row = field_count:i16 field*
+field = size:i32 bytes (size -1 and no bytes for a null)
+```
+
+The bytes of a field are the binary representation (`*send` functions of
+the server) of the SQL type of the column (see `PG_TYPE_BY_DATA_TYPE`):
+
+* `boolean`: one byte, 0 or 1;
+* `bigint`: int64;
+* `double precision`: float64;
+* `numeric`: digit_count:i16 weight:i16 sign:i16 scale:i16, then the digits
+in base 10000 (i16);
+* `date`: int32 days since 2000-01-01;
+* `timestamp`: int64 microseconds since 2000-01-01 00:00:00;
+* `text`: the utf-8 bytes.
+
+The invalid values (`ReadError`) are nulls.
+"""
+import datetime
+import struct
+from decimal import Decimal
+from pathlib import Path
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, Optional,
+                    Sequence)
+
+import mcsv
+from mcsv.field_description import (DataType, FieldDescription,
+                                    python_type_to_data_type)
+from mcsv.field_processors import ReadError
+
+from csv_inspector.cancel import checked
+from csv_inspector.data import Data
+from csv_inspector.util import Column
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+TRAILER = struct.pack(">h", -1)
+
+PG_TYPE_BY_DATA_TYPE = {
+    DataType.BOOLEAN: "boolean",
+    DataType.INTEGER: "bigint",
+    DataType.CURRENCY_INTEGER: "bigint",
+    DataType.FLOAT: "double precision",
+    DataType.PERCENTAGE_FLOAT: "double precision",
+    DataType.DECIMAL: "numeric",
+    DataType.CURRENCY_DECIMAL: "numeric",
+    DataType.PERCENTAGE_DECIMAL: "numeric",
+    DataType.DATE: "date",
+    DataType.DATETIME: "timestamp",
+}
+
+_INT16 = struct.Struct(">h")
+_INT32 = struct.Struct(">i")
+_INT64 = struct.Struct(">q")
+_FLOAT64 = struct.Struct(">d")
+_NULL = _INT32.pack(-1)
+
+_NUMERIC_POS = 0x0000
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+
+_PG_EPOCH_DATE = datetime.date(2000, 1, 1)
+_PG_EPOCH = datetime.datetime(2000, 1, 1)
+
+
+def pg_type(data_type: DataType) -> str:
+    """
+    >>> pg_type(DataType.CURRENCY_DECIMAL)
+    'numeric'
+    >>> pg_type(DataType.ANY)
+    'text'
+    """
+    return PG_TYPE_BY_DATA_TYPE.get(data_type, "text")
+
+
+def encode_boolean(value: Any) -> bytes:
+    return b"\x01" if value else b"\x00"
+
+
+def encode_bigint(value: int) -> bytes:
+    return _INT64.pack(value)
+
+
+def encode_double(value: float) -> bytes:
+    return _FLOAT64.pack(value)
+
+
+def encode_numeric(value: Any) -> bytes:
+    """
+    >>> encode_numeric(Decimal("-12345.678")).hex(" ", 2)
+    '0003 0001 4000 0003 0001 0929 1a7c'
+    >>> encode_numeric(Decimal("0.00001")).hex(" ", 2)
+    '0001 fffe 0000 0005 03e8'
+    >>> encode_numeric(Decimal("1E+4")).hex(" ", 2)
+    '0001 0001 0000 0000 0001'
+    >>> encode_numeric(0).hex(" ", 2)
+    '0000 0000 0000 0000'
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if value.is_nan():
+        return struct.pack(">hhHh", 0, 0, _NUMERIC_NAN, 0)
+    if value.is_infinite():
+        raise ValueError(f"Can't encode {value} as a numeric")
+
+    sign, digits, exponent = value.as_tuple()
+    text = "".join(map(str, digits))
+    if exponent > 0:
+        text += "0" * exponent
+        exponent = 0
+    scale = -exponent
+    if len(text) < scale:
+        text = text.zfill(scale)
+    int_part, frac_part = text[:len(text) - scale], text[len(text) - scale:]
+    # align the base 10000 digits on the decimal point
+    int_part = int_part.zfill((len(int_part) + 3) // 4 * 4)
+    frac_part = frac_part.ljust((len(frac_part) + 3) // 4 * 4, "0")
+    pg_digits = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(pg_digits) - 1
+    pg_digits += [int(frac_part[i:i + 4]) for i in
+                  range(0, len(frac_part), 4)]
+
+    start = 0
+    while start < len(pg_digits) and pg_digits[start] == 0:
+        start += 1
+        weight -= 1
+    end = len(pg_digits)
+    while end > start and pg_digits[end - 1] == 0:
+        end -= 1
+    pg_digits = pg_digits[start:end]
+    if not pg_digits:  # zero
+        weight = 0
+        sign = 0
+
+    return struct.pack(f">hhHh{len(pg_digits)}h", len(pg_digits), weight,
+                       _NUMERIC_NEG if sign else _NUMERIC_POS, scale,
+                       *pg_digits)
+
+
+def encode_date(value: datetime.date) -> bytes:
+    """
+    >>> encode_date(datetime.date(1999, 12, 31)).hex()
+    'ffffffff'
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return _INT32.pack((value - _PG_EPOCH_DATE).days)
+
+
+def encode_timestamp(value: datetime.datetime) -> bytes:
+    """
+    An aware datetime is converted to UTC.
+
+    >>> encode_timestamp(datetime.datetime(2000, 1, 2, 0, 0, 1, 5)).hex()
+    '000000141de6a245'
+    """
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    delta = value - _PG_EPOCH
+    return _INT64.pack((delta.days * 86400 + delta.seconds) * 1000000
+                       + delta.microseconds)
+
+
+def encode_text(value: Any) -> bytes:
+    return str(value).encode("utf-8")
+
+
+ENCODER_BY_PG_TYPE: Dict[str, Callable[[Any], bytes]] = {
+    "boolean": encode_boolean,
+    "bigint": encode_bigint,
+    "double precision": encode_double,
+    "numeric": encode_numeric,
+    "date": encode_date,
+    "timestamp": encode_timestamp,
+    "text": encode_text,
+}
+
+
+class PGCopyWriter:
+    """
+    Write the rows in the binary COPY format. The header is written on
+    enter, the trailer on exit.
+
+    >>> import io
+    >>> stream = io.BytesIO()
+    >>> with PGCopyWriter(stream, [DataType.INTEGER, DataType.TEXT]) as w:
+    ...     w.writerows([(1, "a"), (None, ReadError("b"))])
+    >>> copy = stream.getvalue()
+    >>> copy[:19] == SIGNATURE + bytes(8), copy[-2:] == TRAILER
+    (True, True)
+    >>> copy[19:-2]
+    b'\\x00\\x02\\x00\\x00\\x00\\x08\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01\\x00\\x00\\x00\\x01a\\x00\\x02\\xff\\xff\\xff\\xff\\xff\\xff\\xff\\xff'
+    >>> w.row_count, w.error_count
+    (2, 1)
+    """
+
+    def __init__(self, stream: BinaryIO, data_types: Sequence[DataType]):
+        self._stream = stream
+        self._encoders = [ENCODER_BY_PG_TYPE[pg_type(data_type)]
+                          for data_type in data_types]
+        self._field_count = _INT16.pack(len(self._encoders))
+        self.row_count = 0
+        self.error_count = 0
+
+    def __enter__(self) -> "PGCopyWriter":
+        self._stream.write(SIGNATURE + _INT32.pack(0) + _INT32.pack(0))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._stream.write(TRAILER)
+
+    def writerow(self, row: Sequence[Any]):
+        """
+        A short row is padded with nulls, the extra fields of a long row are
+        ignored.
+        """
+        parts = [self._field_count]
+        for encoder, value in zip(self._encoders, row):
+            if value is None:
+                parts.append(_NULL)
+            elif isinstance(value, ReadError):
+                self.error_count += 1
+                parts.append(_NULL)
+            else:
+                field = encoder(value)
+                parts.append(_INT32.pack(len(field)))
+                parts.append(field)
+        parts.extend([_NULL] * (len(self._encoders) - len(row)))
+        self._stream.write(b"".join(parts))
+        self.row_count += 1
+
+    def writerows(self, rows: Iterable[Sequence[Any]]):
+        for row in checked(rows):
+            self.writerow(row)
+
+
+def column_data_type(column: Column) -> DataType:
+    col_info = column.col_info
+    if isinstance(col_info, FieldDescription):
+        return col_info.get_data_type()
+    elif isinstance(col_info, DataType):
+        return col_info
+    elif isinstance(col_info, type) and col_info is not Any:
+        return python_type_to_data_type(col_info)
+    else:
+        return DataType.TEXT
+
+
+def write_data(data: Data, stream: BinaryIO) -> PGCopyWriter:
+    """
+    Write the rows of a data object. The types of the columns are given by
+    `create_table`.
+
+    :return: the writer, with the counts of rows and errors
+    """
+    column_group = data._column_group
+    with PGCopyWriter(stream, [column_data_type(column)
+                               for column in column_group]) as writer:
+        writer.writerows(column_group.rows())
+    return writer
+
+
+def create_table(data: Data, table_name: str) -> str:
+    """:return: the CREATE TABLE statement for the data object"""
+    columns = ", ".join(f'"{column.name}" {pg_type(column_data_type(column))}'
+                        for column in data._column_group)
+    return f'CREATE TABLE "{table_name}" ({columns});'
+
+
+def write_csv(file: Path, stream: BinaryIO,
+              mcsv_path: Optional[Path] = None) -> PGCopyWriter:
+    """
+    Write the rows of a CSV file. The file is streamed: the rows of the
+    MetaCSV reader are encoded one by one.
+
+    :return: the writer, with the counts of rows and errors
+    """
+    with mcsv.open_csv(file, "r", mcsv_path) as mcsv_reader:
+        next(mcsv_reader)  # header
+        data_types = [description.get_data_type()
+                      for description in mcsv_reader.descriptions]
+        with PGCopyWriter(stream, data_types) as writer:
+            writer.writerows(mcsv_reader)
+    return writer
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,114 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+The protocol between the GUI and the server: the token, the directives and
+the side channel of the frames.
+
+This module has no dependencies, because the server imports it at startup
+(see `csv_inspector.server`): the other modules are imported when they are
+used.
+"""
+import multiprocessing
+import sys
+from typing import Optional
+
+try:
+    TOKEN
+except NameError:
+    if len(sys.argv) > 1:
+        TOKEN = sys.argv[1]
+    else:
+        TOKEN = None
+
+BEGIN_SCRIPT = f"{TOKEN}begin script"
+END_SCRIPT = f"{TOKEN}end script"
+ACCEPT_FRAMES = f"{TOKEN}accept frames:"
+
+# The side channel of the binary frames, if the client accepts them.
+_frame_channel = None
+
+
+def begin_info():
+    print(f"{TOKEN}begin info")
+
+
+def end_info():
+    print(f"{TOKEN}end info", flush=True)
+
+
+def begin_csv():
+    print(f"{TOKEN}begin csv")
+
+
+def end_csv():
+    print(f"{TOKEN}end csv", flush=True)
+
+
+def executed():
+    print(f"{TOKEN}executed", flush=True)
+    print(f"{TOKEN}executed", file=sys.stderr, flush=True)
+
+
+def accept_frames(channel_path: Optional[str]):
+    """
+    The client accepts binary frames (see `csv_inspector.frame`) instead of
+    the text CSV: the frames are appended to the file or pipe `channel_path`.
+    None: back to the text CSV.
+    """
+    global _frame_channel
+
+    if _frame_channel is not None:
+        _frame_channel.close()
+        _frame_channel = None
+    if channel_path:
+        _frame_channel = open(channel_path, "ab")
+
+
+def frames_accepted() -> bool:
+    return _frame_channel is not None
+
+
+def send_frame(frame: bytes):
+    """
+    Write the frame to the side channel, then tell the client the size of
+    the frame to read.
+    """
+    _frame_channel.write(frame)
+    _frame_channel.flush()
+    print(f"{TOKEN}frame:{len(frame)}", flush=True)
+
+
+def missing_mcsv(csv_path):
+    print(f"{TOKEN}missing csv:{csv_path}")
+
+
+def execute_script(script, vars):
+    vars["TOKEN"] = TOKEN
+    exec(script, vars)
+
+
+def fork_context() -> Optional[multiprocessing.context.BaseContext]:
+    """
+    The children of a pool must not import the `__main__` module, since this
+    module is the server loop: return a "fork" context, or None if this
+    start method is not available.
+    """
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:
+        return None
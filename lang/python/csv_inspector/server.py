@@ -0,0 +1,453 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+The server: read the commands on stdin and write the results on stdout.
+
+Every window has its own session: a namespace that lives in a worker
+process, hence the scripts of different windows are executed concurrently.
+The protocol (stdin of the server):
+
+* `{TOKEN}session:<session id>`: the next commands are sent to this session
+(created if necessary). The first session has the id "";
+* `{TOKEN}close session:<session id>`: stop the worker of the session;
+* `{TOKEN}cancel` or `{TOKEN}cancel:<session id>`: cancel the scripts that
+are executed or queued by the current session or by the given session (see
+`csv_inspector.cancel`);
+* `{TOKEN}deadline:<seconds>`: the max duration of the next scripts of the
+session (empty or 0: no deadline);
+* `{TOKEN}timings`: write the startup timings in an info block;
+* the other commands (scripts, pages, frames) are handled by the session.
+
+The outputs of the workers are multiplexed on stdout: a block (between
+`{TOKEN}begin ...` and `{TOKEN}end ...`) is never split, and
+`{TOKEN}session:<session id>` is written before the output of a session if
+the previous output came from another session.
+
+The server imports the light modules only, and starts fast. A standby
+worker is forked in advance: it imports the modules used by the scripts
+(see `WARM_UP_MODULES`) while it is idle, and the next new session takes it.
+"""
+import codecs
+import importlib
+import io
+import os
+import signal
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait, Connection
+from typing import Optional, Dict, List, TextIO
+
+from csv_inspector.cancel import (Cancelled, set_cancel_flag, start_script,
+                                  end_script)
+from csv_inspector.protocol import (TOKEN, BEGIN_SCRIPT, END_SCRIPT,
+                                    ACCEPT_FRAMES, accept_frames, executed,
+                                    fork_context)
+
+SESSION = f"{TOKEN}session:"
+CLOSE_SESSION = f"{TOKEN}close session:"
+CANCEL = f"{TOKEN}cancel"
+DEADLINE = f"{TOKEN}deadline:"
+TIMINGS = f"{TOKEN}timings"
+BEGIN_BLOCK = f"{TOKEN}begin "
+END_BLOCK = f"{TOKEN}end "
+DEFAULT_SESSION = ""
+
+IGNORE = 0
+SCRIPT = 1
+
+STDOUT = 1
+STDERR = 2
+WARM_UP = 3  # the durations of the imports of a worker
+
+WARM_UP_MODULES = ("csv_inspector.inspector", "csv_inspector.incremental",
+                   "csv_inspector.cursor", "numpy")
+
+
+def warm_up() -> Dict[str, float]:
+    """
+    Import the modules used by the scripts.
+
+    :return: the duration of the import of every module, in seconds
+    """
+    duration_by_module = {}
+    for module_name in WARM_UP_MODULES:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module_name)
+        except ImportError:  # optional
+            continue
+        duration_by_module[module_name] = time.perf_counter() - start
+    return duration_by_module
+
+
+class Session:
+    """
+    A namespace and the state of the reading of a script.
+    """
+
+    def __init__(self):
+        self.state = IGNORE
+        self.script_lines = []
+        self.vars = {}
+        self.timeout: Optional[float] = None
+        self.snapshots = None
+
+    def handle_line(self, line: str):
+        stripped_line = line.lstrip()
+        if self.state == IGNORE:
+            if stripped_line == BEGIN_SCRIPT:
+                self.state = SCRIPT
+                self.script_lines = []
+            elif stripped_line.startswith(ACCEPT_FRAMES):
+                accept_frames(stripped_line[len(ACCEPT_FRAMES):])
+            elif stripped_line.startswith(DEADLINE):
+                self._set_timeout(stripped_line[len(DEADLINE):])
+            else:
+                from csv_inspector.cursor import handle_cursor_command
+
+                if not handle_cursor_command(stripped_line):
+                    print(f"Garbage {stripped_line}", file=sys.stderr)
+        elif self.state == SCRIPT:
+            if stripped_line == END_SCRIPT:
+                self._execute("\n".join(self.script_lines))
+                self.state = IGNORE
+            else:
+                self.script_lines.append(line)
+
+    def _set_timeout(self, seconds: str):
+        try:
+            self.timeout = float(seconds) if seconds else None
+        except ValueError:
+            print(f"Wrong deadline {seconds}", file=sys.stderr)
+            return
+        if not self.timeout:
+            self.timeout = None
+
+    def _execute(self, script: str):
+        from csv_inspector.incremental import (SnapshotCache,
+                                               execute_incrementally)
+
+        print("server/execute script: {} chars".format(len(script)))
+        if self.snapshots is None:
+            self.snapshots = SnapshotCache()
+        start_script(self.timeout)
+        try:
+            skipped = execute_incrementally(script, self.vars,
+                                            self.snapshots)
+            if skipped:
+                print(f"server/{skipped} statements skipped")
+        except Cancelled as e:
+            print(f"server/script cancelled: {e}", file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            end_script()
+
+        print("server/script executed")
+        executed()
+
+
+class SessionOutput(io.TextIOBase):
+    """
+    The stdout or stderr of a worker: the text is sent to the server on
+    flush, unless a block was begun and not ended.
+    """
+
+    def __init__(self, connection: Connection, stream: int):
+        self._connection = connection
+        self._stream = stream
+        self._parts = []
+        self._depth = 0
+        self._line_start = True
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        for line in text.splitlines(keepends=True):
+            if self._line_start:
+                if line.startswith(BEGIN_BLOCK):
+                    self._depth += 1
+                elif line.startswith(END_BLOCK):
+                    self._depth = max(self._depth - 1, 0)
+            self._line_start = line.endswith("\n")
+        self._parts.append(text)
+        return len(text)
+
+    def flush(self):
+        if self._parts and self._depth == 0:
+            self._connection.send((self._stream, "".join(self._parts)))
+            self._parts = []
+
+
+def _run_worker(connection: Connection,
+                inherited_connections: List[Connection], cancel_flag):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # see `serve`
+    for inherited_connection in inherited_connections:
+        inherited_connection.close()  # else the other workers never get EOF
+    set_cancel_flag(cancel_flag, os.getppid())
+    sys.stdout = SessionOutput(connection, STDOUT)
+    sys.stderr = SessionOutput(connection, STDERR)
+    connection.send((WARM_UP, warm_up()))
+    session = Session()
+    while True:
+        try:
+            line = connection.recv()
+        except EOFError:
+            break
+        if line is None:
+            break
+        session.handle_line(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class Worker:
+    """
+    The server side of a session that lives in a worker process. The
+    session id of a standby worker is None.
+    """
+
+    def __init__(self, context, other_connections: List[Connection]):
+        self.session_id: Optional[str] = None
+        self.connection, child_connection = context.Pipe()
+        # the number of the scripts sent to the worker
+        self.script_count = 0
+        # shared with the worker, and set without waiting for the worker: the
+        # number of the last cancelled script (see `csv_inspector.cancel`)
+        self.cancel_flag = context.Value('q', 0, lock=False)
+        # not a daemon: the scripts may start pools (e.g. `workers=2`). The
+        # worker is stopped by `close`.
+        self.process = context.Process(
+            target=_run_worker,
+            args=(child_connection, [self.connection, *other_connections],
+                  self.cancel_flag))
+        self.process.start()
+        child_connection.close()
+
+    def send(self, line: str):
+        self.connection.send(line)
+
+    def cancel(self):
+        """Cancel the scripts sent to the worker"""
+        self.cancel_flag.value = self.script_count
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except OSError:  # the worker died
+            pass
+        self.connection.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class Server:
+    """
+    Dispatch the lines of stdin to the sessions and multiplex the outputs.
+    If the processes can't be forked, the sessions are executed in the
+    server process.
+    """
+
+    def __init__(self, stdout: TextIO = sys.stdout,
+                 stderr: TextIO = sys.stderr, standby: bool = True):
+        self._stdout = stdout
+        self._stderr = stderr
+        self._context = fork_context()
+        self._worker_by_id: Dict[str, Worker] = {}
+        self._standby = standby and self._context is not None
+        self._standby_worker: Optional[Worker] = None
+        # name -> duration in seconds
+        self.timings: Dict[str, float] = {}
+        self.start_standby_worker()
+        self._session_by_id: Dict[str, Session] = {}
+        self._session_id = DEFAULT_SESSION
+        self._output_session_id = DEFAULT_SESSION
+        self._in_script = False
+
+    def handle_line(self, line: str):
+        stripped_line = line.lstrip()
+        end_of_script = False
+        if not self._in_script:
+            if stripped_line.startswith(SESSION):
+                self._session_id = stripped_line[len(SESSION):]
+                return
+            elif stripped_line.startswith(CLOSE_SESSION):
+                self.close_session(stripped_line[len(CLOSE_SESSION):])
+                return
+            elif stripped_line == CANCEL:
+                self.cancel(self._session_id)
+                return
+            elif stripped_line.startswith(CANCEL + ":"):
+                self.cancel(stripped_line[len(CANCEL) + 1:])
+                return
+            elif stripped_line == TIMINGS:
+                self.write_timings()
+                return
+            self._in_script = stripped_line == BEGIN_SCRIPT
+        elif stripped_line == END_SCRIPT:
+            self._in_script = False
+            end_of_script = True
+
+        if self._context is None:
+            session = self._session_by_id.setdefault(self._session_id,
+                                                     Session())
+            self._write_session_id(self._session_id)
+            session.handle_line(line)
+            return
+
+        worker = self._worker_by_id.get(self._session_id)
+        if worker is None:
+            worker = self._new_worker(self._session_id)
+        try:
+            worker.send(line)
+        except OSError:
+            self._worker_died(worker)
+            return
+        if end_of_script:
+            worker.script_count += 1
+
+    def start_standby_worker(self):
+        if self._standby and self._standby_worker is None:
+            self._standby_worker = Worker(self._context, self.connections())
+
+    def _new_worker(self, session_id: str) -> Worker:
+        """Take the standby worker, and fork the next one"""
+        worker = self._standby_worker
+        self._standby_worker = None
+        if worker is None:
+            worker = Worker(self._context, self.connections())
+        worker.session_id = session_id
+        self._worker_by_id[session_id] = worker
+        self.start_standby_worker()
+        return worker
+
+    def cancel(self, session_id: str):
+        """
+        Cancel the script of the session. Without worker process, the
+        script is already executed.
+        """
+        worker = self._worker_by_id.get(session_id)
+        if worker is not None:
+            worker.cancel()
+
+    def close_session(self, session_id: str):
+        self._session_by_id.pop(session_id, None)
+        worker = self._worker_by_id.pop(session_id, None)
+        if worker is not None:
+            worker.close()
+
+    def _workers(self) -> List[Worker]:
+        workers = list(self._worker_by_id.values())
+        if self._standby_worker is not None:
+            workers.append(self._standby_worker)
+        return workers
+
+    def connections(self) -> List[Connection]:
+        return [worker.connection for worker in self._workers()]
+
+    def forward(self, connection: Connection):
+        """Write the output of a worker on stdout or stderr"""
+        worker = next((worker for worker in self._workers()
+                       if worker.connection is connection), None)
+        if worker is None:  # closed
+            return
+        try:
+            stream, text = connection.recv()
+        except (EOFError, OSError):
+            if worker is self._standby_worker:
+                self._standby_worker = None
+                worker.close()
+            else:
+                self._worker_died(worker)
+            return
+        if stream == WARM_UP:
+            self.timings.update((f"import {module_name}", duration)
+                                for module_name, duration in text.items())
+            return
+        self._write_session_id(worker.session_id)
+        out = self._stdout if stream == STDOUT else self._stderr
+        out.write(text)
+        out.flush()
+
+    def _write_session_id(self, session_id: str):
+        if session_id != self._output_session_id:
+            self._output_session_id = session_id
+            print(f"{SESSION}{session_id}", file=self._stdout, flush=True)
+
+    def _worker_died(self, worker: Worker):
+        """The client may wait for the end of a script"""
+        del self._worker_by_id[worker.session_id]
+        worker.close()
+        self._write_session_id(worker.session_id)
+        print(f"The worker of the session {worker.session_id!r} died",
+              file=self._stderr)
+        print(f"{TOKEN}executed", file=self._stdout, flush=True)
+        print(f"{TOKEN}executed", file=self._stderr, flush=True)
+
+    def write_timings(self):
+        """Write the startup timings in an info block"""
+        lines = [f"{TOKEN}begin info"]
+        lines.extend(f"{name}: {duration * 1000:.1f} ms"
+                     for name, duration in self.timings.items())
+        lines.append(f"{TOKEN}end info")
+        print("\n".join(lines), file=self._stdout, flush=True)
+        print(f"{TOKEN}executed", file=self._stdout, flush=True)
+        print(f"{TOKEN}executed", file=self._stderr, flush=True)
+
+    def close(self):
+        for session_id in list(self._worker_by_id):
+            self.close_session(session_id)
+        if self._standby_worker is not None:
+            self._standby_worker.close()
+            self._standby_worker = None
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def serve(stdin_fd: int = 0, server: Optional[Server] = None):
+    """
+    The main loop: wait for a line on stdin or an output of a worker.
+
+    The client stops the server with SIGTERM: the workers are not daemons,
+    hence they are closed before the exit.
+    """
+    previous_handler = signal.signal(signal.SIGTERM, _terminate)
+    if server is None:
+        server = Server()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    try:
+        while True:
+            for ready in wait([stdin_fd] + server.connections()):
+                if ready != stdin_fd:
+                    server.forward(ready)
+                    continue
+                data = os.read(stdin_fd, 64 * 1024)
+                if not data:
+                    return
+                *lines, pending = (pending + decoder.decode(data)).split("\n")
+                for line in lines:
+                    server.handle_line(line.rstrip())
+    finally:
+        server.close()
+        signal.signal(signal.SIGTERM, previous_handler)
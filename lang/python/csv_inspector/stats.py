@@ -0,0 +1,443 @@
+#  CSVInspector - A graphical interactive tool to inspect and process CSV files.
+#      Copyright (C) 2020 J. Férard <https://github.com/jferard>
+#
+#  This file is part of CSVInspector.
+#
+#  CSVInspector is free software: you can redistribute it and/or modify it under the
+#  terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  CSVInspector is distributed in the hope that it will be useful, but WITHOUT ANY
+#  WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+#  A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+The stats of the columns. The values of a column are read once, by chunks:
+count, min, max, mean and variance are updated chunk by chunk (exact sums for
+the integers and the decimals, moments merged with the formulas of Chan et
+al. for the floats).
+
+The median is exact (the values are kept and sorted) or approximated by a
+t-digest (the memory is bounded).
+
+The stats are cached in the columns, by version of the column.
+"""
+import decimal
+import math
+from decimal import Decimal
+from fractions import Fraction
+from itertools import islice
+from typing import (Any, Collection, Iterable, List, Optional, Sequence,
+                    Type, Tuple)
+
+from csv_inspector.cancel import check
+from csv_inspector.parallel import map_ranges
+from csv_inspector.util import Column, count_nulls, valid_values
+
+CHUNK_SIZE = 64 * 1024
+EXACT = "exact"
+TDIGEST = "tdigest"
+
+
+class ColumnStats:
+    """
+    The stats of a column. A stat is None if it can't be computed (no value,
+    values not comparable...)
+    """
+
+    def __init__(self, count: int, null_count: int, min_value: Any = None,
+                 max_value: Any = None, mean: Optional[float] = None,
+                 variance: Optional[float] = None, median: Any = None):
+        self.count = count
+        self.null_count = null_count
+        self.min = min_value
+        self.max = max_value
+        self.mean = mean
+        self.variance = variance
+        self.median = median
+
+    def __repr__(self):
+        return (f"ColumnStats(count={self.count}, "
+                f"null_count={self.null_count}, min={self.min}, "
+                f"max={self.max}, mean={self.mean}, "
+                f"variance={self.variance}, median={self.median})")
+
+
+class StatsAccumulator:
+    """
+    Count, min, max, mean and variance of the values, chunk by chunk.
+
+    The sums of the integers and of the decimals are exact: as with
+    `statistics.mean` and `statistics.variance`, the mean of integers is an
+    int if it is an integer (else a float) and the mean of decimals is a
+    Decimal. The moments of the floats are merged with the formulas of Chan
+    et al.
+
+    >>> accumulator = StatsAccumulator()
+    >>> accumulator.update([2, 4, 4])
+    >>> accumulator.update([4, 5, 5, 7, 9])
+    >>> accumulator.count, accumulator.min, accumulator.max, accumulator.mean
+    (8, 2, 9, 5)
+    >>> accumulator.variance()
+    4.571428571428571
+    >>> accumulator.update([0.5])
+    >>> accumulator.mean
+    4.5
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._comparable = True
+        self._kind = None
+        # _INT and _DECIMAL: exact sums
+        self._sum = 0
+        self._sum_squares = 0
+        # _FLOAT: moments
+        self._mean = None
+        self._m2 = None
+
+    def update(self, values: Sequence[Any]):
+        n = len(values)
+        if n == 0:
+            return
+        self.count += n
+        if self._comparable:
+            try:
+                chunk_min, chunk_max = min(values), max(values)
+                if self.min is None:
+                    self.min, self.max = chunk_min, chunk_max
+                else:
+                    self.min = min(self.min, chunk_min)
+                    self.max = max(self.max, chunk_max)
+            except TypeError:
+                self._comparable = False
+                self.min = self.max = None
+        if self._kind != _NOT_NUMERIC:
+            self._update_moments(values, _numeric_kind(values))
+
+    def _update_moments(self, values: Sequence[Any], kind: Optional[str]):
+        if (kind is None
+                or {kind, self._kind} == {_FLOAT, _DECIMAL}):  # no mean
+            self._kind = _NOT_NUMERIC
+            self._mean = self._m2 = None
+        elif _FLOAT in (kind, self._kind):
+            if self._kind in (_INT, _DECIMAL):
+                self._exact_to_moments(self.count - len(values))
+            self._kind = _FLOAT
+            n = len(values)
+            chunk_mean = math.fsum(values) / n
+            chunk_m2 = math.fsum([(x - chunk_mean) ** 2 for x in values])
+            self._merge_moments(n, chunk_mean, chunk_m2)
+        else:
+            if _DECIMAL in (kind, self._kind):
+                self._kind = _DECIMAL
+            else:
+                self._kind = _INT
+            with _exact_context():
+                self._sum += sum(values)
+                self._sum_squares += sum([x * x for x in values])
+
+    def _exact_to_moments(self, previous_count: int):
+        """The exact sums of int values become float moments"""
+        self._mean = self._sum / previous_count
+        self._m2 = ((previous_count * self._sum_squares - self._sum ** 2)
+                    / previous_count)
+
+    def _merge_moments(self, n: int, chunk_mean: float, chunk_m2: float):
+        if self._mean is None:
+            self._mean, self._m2 = chunk_mean, chunk_m2
+            return
+        previous_count = self.count - n
+        delta = chunk_mean - self._mean
+        self._mean += delta * n / self.count
+        self._m2 += chunk_m2 + delta ** 2 * previous_count * n / self.count
+
+    @property
+    def mean(self) -> Any:
+        if self._kind == _FLOAT:
+            return self._mean
+        elif self._kind in (_INT, _DECIMAL):
+            return self._exact_ratio(self._sum, self.count)
+        return None
+
+    def variance(self) -> Any:
+        """The sample variance"""
+        if self.count < 2:
+            return None
+        if self._kind == _FLOAT:
+            return self._m2 / (self.count - 1)
+        elif self._kind in (_INT, _DECIMAL):
+            with _exact_context():
+                numerator = (self.count * self._sum_squares
+                             - self._sum * self._sum)
+            return self._exact_ratio(numerator, self.count * (self.count - 1))
+        return None
+
+    def _exact_ratio(self, numerator: Any, denominator: int) -> Any:
+        """The conversion of `statistics`"""
+        ratio = Fraction(numerator) / denominator
+        if self._kind == _DECIMAL:
+            return Decimal(ratio.numerator) / Decimal(ratio.denominator)
+        if ratio.denominator == 1:
+            return ratio.numerator
+        return ratio.numerator / ratio.denominator
+
+
+_INT = "int"
+_DECIMAL = "decimal"
+_FLOAT = "float"
+_NOT_NUMERIC = "not numeric"
+
+
+def _numeric_kind(values: Iterable[Any]) -> Optional[str]:
+    """
+    >>> _numeric_kind([1, True]), _numeric_kind([1, Decimal(2)])
+    ('int', 'decimal')
+    >>> _numeric_kind([1, 2.0]), _numeric_kind(["a"])
+    ('float', None)
+    """
+    kinds = set()
+    for value_type in set(map(type, values)):
+        if issubclass(value_type, int):
+            kinds.add(_INT)
+        elif issubclass(value_type, Decimal):
+            kinds.add(_DECIMAL)
+        elif issubclass(value_type, float):
+            kinds.add(_FLOAT)
+        else:
+            return None
+    if kinds == {_DECIMAL, _FLOAT}:
+        return None
+    for kind in (_FLOAT, _DECIMAL, _INT):
+        if kind in kinds:
+            return kind
+    return None
+
+
+# the sums and products of decimals are exact in this context
+_EXACT_CONTEXT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX,
+                                 Emin=decimal.MIN_EMIN)
+
+
+def _exact_context():
+    return decimal.localcontext(_EXACT_CONTEXT)
+
+
+class TDigest:
+    """
+    An approximation of the distribution of the values, with a bounded
+    number of centroids (Dunning's merging t-digest, scale function k1).
+
+    >>> digest = TDigest()
+    >>> digest.update(range(10001))
+    >>> round(digest.quantile(0.5))
+    5000
+    >>> len(digest.centroids()) < 200
+    True
+    """
+
+    def __init__(self, compression: int = 100):
+        self._compression = compression
+        self._centroids: List[List[float]] = []  # [mean, weight]
+        self._buffer: List[float] = []
+        self._min = None
+        self._max = None
+
+    def update(self, values: Iterable[float]):
+        self._buffer.extend(values)
+        if len(self._buffer) > 10 * self._compression:
+            self._compress()
+
+    def centroids(self) -> List[List[float]]:
+        self._compress()
+        return self._centroids
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        buffer_min, buffer_max = min(self._buffer), max(self._buffer)
+        if self._min is None:
+            self._min, self._max = buffer_min, buffer_max
+        else:
+            self._min = min(self._min, buffer_min)
+            self._max = max(self._max, buffer_max)
+        points = sorted(self._centroids + [[v, 1] for v in self._buffer])
+        self._buffer = []
+        total = sum(w for _, w in points)
+
+        centroids = []
+        weight_so_far = 0
+        q_limit = self._q_limit(0)
+        current = points[0]
+        for point in points[1:]:
+            if (weight_so_far + current[1] + point[1]) / total <= q_limit:
+                weight = current[1] + point[1]
+                current = [current[0] + (point[0] - current[0]) * point[1]
+                           / weight, weight]
+            else:
+                centroids.append(current)
+                weight_so_far += current[1]
+                q_limit = self._q_limit(weight_so_far / total)
+                current = point
+        centroids.append(current)
+        self._centroids = centroids
+
+    def _q_limit(self, q: float) -> float:
+        """The max quantile of a centroid that begins at q (k1 scale)"""
+        k = self._compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self._compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self._compression) + 1) / 2
+
+    def quantile(self, q: float) -> Optional[float]:
+        centroids = self.centroids()
+        if not centroids:
+            return None
+        total = sum(w for _, w in centroids)
+        target = q * total
+        cumulative = 0
+        previous_mean, previous_center = self._min, 0
+        for mean, weight in centroids:
+            center = cumulative + weight / 2
+            if target <= center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (
+                        target - previous_center) / (center - previous_center)
+            cumulative += weight
+            previous_mean, previous_center = mean, center
+        if total == previous_center:
+            return self._max
+        return previous_mean + (self._max - previous_mean) * (
+                target - previous_center) / (total - previous_center)
+
+
+def column_stats(col_values: Collection[Any], col_type: Type,
+                 quantiles: str = EXACT) -> ColumnStats:
+    """
+    Compute the stats of a column in one pass over the values. The text
+    columns only have a count and a null count.
+
+    :param quantiles: `EXACT` or `TDIGEST`
+
+    >>> column_stats([3, None, 1, 2, 4], int)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ColumnStats(count=4, null_count=1, min=1, max=4, mean=2.5,
+                variance=1.6666666666666667, median=2.5)
+    >>> column_stats([3, None, 1, 2, 4], int, TDIGEST).median
+    2.5
+    """
+    null_count = count_nulls(col_values)
+    if col_type == str:
+        return ColumnStats(len(col_values) - null_count, null_count)
+    if quantiles not in (EXACT, TDIGEST):
+        raise ValueError(f"Unknown quantiles {quantiles}")
+
+    accumulator = StatsAccumulator()
+    kept_values = []
+    digest = TDigest()
+    it = valid_values(col_values)
+    while True:
+        chunk = list(islice(it, CHUNK_SIZE))
+        if not chunk:
+            break
+        check()
+        accumulator.update(chunk)
+        if quantiles == EXACT:
+            kept_values.extend(chunk)
+        elif accumulator.mean is not None:
+            digest.update(map(float, chunk))
+
+    median = None
+    try:
+        if quantiles == EXACT:
+            median = _exact_median(kept_values)
+        elif accumulator.mean is not None:
+            median = digest.quantile(0.5)
+    except TypeError:  # not comparable
+        pass
+    return ColumnStats(accumulator.count, null_count, accumulator.min,
+                       accumulator.max, accumulator.mean,
+                       accumulator.variance(), median)
+
+
+def _exact_median(values: List[Any]) -> Any:
+    """Same as `statistics.median`"""
+    n = len(values)
+    if n == 0:
+        return None
+    values.sort()
+    i = n // 2
+    if n % 2 == 1:
+        return values[i]
+    return (values[i - 1] + values[i]) / 2
+
+
+def cached_column_stats(column: Column, quantiles: str = EXACT
+                        ) -> Optional[ColumnStats]:
+    """
+    :return: the stats of the current version of the column, or None if
+    they were not computed.
+    """
+    return column.stats_cache.get(_cache_key(column, quantiles))
+
+
+def _cache_key(column: Column, quantiles: str) -> Tuple:
+    return column.version, column.col_type, quantiles
+
+
+def _store_column_stats(column: Column, quantiles: str, stats: ColumnStats):
+    """Store the stats and forget the stats of the previous versions"""
+    for key in [key for key in column.stats_cache
+                if key[0] != column.version]:
+        del column.stats_cache[key]
+    column.stats_cache[_cache_key(column, quantiles)] = stats
+
+
+def columns_stats(columns: Sequence[Column], quantiles: str = EXACT,
+                  workers: int = 1) -> List[ColumnStats]:
+    """
+    Compute the stats of the columns. The stats of a column are computed
+    only if the column was modified since the last call. If `workers` > 1,
+    the columns are split between a pool of processes.
+
+    >>> column = Column("A", int, [1, 2, 3])
+    >>> columns_stats([column])[0] is columns_stats([column])[0]
+    True
+    >>> stats = columns_stats([column])[0]
+    >>> column.col_values = [1, 2]
+    >>> columns_stats([column])[0] is stats
+    False
+    """
+    missing_columns = [column for column in columns
+                       if cached_column_stats(column, quantiles) is None]
+
+    def stats_of_range(start: int, end: int) -> List[ColumnStats]:
+        return [column_stats(column.col_values, column.col_type, quantiles)
+                for column in missing_columns[start:end]]
+
+    missing_stats = None
+    if workers > 1:
+        stats_list = map_ranges(stats_of_range, len(missing_columns),
+                                workers)
+        if stats_list is not None:
+            missing_stats = [stats for stats_of_columns in stats_list
+                             for stats in stats_of_columns]
+    if missing_stats is None:
+        missing_stats = stats_of_range(0, len(missing_columns))
+
+    for column, stats in zip(missing_columns, missing_stats):
+        _store_column_stats(column, quantiles, stats)
+    return [cached_column_stats(column, quantiles) for column in columns]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
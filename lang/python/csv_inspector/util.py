@@ -16,56 +16,24 @@
 #  You should have received a copy of the GNU General Public License along with
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
-import sys
+import itertools
 import string
+from array import array
 from typing import (Union, Tuple, List, NewType, Callable, Any, Type,
                     Collection, Generic, TypeVar, Sequence, Sized, Iterable,
-                    Iterator, Container)
+                    Iterator, Container, Optional, Dict)
 
 from mcsv.field_description import FieldDescription, DataType, \
     data_type_to_python_type
 from mcsv.field_processors import ReadError
 
-try:
-    TOKEN
-except NameError:
-    if len(sys.argv) > 1:
-        TOKEN = sys.argv[1]
-    else:
-        TOKEN = None
-
-BEGIN_SCRIPT = f"{TOKEN}begin script"
-END_SCRIPT = f"{TOKEN}end script"
-
-
-def begin_info():
-    print(f"{TOKEN}begin info")
-
-
-def end_info():
-    print(f"{TOKEN}end info", flush=True)
-
-
-def begin_csv():
-    print(f"{TOKEN}begin csv")
-
-
-def end_csv():
-    print(f"{TOKEN}end csv", flush=True)
-
-
-def executed():
-    print(f"{TOKEN}executed", flush=True)
-    print(f"{TOKEN}executed", file=sys.stderr, flush=True)
-
-
-def missing_mcsv(csv_path):
-    print(f"{TOKEN}missing csv:{csv_path}")
-
-
-def execute_script(script, vars):
-    vars["TOKEN"] = TOKEN
-    exec(script, vars)
+# the protocol is in a module without dependencies: the server imports it
+# at startup
+from csv_inspector.protocol import (TOKEN, BEGIN_SCRIPT, END_SCRIPT,
+                                    ACCEPT_FRAMES, begin_info, end_info,
+                                    begin_csv, end_csv, executed,
+                                    accept_frames, frames_accepted,
+                                    send_frame, missing_mcsv, execute_script)
 
 
 def sanitize(text: str) -> str:
@@ -105,6 +73,20 @@ def to_standard(text: str) -> str:
     return "".join(filter(remove_chars, text))
 
 
+def get_return_type(func, default_type):
+    """
+    >>> def f(x) -> int: pass
+    >>> get_return_type(f, str)
+    <class 'int'>
+    >>> get_return_type(len, str)
+    <class 'str'>
+    """
+    try:
+        return func.__annotations__['return']
+    except (KeyError, AttributeError):
+        return default_type
+
+
 SomeIndices = NewType("SomeIndices",
                       Union[Tuple[Union[slice, int]], slice, int])
 
@@ -141,10 +123,475 @@ def to_indices(length: int,
 S = TypeVar('S')
 ColInfo = Union[FieldDescription, DataType, Type]
 
+MAX_CATEGORIES = 1 << 16
+VALID = 0
+NULL = 1
+ERROR = 2
+VALIDITY_TABLE = bytes([1] + [0] * 255)  # VALID -> 1, NULL or ERROR -> 0
+TYPECODE_BY_TYPE = {bool: 'b', int: 'q', float: 'd'}
+
+
+class TypedValues(Sequence):
+    """
+    A compact sequence of bool, int or float values: the values are stored
+    in an `array` and the invalid slots in a separate map (one byte per
+    slot: `NULL` or `ERROR`). The `ReadError`s are stored by index.
+
+    >>> values = TypedValues.create(int, [1, None, 3])
+    >>> values
+    TypedValues(<class 'int'>, [1, None, 3])
+    >>> list(values) == [1, None, 3]
+    True
+    >>> values[1:]
+    TypedValues(<class 'int'>, [None, 3])
+    >>> values.null_count(), list(values.valid_values())
+    (1, [1, 3])
+    >>> TypedValues.create(int, [1, "a"])
+    [1, 'a']
+    """
+
+    @staticmethod
+    def create(col_type: Type, values: Collection[Any]) -> Collection[Any]:
+        """
+        Return a `TypedValues` if the values can be stored in an array, else
+        the values.
+        """
+        if isinstance(values, TypedValues):
+            if values._col_type == col_type:
+                return values
+            values = list(values)
+
+        try:
+            typecode = TYPECODE_BY_TYPE[col_type]
+        except (KeyError, TypeError):  # unhashable col_type
+            return values
+
+        value_types = set(map(type, values))
+        has_nulls = type(None) in value_types
+        value_types.discard(type(None))
+        error_types = {t for t in value_types if issubclass(t, ReadError)}
+        value_types -= error_types
+        if value_types - {col_type}:  # bool in an int column...
+            return values
+
+        if has_nulls or error_types:
+            invalid = bytearray([VALID if type(v) is col_type
+                                 else NULL if v is None else ERROR
+                                 for v in values])
+            errors = {i: v for i, v in enumerate(values)
+                      if isinstance(v, ReadError)} or None
+            dense_values = [v if type(v) is col_type else 0 for v in values]
+        else:
+            invalid = None
+            errors = None
+            dense_values = values
+        try:
+            return TypedValues(col_type, array(typecode, dense_values),
+                               invalid, errors)
+        except OverflowError:  # big integers
+            return values
+
+    def __init__(self, col_type: Type, values: array,
+                 invalid: Optional[bytearray],
+                 errors: Optional[Dict[int, Any]] = None):
+        self._col_type = col_type
+        self._values = values
+        self._invalid = invalid
+        self._errors = errors
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._slice(item)
+        if self._invalid is not None and self._invalid[item]:
+            if self._invalid[item] == NULL:
+                return None
+            return self._errors[range(len(self._values))[item]]
+        v = self._values[item]
+        if self._col_type is bool:
+            return bool(v)
+        return v
+
+    def _slice(self, item: slice) -> "TypedValues":
+        if self._invalid is None:
+            return TypedValues(self._col_type, self._values[item], None)
+        errors = None
+        if self._errors is not None:
+            errors = {j: self._errors[i] for j, i in
+                      enumerate(range(len(self._values))[item])
+                      if i in self._errors} or None
+        return TypedValues(self._col_type, self._values[item],
+                           self._invalid[item], errors)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._col_type is bool:
+            values = map(bool, self._values)
+        else:
+            values = iter(self._values)
+        if self._invalid is None:
+            return values
+        if self._errors is None:
+            return (None if n else v for v, n in zip(values, self._invalid))
+        return (v if n == VALID else None if n == NULL else self._errors[i]
+                for i, (v, n) in enumerate(zip(values, self._invalid)))
+
+    def valid_values(self) -> Iterator[Any]:
+        """
+        :return: the values that are neither null nor errors.
+        """
+        if self._col_type is bool:
+            values = map(bool, self._values)
+        else:
+            values = iter(self._values)
+        if self._invalid is None:
+            return values
+        return itertools.compress(values,
+                                  self._invalid.translate(VALIDITY_TABLE))
+
+    def null_count(self) -> int:
+        if self._invalid is None:
+            return 0
+        return self._invalid.count(NULL)
+
+    def error_count(self) -> int:
+        if self._errors is None:
+            return 0
+        return len(self._errors)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, TypedValues):
+            return (self._values == other._values
+                    and self._invalid_map() == other._invalid_map()
+                    and (self._errors or {}) == (other._errors or {}))
+        try:
+            return len(self) == len(other) and all(
+                v == w for v, w in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def _invalid_map(self) -> bytes:
+        if self._invalid is None:
+            return bytes(len(self._values))
+        return bytes(self._invalid)
+
+    def __repr__(self):
+        return f"TypedValues({self._col_type}, {list(self)})"
+
+    def extend(self, other: "TypedValues"):
+        """
+        Append the values of another `TypedValues` of the same type.
+        """
+        if other._invalid is not None and self._invalid is None:
+            self._invalid = bytearray(len(self._values))
+        if self._invalid is not None:
+            if other._invalid is None:
+                self._invalid.extend(bytes(len(other._values)))
+            else:
+                self._invalid.extend(other._invalid)
+        if other._errors is not None:
+            if self._errors is None:
+                self._errors = {}
+            offset = len(self._values)
+            for i, error in other._errors.items():
+                self._errors[offset + i] = error
+        self._values.extend(other._values)
+
+    def buffers(self) -> Tuple[array, Optional[bytearray]]:
+        """
+        :return: the array of values and the map of invalid slots (`NULL` or
+        `ERROR`), or None if all slots are valid. The buffers are not
+        copied.
+        """
+        return self._values, self._invalid
+
+    def copy(self) -> "TypedValues":
+        return TypedValues(self._col_type, array(self._values.typecode,
+                                                 self._values),
+                           None if self._invalid is None else bytearray(
+                               self._invalid),
+                           None if self._errors is None else dict(
+                               self._errors))
+
+
+class CategoricalValues(Sequence):
+    """
+    A dictionary encoded sequence of values: the distinct values (the
+    categories) are sorted and the values are stored as an array of codes,
+    -1 for a null. The codes are in the order of the values: the sort, the
+    grouping and the equality may use the codes.
+
+    >>> values = CategoricalValues.create(["b", "a", None, "b"])
+    >>> values
+    CategoricalValues(['b', 'a', None, 'b'])
+    >>> values.categories, list(values.codes)
+    (['a', 'b'], [1, 0, -1, 1])
+    >>> values.encode(["a", None])
+    CategoricalValues(['a', None])
+    >>> CategoricalValues.create(["a", 1])
+    ['a', 1]
+    """
+
+    @staticmethod
+    def create(values: Collection[Any],
+               max_categories: int = MAX_CATEGORIES) -> Collection[Any]:
+        """
+        Return a `CategoricalValues` if the values are hashable, sortable,
+        and there are at most `max_categories` distinct values, else the
+        values.
+        """
+        if isinstance(values, CategoricalValues):
+            return values
+        builder = CategoricalValuesBuilder(max_categories)
+        if not builder.extend(values):
+            return values
+        categorical_values = builder.build()
+        if categorical_values is None:
+            return values
+        return categorical_values
+
+    def __init__(self, categories: List[Any], codes: array):
+        self._categories = categories
+        self._codes = codes
+
+    @property
+    def categories(self) -> List[Any]:
+        return self._categories
+
+    @property
+    def codes(self) -> array:
+        return self._codes
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return CategoricalValues(self._categories, self._codes[item])
+        code = self._codes[item]
+        if code == -1:
+            return None
+        return self._categories[code]
+
+    def __iter__(self) -> Iterator[Any]:
+        return map(self.lookup_table().__getitem__, self._codes)
+
+    def lookup_table(self) -> List[Any]:
+        """
+        :return: the list of the values by code (the code -1 gives the last
+        item: None)
+        """
+        return self._categories + [None]
+
+    def __eq__(self, other: Any) -> bool:
+        try:
+            return len(self) == len(other) and all(
+                v == w for v, w in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"CategoricalValues({list(self)})"
+
+    def from_codes(self, codes: Iterable[int]) -> "CategoricalValues":
+        return CategoricalValues(self._categories, array("i", codes))
+
+    def encode(self, values: Iterable[Any], col_type: Type = str
+               ) -> Collection[Any]:
+        """
+        Encode some values with the categories of this object. If a value is
+        not a category, the values are stored as the values of a new column
+        (see `ColumnBuilder`): new categories for low cardinality texts,
+        else typed values.
+
+        >>> values = CategoricalValues.create(["a", "b", "a"])
+        >>> values.encode(["c", "c", None])
+        CategoricalValues(['c', 'c', None])
+        >>> values.encode([1, 1, 1], int)
+        TypedValues(<class 'int'>, [1, 1, 1])
+        >>> values.encode(["x", "y", "z"])
+        ['x', 'y', 'z']
+        """
+        code_by_value = {v: i for i, v in enumerate(self._categories)}
+        code_by_value[None] = -1
+        values = list(values)
+        try:
+            codes = array("i", [code_by_value[v] for v in values])
+        except (KeyError, TypeError):  # unknown or unhashable value
+            return _encode_new_values(col_type, values)
+        return CategoricalValues(self._categories, codes)
+
+    def translate(self, other: "CategoricalValues") -> array:
+        """
+        :return: the codes of the other values, translated to the codes of
+        this object, -2 if the value is not a category of this object.
+        """
+        code_by_value = {v: i for i, v in enumerate(self._categories)}
+        table = [code_by_value.get(v, -2) for v in other._categories] + [-1]
+        return array("i", map(table.__getitem__, other._codes))
+
+    def valid_values(self) -> Iterator[Any]:
+        """
+        :return: the values that are not null.
+        """
+        return map(self._categories.__getitem__,
+                   filter((-1).__ne__, self._codes))
+
+    def null_count(self) -> int:
+        return self._codes.count(-1)
+
+    def take(self, indices: Iterable[int]) -> "CategoricalValues":
+        codes = self._codes
+        return self.from_codes([codes[i] for i in indices])
+
+    def compress(self, mask: Iterable[Any]) -> "CategoricalValues":
+        return self.from_codes(itertools.compress(self._codes, mask))
+
+    def copy(self) -> "CategoricalValues":
+        return CategoricalValues(self._categories, array("i", self._codes))
+
+
+class CategoricalValuesBuilder:
+    """
+    Encode values batch by batch.
+    """
+
+    def __init__(self, max_categories: int = MAX_CATEGORIES):
+        self._max_categories = max_categories
+        self._code_by_value = {None: -1}
+        self._codes = array("i")
+
+    def extend(self, values: Iterable[Any]) -> bool:
+        """
+        :return: False if the values can't be encoded.
+        """
+        code_by_value = self._code_by_value
+        try:
+            codes = [code_by_value.setdefault(v, len(code_by_value) - 1)
+                     for v in values]
+        except TypeError:  # unhashable
+            return False
+        if len(code_by_value) - 1 > self._max_categories:
+            return False
+        self._codes.extend(codes)
+        return True
+
+    def values(self) -> List[Any]:
+        """
+        :return: the list of the values
+        """
+        table = list(self._code_by_value)[1:] + [None]
+        return list(map(table.__getitem__, self._codes))
+
+    def build(self) -> Optional[CategoricalValues]:
+        """
+        :return: the values with sorted categories, or None if the values
+        are not sortable.
+        """
+        categories = list(self._code_by_value)[1:]
+        try:
+            order = sorted(range(len(categories)), key=categories.__getitem__)
+        except TypeError:
+            return None
+        new_code_by_code = [0] * len(categories) + [-1]
+        for new_code, code in enumerate(order):
+            new_code_by_code[code] = new_code
+        return CategoricalValues(
+            [categories[code] for code in order],
+            array("i", map(new_code_by_code.__getitem__, self._codes)))
+
+    def is_low_cardinality(self) -> bool:
+        return (len(self._code_by_value) - 1) * 2 <= len(self._codes)
+
+
+def _encode_new_values(col_type: Type, values: List[Any]
+                       ) -> Collection[Any]:
+    if col_type is str and all(v is None or type(v) is str for v in values):
+        builder = CategoricalValuesBuilder()
+        if builder.extend(values) and builder.is_low_cardinality():
+            categorical_values = builder.build()
+            if categorical_values is not None:
+                return categorical_values
+    return TypedValues.create(col_type, values)
+
+
+def compress_values(col_values: Collection[Any],
+                    mask: Iterable[Any]) -> Collection[Any]:
+    if isinstance(col_values, CategoricalValues):
+        return col_values.compress(mask)
+    return list(itertools.compress(col_values, mask))
+
+
+def take_values(col_values: Collection[Any],
+                indices: Iterable[int]) -> Collection[Any]:
+    if isinstance(col_values, CategoricalValues):
+        return col_values.take(indices)
+    return [col_values[i] for i in indices]
+
+
+def valid_values(col_values: Collection[Any]) -> Iterator[Any]:
+    """
+    :return: the values that are neither null nor errors.
+    """
+    if isinstance(col_values, (TypedValues, CategoricalValues)):
+        return col_values.valid_values()
+    return (v for v in col_values
+            if not (v is None or isinstance(v, ReadError)))
+
+
+def count_nulls(col_values: Collection[Any]) -> int:
+    """
+    >>> count_nulls([1, None, 2])
+    1
+    >>> count_nulls(TypedValues.create(int, [None, 1]))
+    1
+    """
+    if isinstance(col_values, (TypedValues, CategoricalValues)):
+        return col_values.null_count()
+    return sum(v is None for v in col_values)
+
+
+def key_values(col_values: Collection[Any], ordered: bool = False
+               ) -> Collection[Any]:
+    """
+    :param ordered: True if the keys are sorted. The code of a null is -1,
+    but a null is not comparable to a value: the codes are returned only if
+    there is no null, hence the sort fails whatever the storage.
+    :return: the codes if the values are categorical, else the values. The
+    codes have the same order and the same equality as the values.
+
+    >>> values = CategoricalValues.create(["b", None, "a"])
+    >>> list(key_values(values))
+    [1, -1, 0]
+    >>> key_values(values, ordered=True)
+    CategoricalValues(['b', None, 'a'])
+    """
+    if isinstance(col_values, CategoricalValues) and not (
+            ordered and col_values.null_count()):
+        return col_values.codes
+    return col_values
+
 
 class Column(Generic[S]):
     """
     We try to keed the column description.
+
+    Bool, int and float values are stored in a `TypedValues` object. The
+    values of a categorical column (see `CategoricalValues`) stay encoded
+    when they are replaced.
+
+    The version is incremented every time the values are replaced: the
+    `stats_cache` stores the stats by version.
+
+    The values of a deferred column are loaded on the first access.
+
+    >>> column = Column("A", int, [1, 2])
+    >>> column.version
+    1
+    >>> column.col_values = [3]
+    >>> column.version
+    2
     """
 
     def __init__(self, name: str, col_info: ColInfo,
@@ -163,8 +610,45 @@ class Column(Generic[S]):
                        ), f"Expected {self.col_type}, got {set(type(v) for v in col_values)}"
         self.name = name
         self.col_info = col_info
+        self.version = 0
+        self.stats_cache: Dict[Tuple, Any] = {}
+        self._load = None
         self.col_values = col_values
 
+    @staticmethod
+    def deferred(name: str, col_info: ColInfo,
+                 load: Callable[[], Collection[S]]) -> "Column":
+        """
+        :param load: a function that returns the values. It is called on the
+        first access to the values.
+
+        >>> column = Column.deferred("A", int, lambda: [1, 2])
+        >>> column.version, column.col_values, column.version
+        (1, TypedValues(<class 'int'>, [1, 2]), 1)
+        """
+        column = Column(name, col_info, [])
+        column._load = load
+        return column
+
+    @property
+    def col_values(self) -> Collection[S]:
+        if self._load is not None:
+            load, self._load = self._load, None
+            self._col_values = TypedValues.create(self.col_type, load())
+        return self._col_values
+
+    @col_values.setter
+    def col_values(self, col_values: Collection[S]):
+        self._load = None
+        old_col_values = getattr(self, "_col_values", None)
+        if (isinstance(old_col_values, CategoricalValues)
+                and not isinstance(col_values, CategoricalValues)):
+            self._col_values = old_col_values.encode(col_values,
+                                                     self.col_type)
+        else:
+            self._col_values = TypedValues.create(self.col_type, col_values)
+        self.version += 1
+
     def standard_name(self):
         return to_standard(self.name)
 
@@ -175,9 +659,15 @@ class Column(Generic[S]):
         return len(self.col_values)
 
     def __eq__(self, other: Any) -> bool:
+        if type(self.col_values) == type(other.col_values):
+            values_eq = self.col_values == other.col_values
+        else:  # a list and a tuple are not equal
+            values_eq = (len(self.col_values) == len(other.col_values)
+                         and all(v == w for v, w in
+                                 zip(self.col_values, other.col_values)))
         return (self.name == other.name
                 and self.col_type == other.col_type
-                and self.col_values == other.col_values)
+                and values_eq)
 
     def __repr__(self):
         return f"Column({self.name}, {self.col_info}, {self.col_values}"
@@ -186,7 +676,70 @@ class Column(Generic[S]):
         return max(len(self.name), *(len(str(v)) for v in self.col_values))
 
     def copy(self):
-        return Column(self.name, self.col_info, list(self.col_values))
+        if self._load is not None:
+            return Column.deferred(self.name, self.col_info, self._load)
+        if isinstance(self.col_values, (TypedValues, CategoricalValues)):
+            col_values = self.col_values.copy()
+        else:
+            col_values = list(self.col_values)
+        column = Column(self.name, self.col_info, col_values)
+        column.version = self.version
+        column.stats_cache = dict(self.stats_cache)
+        return column
+
+
+class ColumnBuilder:
+    """
+    Build a column batch by batch. Typed values are appended to an array,
+    hence the list of values is never fully materialized. The text values are
+    encoded if there are few distinct values.
+
+    >>> builder = ColumnBuilder("A", int)
+    >>> builder.extend((1, 2))
+    >>> builder.extend((None, 3))
+    >>> builder.build()
+    Column(A, <class 'int'>, TypedValues(<class 'int'>, [1, 2, None, 3])
+    >>> builder = ColumnBuilder("A", int)
+    >>> builder.extend((1, 2))
+    >>> builder.extend((2 ** 70, 3))
+    >>> builder.build()
+    Column(A, <class 'int'>, [1, 2, 1180591620717411303424, 3]
+    >>> builder = ColumnBuilder("A", str)
+    >>> builder.extend(("a", "b", "a", "a"))
+    >>> builder.build()
+    Column(A, <class 'str'>, CategoricalValues(['a', 'b', 'a', 'a'])
+    """
+
+    def __init__(self, name: str, col_info: ColInfo):
+        self._name = name
+        self._col_info = col_info
+        self._col_type = Column(name, col_info, []).col_type
+        if self._col_type is str:
+            self._values = CategoricalValuesBuilder()
+        else:
+            self._values = TypedValues.create(self._col_type, [])
+
+    def extend(self, values: Collection[Any]):
+        if isinstance(self._values, CategoricalValuesBuilder):
+            if self._values.extend(values):
+                return
+            self._values = self._values.values()
+        elif isinstance(self._values, TypedValues):
+            typed_values = TypedValues.create(self._col_type, values)
+            if isinstance(typed_values, TypedValues):
+                self._values.extend(typed_values)
+                return
+            self._values = list(self._values)
+        self._values.extend(values)
+
+    def build(self) -> Column:
+        values = self._values
+        if isinstance(values, CategoricalValuesBuilder):
+            if values.is_low_cardinality():
+                values = values.build() or values.values()
+            else:
+                values = values.values()
+        return Column(self._name, self._col_info, values)
 
 
 class ColumnGroup(Sized):
@@ -218,6 +771,11 @@ class ColumnGroup(Sized):
     def __iter__(self):
         return iter(self.columns)
 
+    def row_count(self) -> int:
+        if not self.columns:
+            return 0
+        return len(self.columns[0])
+
     def rows(self, indices: List[int] = None):
         if indices is None:
             return zip(*self.columns)
@@ -248,6 +806,22 @@ class ColumnGroup(Sized):
         for col, col_values in zip(self.columns, zip(*new_rows)):
             col.col_values = col_values
 
+    def compress_rows(self, mask: Iterable[Any]):
+        """
+        Keep the rows where the mask is true.
+        """
+        mask = list(mask)
+        for col in self.columns:
+            col.col_values = compress_values(col.col_values, mask)
+
+    def take_rows(self, indices: Iterable[int]):
+        """
+        Keep the rows of the given indices, in that order.
+        """
+        indices = list(indices)
+        for col in self.columns:
+            col.col_values = take_values(col.col_values, indices)
+
     def copy(self):
         return ColumnGroup([col.copy() for col in self.columns])
 
@@ -15,13 +15,52 @@
 #  You should have received a copy of the GNU General Public License along with
 #  this program. If not, see <http://www.gnu.org/licenses/>.
 #
+import contextlib
+import datetime
+import io
 import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
-from typing import (Any, Sequence)
+import warnings
+from multiprocessing.connection import wait
+from unittest import mock
+from pathlib import Path
+from decimal import Decimal
+from typing import (Any, Sequence, List)
 
+from mcsv.field_processors import ReadError
+
+from benchmarks.data_benchmarks import run_benchmarks, compare
 from csv_inspector import read_csv
+from csv_inspector.bulk_query_provider import get_provider
+from csv_inspector.cancel import (Cancelled, CHECK_INTERVAL, start_script,
+                                  end_script)
+from csv_inspector.column_cache import evict
+from csv_inspector.cursor import handle_cursor_command, PAGE
 from csv_inspector.data import Data
-from csv_inspector.util import ColumnGroup, Column
+from csv_inspector.frame import encode_frame, decode_frame
+from csv_inspector.pg_copy import (write_data, create_table, SIGNATURE,
+                                   TRAILER)
+from csv_inspector.incremental import SnapshotCache, execute_incrementally
+from csv_inspector.instrument import enable_profiling, disable_profiling
+from csv_inspector.server import Server, SESSION, CANCEL, TIMINGS
+from csv_inspector.stats import column_stats, columns_stats
+from csv_inspector.util import (ColumnGroup, Column, TypedValues,
+                                ColumnBuilder, CategoricalValues,
+                                accept_frames, TOKEN, MAX_CATEGORIES,
+                                BEGIN_SCRIPT, END_SCRIPT)
+
+
+class AReadError(ReadError):
+    def __init__(self):
+        pass
 
 
 class ColumnTest(unittest.TestCase):
@@ -29,6 +68,88 @@ class ColumnTest(unittest.TestCase):
         self.assertEqual(Column("colA", int, [1, 2, 3]),
                          Column("colA", int, [1, 2, 3]))
 
+    def test_col_typed_values(self):
+        for col_type, values in ((int, [1, None, 3]),
+                                 (float, [None, 2.5, -1.0]),
+                                 (bool, [True, None, False])):
+            column = Column("colA", col_type, values)
+            self.assertIsInstance(column.col_values, TypedValues)
+            self.assertEqual(values, list(column))
+            self.assertEqual(3, len(column))
+            self.assertEqual(Column("colA", col_type, tuple(values)), column)
+
+    def test_col_invalid_values(self):
+        values = [AReadError(), 1, None, 3, None]
+        column = Column("colA", int, values)
+        self.assertIsInstance(column.col_values, TypedValues)
+        self.assertEqual(values, list(column))
+        self.assertEqual(2, column.col_values.null_count())
+        self.assertEqual(1, column.col_values.error_count())
+        self.assertEqual([1, 3], list(column.col_values.valid_values()))
+        self.assertEqual(values[2:], list(column.col_values[2:]))
+
+    def test_col_untyped_values(self):
+        self.assertEqual([1, 2 ** 70],
+                         Column("colA", int, [1, 2 ** 70]).col_values)
+        self.assertEqual(["a", None],
+                         Column("colA", str, ["a", None]).col_values)
+
+
+class CategoricalValuesTest(unittest.TestCase):
+    def test_encode(self):
+        values = CategoricalValues.create(["b", None, "a", "b"])
+        self.assertEqual(["a", "b"], values.categories)
+        self.assertEqual([1, -1, 0, 1], list(values.codes))
+        self.assertEqual(["b", None, "a", "b"], list(values))
+        self.assertEqual([1, 1, 0], list(values.encode(["b", "b", "a"]).codes))
+        self.assertEqual(["c", "a"], list(values.encode(["c", "a"])))
+
+    def test_column_stays_encoded(self):
+        column = Column("A", str, CategoricalValues.create(["b", "a", "b"]))
+        column.col_values = ["a", None]
+        self.assertIsInstance(column.col_values, CategoricalValues)
+        self.assertEqual(["a", None], list(column.col_values))
+
+    def test_group_result_not_encoded(self):
+        data = data_from_rows((str, str), [("colA", "colB"), ("a", "x"),
+                                           ("b", "y"), ("a", "x")])
+        data._column_group[1].col_values = CategoricalValues.create(
+            ["x", "y", "x"])
+        grouper = data[0].grouper()
+        grouper[1].agg("count")
+        grouper.group()
+        col_values = data._column_group[1].col_values
+        self.assertIsInstance(col_values, TypedValues)
+        self.assertEqual([2, 1], list(col_values))
+
+        column = Column("A", str, CategoricalValues.create(["b", "a", "b"]))
+        column.col_values = ["c", "d", "e"]  # high cardinality
+        self.assertNotIsInstance(column.col_values, CategoricalValues)
+
+    def test_high_cardinality(self):
+        builder = ColumnBuilder("A", str)
+        builder.extend(["a", "b", "c"])
+        self.assertEqual(["a", "b", "c"], builder.build().col_values)
+
+    def test_too_many_categories(self):
+        values = [str(i) for i in range(MAX_CATEGORIES + 1)]
+        builder = ColumnBuilder("A", str)
+        builder.extend(values[:10] * 3)
+        builder.extend(values)
+        self.assertEqual(values[:10] * 3 + values, builder.build().col_values)
+
+
+class ColumnBuilderTest(unittest.TestCase):
+    def test_build_by_chunks(self):
+        for col_type, chunks in ((int, [(1, 2), (None,), (3,)]),
+                                 (str, [("a",), ("b", None)]),
+                                 (int, [(1, None), (2 ** 70,)])):
+            builder = ColumnBuilder("colA", col_type)
+            for chunk in chunks:
+                builder.extend(chunk)
+            values = [v for chunk in chunks for v in chunk]
+            self.assertEqual(values, list(builder.build()))
+
 
 class ColumnGroupTest(unittest.TestCase):
     def test_from_rows(self):
@@ -39,6 +160,420 @@ class ColumnGroupTest(unittest.TestCase):
                                       Column("colB", str, ["a", "b", "c"])]), c)
 
 
+class StatsTest(unittest.TestCase):
+    def test_column_stats(self):
+        values = [((i * 7919) % 1000) / 10 for i in range(200000)]
+        values[3] = None
+        vs = [v for v in values if v is not None]
+        column = Column("colA", float, values)
+
+        stats = column_stats(column.col_values, float)
+        self.assertEqual(1, stats.null_count)
+        self.assertEqual(len(vs), stats.count)
+        self.assertEqual((min(vs), max(vs)), (stats.min, stats.max))
+        self.assertAlmostEqual(statistics.mean(vs), stats.mean)
+        self.assertAlmostEqual(statistics.variance(vs), stats.variance)
+        self.assertEqual(statistics.median(vs), stats.median)
+
+        stats = column_stats(column.col_values, float, "tdigest")
+        self.assertAlmostEqual(statistics.median(vs), stats.median, delta=1)
+
+    def test_column_stats_exact(self):
+        values = [Decimal("1.5"), None, Decimal("2.5"), Decimal("4.25")]
+        vs = [v for v in values if v is not None]
+        stats = column_stats(TypedValues.create(Decimal, values), Decimal)
+        self.assertEqual(statistics.mean(vs), stats.mean)
+        self.assertIsInstance(stats.mean, Decimal)
+        self.assertEqual(statistics.variance(vs), stats.variance)
+
+        stats = column_stats([1, 2, 3], int)
+        self.assertEqual((2, 1), (stats.mean, stats.variance))
+        self.assertIsInstance(stats.mean, int)
+
+    def test_columns_stats_workers(self):
+        columns = [Column("colA", int, [1, 2, None]),
+                   Column("colB", str, ["a", None, None]),
+                   Column("colC", float, [0.5, 1.5, 2.5])]
+        expected = [repr(stats) for stats in columns_stats(columns)]
+        self.assertEqual(expected, [repr(stats) for stats in
+                                    columns_stats(columns, workers=2)])
+
+    def test_columns_stats_cache(self):
+        data = data_from_rows((int, int, str),
+                              [("colA", "colB", "colC"),
+                               (1, 2, "a"), (3, 4, "b"), (5, 6, None)])
+        columns = data._column_group.columns
+        stats_list = columns_stats(columns)
+        data[1].update(lambda x: x * 2)
+        columns = data._column_group.columns
+        new_stats_list = columns_stats(columns)
+        self.assertIs(stats_list[0], new_stats_list[0])
+        self.assertIsNot(stats_list[1], new_stats_list[1])
+        self.assertEqual(12, new_stats_list[1].max)
+        self.assertIs(stats_list[2], new_stats_list[2])
+
+        data[0].filter(lambda x: x > 1)
+        self.assertTrue(all(
+            old is not new for old, new in zip(
+                new_stats_list, columns_stats(data._column_group.columns))))
+
+
+class FrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [TypedValues.create(bool, [True, None, False]),
+                  TypedValues.create(int, [1, 2 ** 40, None]),
+                  TypedValues.create(float, [0.5, None, -1e300]),
+                  CategoricalValues.create(["b", None, "a"]),
+                  ["é", None, ""],
+                  [1, "a", None]]
+        frame = encode_frame([f"col{i}" for i in range(len(values))],
+                             ["t"] * len(values), values)
+        self.assertEqual(
+            [[True, None, False], [1, 2 ** 40, None], [0.5, None, -1e300],
+             ["b", None, "a"], ["é", None, ""], ["1", "a", None]],
+            [column_values for _, _, column_values in decode_frame(frame)])
+
+        frame = encode_frame(["A"], ["t"], [values[1]], limit=2)
+        self.assertEqual([("A", "t", [1, 2 ** 40])], decode_frame(frame))
+
+    def test_exact_values(self):
+        values = [Decimal("1.10"), datetime.datetime(2020, 1, 2, 3, 4, 5),
+                  ReadError("x"), None, 2 ** 70]
+        frame = encode_frame(["A"], ["t"], [values], exact=True)
+        self.assertEqual([("A", "t", values)], decode_frame(frame))
+        with self.assertRaises(TypeError):
+            encode_frame(["A"], ["t"], [[object()]], exact=True)
+
+    def test_show_stats(self):
+        data = data_from_rows((int, str), [("colA", "colB"), (1, "a"),
+                                           (None, "b"), (3, "c")])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            channel_path = Path(tmpdir, "channel")
+            accept_frames(str(channel_path))
+            try:
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    data.show(limit=2)
+                    data.stats()
+            finally:
+                accept_frames(None)
+            frames = channel_path.read_bytes()
+
+        sizes = [int(line.rsplit(":", 1)[1])
+                 for line in out.getvalue().splitlines() if "frame:" in line]
+        self.assertEqual(len(frames), sum(sizes))
+        self.assertEqual([("colA", "<class 'int'>", [1, None]),
+                          ("colB", "<class 'str'>", ["a", "b"])],
+                         decode_frame(frames[:sizes[0]]))
+        stats = decode_frame(frames[sizes[0]:])
+        self.assertEqual(["line count", "column count", "column 0",
+                          "column 1"], stats[0][2])
+        self.assertEqual(["-", "-", "1", "0"], stats[3][2])
+
+
+class PGCopyTest(unittest.TestCase):
+    def test_write_data(self):
+        data = data_from_rows(
+            (int, Decimal, datetime.date, bool, str),
+            [("id", "amount", "day", "flag", "label"),
+             (1, Decimal("12.50"), datetime.date(2000, 1, 3), True, "é"),
+             (None, None, None, None, None)])
+        self.assertEqual(
+            'CREATE TABLE "t" ("id" bigint, "amount" numeric, "day" date, '
+            '"flag" boolean, "label" text);', create_table(data, "t"))
+        stream = io.BytesIO()
+        writer = write_data(data, stream)
+        self.assertEqual((2, 0), (writer.row_count, writer.error_count))
+        self.assertEqual(
+            SIGNATURE + bytes(8)
+            + bytes.fromhex("0005"
+                            "00000008 0000000000000001"
+                            "0000000c 0002 0000 0000 0002 000c 1388"
+                            "00000004 00000002"
+                            "00000001 01"
+                            "00000002 c3a9")
+            + bytes.fromhex("0005" + "ffffffff" * 5)
+            + TRAILER, stream.getvalue())
+
+
+class CursorTest(unittest.TestCase):
+    def test_pages(self):
+        data = data_from_rows((int, str), [("colA", "colB"), (2, "a"),
+                                           (None, "b"), (3, "c"), (1, "b")])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            cursor_id = data.show(limit=1)
+        self.assertEqual(f"{TOKEN}cursor:{cursor_id}:4",
+                         out.getvalue().splitlines()[0])
+        data[0].update(lambda x: x and x * 10)  # not seen by the cursor
+
+        def page(command: str) -> List[str]:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertTrue(
+                    handle_cursor_command(f"{PAGE}{cursor_id}:{command}"))
+            lines = out.getvalue().splitlines()
+            return lines[4:lines.index(f"{TOKEN}end csv")]
+
+        self.assertEqual(["3,c", "1,b"], page("2:5"))
+        self.assertEqual(["3,c", "2,a", "1,b"], page("0:3:-0"))
+        self.assertEqual(["2,a", ",b", "1,b", "3,c"], page("0:4:1"))
+
+    def test_page_mixed_types(self):
+        data = data_from_rows((Any,), [("colA",), ("b",), (ReadError("x"),),
+                                       (2,), (None,), (1.5,)])
+        with contextlib.redirect_stdout(io.StringIO()):
+            cursor_id = data.show()
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            handle_cursor_command(f"{PAGE}{cursor_id}:0:5:0")
+            handle_cursor_command(f"{PAGE}{cursor_id}:0:5:x")
+        lines = out.getvalue().splitlines()
+        self.assertEqual(["1.5", "2", "b"], lines[4:7])
+        self.assertEqual(2, lines.count(f"{TOKEN}executed"))
+        self.assertIn("Bad page command", err.getvalue())
+
+
+class ServerTest(unittest.TestCase):
+    def test_sessions(self):
+        out, err = io.StringIO(), io.StringIO()
+        server = Server(out, err)
+        try:
+            for line in [BEGIN_SCRIPT, "import time; time.sleep(0.5); x = 1",
+                         END_SCRIPT, f"{SESSION}b", BEGIN_SCRIPT, "print(x)",
+                         END_SCRIPT, f"{SESSION}", BEGIN_SCRIPT,
+                         "print('x =', x + 1)", END_SCRIPT]:
+                server.handle_line(line)
+            while out.getvalue().count(f"{TOKEN}executed") < 3:
+                connections = wait(server.connections(), 10)
+                self.assertTrue(connections)
+                for connection in connections:
+                    server.forward(connection)
+        finally:
+            server.close()
+
+        lines = out.getvalue().splitlines()
+        # the session "b" is not blocked by the default session
+        self.assertEqual(f"{SESSION}b", lines[0])
+        self.assertIn("NameError", err.getvalue())
+        self.assertEqual(f"{SESSION}",
+                         lines[lines.index(f"{TOKEN}executed") + 1])
+        self.assertIn("x = 2", lines)
+
+    def test_cancel(self):
+        out, err = io.StringIO(), io.StringIO()
+        server = Server(out, err)
+        try:
+            for line in [BEGIN_SCRIPT, "import time",
+                         "from csv_inspector.cancel import check",
+                         "print('started', flush=True)",
+                         "while True: time.sleep(0.01); check()",
+                         END_SCRIPT]:
+                server.handle_line(line)
+            while "started" not in out.getvalue():
+                for connection in wait(server.connections(), 10):
+                    server.forward(connection)
+            server.handle_line(CANCEL)
+            while f"{TOKEN}executed" not in err.getvalue():
+                connections = wait(server.connections(), 10)
+                self.assertTrue(connections)
+                for connection in connections:
+                    server.forward(connection)
+        finally:
+            server.close()
+
+        self.assertIn("server/script cancelled: cancelled", err.getvalue())
+
+    def test_cancel_queued_script(self):
+        out, err = io.StringIO(), io.StringIO()
+        server = Server(out, err)
+        try:
+            for line in [BEGIN_SCRIPT, "import time; time.sleep(0.3)",
+                         END_SCRIPT, BEGIN_SCRIPT,
+                         "from csv_inspector.cancel import check",
+                         "while True: time.sleep(0.01); check()",
+                         END_SCRIPT, CANCEL, BEGIN_SCRIPT,
+                         "print('after'); check()", END_SCRIPT]:
+                server.handle_line(line)
+            while err.getvalue().count(f"{TOKEN}executed") < 3:
+                connections = wait(server.connections(), 10)
+                self.assertTrue(connections)
+                for connection in connections:
+                    server.forward(connection)
+        finally:
+            server.close()
+
+        self.assertEqual(1, err.getvalue().count("server/script cancelled"))
+        self.assertIn("after", out.getvalue().splitlines())
+
+    def test_pool_in_session(self):
+        out, err = io.StringIO(), io.StringIO()
+        server = Server(out, err)
+        try:
+            for line in [BEGIN_SCRIPT,
+                         "from csv_inspector.util import ColumnGroup, Column",
+                         "from csv_inspector.data import Data",
+                         "data = Data(ColumnGroup(["
+                         "Column('k', int, [i % 3 for i in range(30)]), "
+                         "Column('v', int, list(range(30)))]), None)",
+                         "g = data[0].grouper()", "g[1].agg('count')",
+                         "g.group(workers=2)",
+                         "print(list(data._column_group[1]))",
+                         END_SCRIPT]:
+                server.handle_line(line)
+            while f"{TOKEN}executed" not in err.getvalue():
+                connections = wait(server.connections(), 10)
+                self.assertTrue(connections)
+                for connection in connections:
+                    server.forward(connection)
+        finally:
+            server.close()
+
+        self.assertNotIn("daemonic", err.getvalue())
+        self.assertIn("[10, 10, 10]", out.getvalue().splitlines())
+
+    def test_standby_worker(self):
+        out, err = io.StringIO(), io.StringIO()
+        server = Server(out, err)
+        try:
+            while "import csv_inspector.inspector" not in server.timings:
+                connections = wait(server.connections(), 10)
+                self.assertTrue(connections)
+                for connection in connections:
+                    server.forward(connection)
+            for line in [BEGIN_SCRIPT, "import sys",
+                         "print('mcsv' in sys.modules)", END_SCRIPT]:
+                server.handle_line(line)
+            while out.getvalue().count(f"{TOKEN}executed") < 1:
+                for connection in wait(server.connections(), 10):
+                    server.forward(connection)
+            server.handle_line(TIMINGS)
+        finally:
+            server.close()
+
+        lines = out.getvalue().splitlines()
+        # the session took the warm standby worker
+        self.assertIn("True", lines)
+        self.assertTrue(any(line.startswith("import csv_inspector.inspector:")
+                            for line in lines))
+
+    def test_light_imports(self):
+        output = subprocess.run(
+            [sys.executable, "-c", "import sys, csv_inspector.server; "
+                                   "print('mcsv' in sys.modules)"],
+            capture_output=True, text=True, check=True,
+            **subprocess_kwargs()).stdout
+        self.assertEqual("False", output.strip())
+
+    def test_terminate(self):
+        worker_pid = self._stop_server(["while True: pass"],
+                                       subprocess.Popen.terminate)
+        self._assert_process_ends(worker_pid)
+
+    def test_orphan_worker(self):
+        worker_pid = self._stop_server(
+            ["from csv_inspector.cancel import check", "while True: check()"],
+            subprocess.Popen.kill)
+        self._assert_process_ends(worker_pid)
+
+    def _stop_server(self, script_lines, stop) -> int:
+        """
+        Run the script in a server process and stop the server.
+
+        :return: the pid of the worker
+        """
+        process = subprocess.Popen(
+            [sys.executable, "-m", "csv_inspector", "@@"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+            **subprocess_kwargs())
+        watchdog = threading.Timer(30, process.kill)
+        watchdog.start()
+        try:
+            process.stdin.write("\n".join(
+                ["@@begin script", "import os",
+                 "print('pid', os.getpid(), flush=True)", *script_lines,
+                 "@@end script", ""]))
+            process.stdin.flush()
+            line = process.stdout.readline()
+            while line and not line.startswith("pid "):
+                line = process.stdout.readline()
+            stop(process)
+            process.wait(10)
+        finally:
+            watchdog.cancel()
+            process.kill()
+            process.stdin.close()
+            process.stdout.close()
+        return int(line.split()[1])
+
+    def _assert_process_ends(self, pid: int):
+        deadline = time.monotonic() + 10
+        with self.assertRaises(ProcessLookupError):
+            while time.monotonic() < deadline:
+                os.kill(pid, 0)
+                time.sleep(0.05)
+
+
+class IncrementalTest(unittest.TestCase):
+    def test_resume(self):
+        calls = []
+        snapshots = SnapshotCache()
+        namespace = {"read": lambda: calls.append(1) or data_from_rows(
+            (int,), [("colA",), (1,), (2,)])}
+        script = "data = read()\ndata[0].update(lambda x: x + 1)"
+        self.assertEqual(0, execute_incrementally(script, namespace,
+                                                  snapshots, 0))
+        self.assertEqual(2, len(snapshots))
+
+        script += "\ndata[0].update(lambda x: x * 10)"
+        for _ in range(2):  # the snapshots are not modified
+            namespace = {}
+            execute_incrementally(script, namespace, snapshots, 0)
+            self.assertEqual([20, 30],
+                             list(namespace["data"]._column_group[0]))
+        self.assertEqual([1], calls)
+
+        # the output of the skipped statements would be lost
+        with contextlib.redirect_stdout(io.StringIO()):
+            execute_incrementally("print(1)\ny = 2", {}, snapshots, 0)
+        self.assertEqual(3, len(snapshots))
+
+    def test_input_file_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, "a.txt")
+            path.write_text("abc")
+            script = (f"from pathlib import Path\nd = {tmpdir!r}\n"
+                      "n = len(Path(d, 'a.txt').read_text())")
+            snapshots = SnapshotCache()
+            execute_incrementally(script, {}, snapshots, 0)
+            self.assertEqual(3, execute_incrementally(script, {}, snapshots,
+                                                      0))
+            path.write_text("abcd")
+            namespace = {}
+            self.assertEqual(2, execute_incrementally(script, namespace,
+                                                      snapshots, 0))
+            self.assertEqual(4, namespace["n"])
+
+    def test_warning_is_not_an_output(self):
+        snapshots = SnapshotCache()
+        script = "import warnings\nwarnings.warn('w')\nx = 1"
+        with warnings.catch_warnings(), \
+                contextlib.redirect_stderr(io.StringIO()) as err:
+            warnings.simplefilter("always")
+            warnings.showwarning = (
+                lambda message, *args, **kwargs: print(message,
+                                                       file=sys.stderr))
+            execute_incrementally(script, {}, snapshots, 0)
+        self.assertEqual("w\n", err.getvalue())
+        self.assertEqual(3, len(snapshots))
+
+    def test_max_size(self):
+        snapshots = SnapshotCache(1000)
+        script = "x = 'a' * 600\ny = x + 'b'"
+        execute_incrementally(script, {}, snapshots, 0)
+        self.assertEqual(1, len(snapshots))
+
+
 class DataIntegrationTest(unittest.TestCase):
     def setUp(self) -> None:
         os.chdir("../../..")
@@ -48,6 +583,171 @@ class DataIntegrationTest(unittest.TestCase):
         data = read_csv("fixtures/datasets-2020-02-22-12-33.csv")
 
 
+class ReadCSVTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self.csv_path = Path(self._dir.name, "test.csv")
+        lines = ["id;text;value"]
+        for i in range(500):
+            lines.append(f'{i};"line {i}\nwith a ; and a ""quote""";{i * 3}')
+        self.csv_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        self.csv_path.with_suffix(".mcsv").write_text(
+            "domain,key,value\n"
+            "file,encoding,utf-8\n"
+            "csv,delimiter,;\n"
+            "data,col/0/type,integer\n"
+            "data,col/2/type,integer\n", encoding="utf-8")
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_read_by_chunks(self):
+        data = read_csv(self.csv_path, nrows=-1, chunk_size=7)
+        self.assertEqual(list(range(500)), list(data._column_group[0]))
+        self.assertEqual("line 499\nwith a ; and a \"quote\"",
+                         data._column_group[1].col_values[-1])
+
+    def test_read_in_parallel(self):
+        expected = read_csv(self.csv_path, nrows=-1)
+        for workers in (2, 3, 16):
+            data = read_csv(self.csv_path, nrows=-1, workers=workers)
+            self.assertEqual(expected._column_group, data._column_group)
+
+    def test_read_in_parallel_null_value(self):
+        mcsv_path = self.csv_path.with_suffix(".mcsv")
+        mcsv_path.write_text(mcsv_path.read_text(encoding="utf-8")
+                             + "data,null_value,NULL\n", encoding="utf-8")
+        self.csv_path.write_text(
+            "id;text;value\n" + "".join(f"{i};NULL;{i if i % 2 else 'NULL'}\n"
+                                        for i in range(100)),
+            encoding="utf-8")
+        expected = read_csv(self.csv_path, nrows=-1)
+        data = read_csv(self.csv_path, nrows=-1, workers=3)
+        self.assertEqual(expected._column_group, data._column_group)
+        self.assertEqual([None] * 100, list(data._column_group[1]))
+        self.assertEqual(50, data._column_group[2].col_values.null_count())
+
+    def test_read_mmap(self):
+        expected = read_csv(self.csv_path, nrows=-1)
+        data = read_csv(self.csv_path, nrows=-1, backend="mmap")
+        self.assertEqual(expected._column_group, data._column_group)
+        data = read_csv(self.csv_path, nrows=10, backend="mmap")
+        self.assertEqual(9, len(data._column_group[2]))
+
+        with mock.patch("csv_inspector.mmap_reader.MmapCSVReader._decode",
+                        autospec=True, side_effect=lambda _, field: "0"
+                        ) as m:
+            data = read_csv(self.csv_path, nrows=-1, backend="mmap")
+            data[1].drop()
+            m.assert_not_called()
+            self.assertEqual([0] * 500, list(data._column_group[1]))
+            self.assertEqual(500, m.call_count)
+
+    def test_read_mmap_unterminated_quote(self):
+        self.csv_path.write_text('id;text;value\n1;"x;2;3\n4;5;6\n',
+                                 encoding="utf-8")
+        expected = read_csv(self.csv_path, nrows=-1)
+        data = read_csv(self.csv_path, nrows=-1, backend="mmap")
+        self.assertEqual(list(expected._column_group),
+                         list(data._column_group)[:2])
+        self.assertEqual(["x;2;3\n4;5;6\n"], data._column_group[1].col_values)
+        self.assertEqual([None], list(data._column_group[2]))
+
+    def test_read_cache(self):
+        expected = read_csv(self.csv_path, nrows=-1)
+        data = read_csv(self.csv_path, nrows=-1, cache=True)
+        self.assertEqual(expected._column_group, data._column_group)
+        path = self.csv_path.with_suffix(".mcsvcache")
+        self.assertTrue(path.is_file())
+
+        with mock.patch("csv_inspector.inspector._read_by_chunks") as m:
+            data = read_csv(self.csv_path, nrows=-1, cache=True)
+            m.assert_not_called()
+        self.assertEqual(expected._column_group, data._column_group)
+
+        # same size, different content
+        self.csv_path.write_bytes(
+            self.csv_path.read_bytes().replace(b"line 0", b"line X"))
+        data = read_csv(self.csv_path, nrows=-1, cache=True)
+        self.assertEqual("line X", data._column_group[1].col_values[0][:6])
+
+    def test_read_cache_corrupt(self):
+        expected = read_csv(self.csv_path, nrows=-1)
+        read_csv(self.csv_path, nrows=-1, cache=True)
+        path = self.csv_path.with_suffix(".mcsvcache")
+        content = path.read_bytes()
+        for corrupt in (content[:-100], content[:-100] + b"\xff" * 100):
+            path.write_bytes(corrupt)
+            data = read_csv(self.csv_path, nrows=-1, cache=True)
+            self.assertEqual(expected._column_group, data._column_group)
+
+    def test_read_cache_read_only(self):
+        expected = read_csv(self.csv_path, nrows=-1, cache=True)
+        with mock.patch("os.utime", side_effect=PermissionError), \
+                mock.patch("csv_inspector.inspector._read_by_chunks") as m:
+            data = read_csv(self.csv_path, nrows=-1, cache=True)
+            m.assert_not_called()
+        self.assertEqual(expected._column_group, data._column_group)
+
+    def test_read_cache_dir(self):
+        cache_dir = Path(self._dir.name, "cache")
+        cache_dir.mkdir()
+        read_csv(self.csv_path, nrows=-1, cache=cache_dir)
+        path, = cache_dir.glob("*.mcsvcache")
+        evict(cache_dir, path.stat().st_size)
+        self.assertTrue(path.exists())
+        evict(cache_dir, path.stat().st_size - 1)
+        self.assertFalse(path.exists())
+
+    def test_sqlite_load(self):
+        provider = get_provider("sqlite")(self.csv_path)
+        self.assertEqual(
+            'CREATE TABLE "test" ("id" INTEGER, "text" TEXT, "value" INTEGER);',
+            provider.create_schema())
+        connection = sqlite3.connect(":memory:")
+        synchronous = connection.execute("PRAGMA synchronous").fetchone()
+        report = provider.load(connection, batch_size=7)
+        self.assertEqual((500, 0), (report.row_count, report.error_count))
+        self.assertEqual(
+            (500, 3 * 499 * 500 // 2),
+            connection.execute('SELECT COUNT(*), SUM("value") FROM "test"'
+                               ).fetchone())
+        self.assertEqual(
+            ("line 499\nwith a ; and a \"quote\"",),
+            connection.execute('SELECT "text" FROM "test" WHERE "id" = 499'
+                               ).fetchone())
+        self.assertEqual(synchronous, connection.execute(
+            "PRAGMA synchronous").fetchone())
+        provider.load(connection)  # the table is rebuilt
+        self.assertEqual(500, connection.execute(
+            'SELECT COUNT(*) FROM "test"').fetchone()[0])
+
+    def test_pg_binary_copy(self):
+        provider = get_provider("pg")("utf-8", None, self.csv_path, "t", [])
+        self.assertEqual(
+            'CREATE TABLE "t" ("id" bigint, "text" text, "value" bigint);',
+            provider.create_schema())
+        stream = io.BytesIO()
+        writer = provider.write_binary_copy(stream)
+        self.assertEqual(500, writer.row_count)
+        text = "line 1\nwith a ; and a \"quote\"".encode("utf-8")
+        row = (bytes.fromhex("0003 00000008 0000000000000001")
+               + len(text).to_bytes(4, "big") + text
+               + bytes.fromhex("00000008 0000000000000003"))
+        self.assertIn(row, stream.getvalue())
+        self.assertTrue(stream.getvalue().endswith(TRAILER))
+
+
+def subprocess_kwargs():
+    """:return: the cwd and the env to run the package in a subprocess"""
+    package_dir = Path(__file__).resolve().parents[1]
+    python_path = [str(package_dir)] + [
+        os.path.abspath(path) for path in
+        os.environ.get("PYTHONPATH", "").split(os.pathsep) if path]
+    return {"cwd": package_dir,
+            "env": dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))}
+
+
 def data_from_rows(col_types, rows):
     columns = list(zip(*rows))
     return Data(
@@ -55,6 +755,22 @@ def data_from_rows(col_types, rows):
                      zip(col_types, columns)]), None)
 
 
+class BenchmarkTest(unittest.TestCase):
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as data_dir, \
+                contextlib.redirect_stderr(io.StringIO()):
+            report = run_benchmarks([100], Path(data_dir), repeat=1)
+        operations = [result["operation"] for result in report["results"]]
+        self.assertEqual(["read_csv", "filter", "filter_expr", "sort",
+                          "create", "ijoin", "ljoin", "rjoin", "ojoin",
+                          "group", "stats", "show", "save_as"], operations)
+        self.assertEqual([], compare(report, report, 0))
+
+        slower = {"results": [dict(result, wall_time=result["wall_time"] * 2)
+                              for result in report["results"]]}
+        self.assertEqual(len(operations), len(compare(slower, report, 0.5)))
+
+
 class DataTest(unittest.TestCase):
     def test_data_swap(self):
         data = data_from_rows((int, str, int, str),
@@ -103,6 +819,63 @@ class DataTest(unittest.TestCase):
         g.group()
         print(data)
 
+    def test_data_groupby_aggregators(self):
+        rows = [("colA", "colB", "colC"),
+                (1, "a", 10), (2, "b", None), (1, "b", 20), (2, "a", 40),
+                (1, "a", 10)]
+
+        def non_null(vs):
+            return [v for v in vs if v is not None]
+
+        funcs_by_name = {
+            "count": len,
+            "sum": lambda vs: sum(non_null(vs)),
+            "min": lambda vs: min(non_null(vs)),
+            "max": lambda vs: max(non_null(vs)),
+            "mean": lambda vs: sum(non_null(vs)) / len(non_null(vs)),
+            "first": lambda vs: vs[0],
+            "last": lambda vs: vs[-1],
+            "count_distinct": lambda vs: len(set(vs)),
+        }
+        for name, func in funcs_by_name.items():
+            data = data_from_rows((int, str, int), rows)
+            g = data[0].grouper()
+            g[1].agg("count_distinct")
+            g[2].agg(name)
+            g.group()
+
+            expected = data_from_rows((int, str, int), rows)
+            g = expected[0].grouper()
+            g[1].agg(lambda vs: len(set(vs)), int)
+            g[2].agg(func, data._column_group[2].col_type)
+            g.group()
+            self.assertEqual(expected._column_group, data._column_group, name)
+
+    def test_data_groupby_mean_type(self):
+        data = data_from_rows((int, Decimal, int),
+                              [("colA", "colB", "colC"),
+                               (1, Decimal("1.5"), 1), (1, Decimal("1.8"), 2)])
+        g = data[0].grouper()
+        g[1, 2].agg("mean")
+        g.group()
+        col_b, col_c = data._column_group[1], data._column_group[2]
+        self.assertEqual((Decimal, [Decimal("1.65")]),
+                         (col_b.col_type, list(col_b)))
+        self.assertEqual((float, [1.5]), (col_c.col_type, list(col_c)))
+
+    def test_data_groupby_workers(self):
+        rows = [("colA", "colB", "colC", "colD")] + [
+            (i % 3, i % 2, float(i) / 7, str(i)) for i in range(100)]
+        for workers in (2, 3, 200):
+            data = data_from_rows((int, int, float, str), rows)
+            expected = data_from_rows((int, int, float, str), rows)
+            for d, w in ((data, workers), (expected, 1)):
+                g = d[1, 0].grouper()
+                g[2].agg("sum")
+                g[3].agg(lambda vs: "-".join(vs))
+                g.group(workers=w)
+            self.assertEqual(expected._column_group, data._column_group)
+
     def test_data_ljoin(self):
         data1 = data_from_rows((int, str, int),
                                [("colA1", "colB1", "colC1"),
@@ -115,6 +888,131 @@ class DataTest(unittest.TestCase):
         data1[0].ljoin(data2[0])
         print(data1)
 
+    def test_data_joins_without_func(self):
+        rows1 = [("colA1", "colB1"), (1, "a"), (2, "b"), (2, "c"), (3, "d")]
+        rows2 = [("colA2", "colB2"), (2, "x"), (4, "y"), (2, "z")]
+        for join_name in ("ijoin", "ljoin", "rjoin", "ojoin"):
+            for r1, r2 in ((rows1, rows2), (rows2, rows1)):
+                expected1 = data_from_rows((int, str), r1)
+                expected2 = data_from_rows((int, str), r2)
+                getattr(expected1[0], join_name)(expected2[0],
+                                                 lambda x, y: x == y)
+                data1 = data_from_rows((int, str), r1)
+                data2 = data_from_rows((int, str), r2)
+                getattr(data1[0], join_name)(data2[0])
+                self.assertEqual(expected1._column_group,
+                                 data1._column_group)
+
+    def test_data_joins_on(self):
+        rows1 = [("colA1", "colB1"), (3, "a"), (1, "b"), (2, "c"), (2, "d"),
+                 (5, "e")]
+        rows2 = [("colA2", "colB2", "colC2"), (2, 3, "x"), (0, 1, "y"),
+                 (2, 2, "z"), (4, 9, "t")]
+        funcs_by_on = {
+            "==": lambda x, y: x == y, "<": lambda x, y: x < y,
+            "<=": lambda x, y: x <= y, ">": lambda x, y: x > y,
+            ">=": lambda x, y: x >= y,
+        }
+        for join_name in ("ijoin", "ljoin", "rjoin", "ojoin"):
+            for on, func in funcs_by_on.items():
+                self._assert_join_on(join_name, rows1, rows2, 0, 0, on, func)
+            self._assert_join_on(join_name, rows1, rows2, 0, (0, 1),
+                                 "between", lambda x, y: y[0] <= x[0] <= y[1])
+
+    def test_data_joins_on_nan(self):
+        nan = float("nan")
+        rows1 = [("colA1", "colB1"), (3.0, 1.0), (nan, 2.0), (1.0, nan),
+                 (2.0, 3.0), (nan, nan)]
+        rows2 = [("colA2", "colB2", "colC2"), (2.0, 3.0, "x"),
+                 (nan, 1.0, "y"), (0.0, nan, "z"), (1.0, 2.0, "t")]
+        col_types = ((float, float), (float, float, str))
+        funcs_by_on = {
+            "<": lambda x, y: x < y, "<=": lambda x, y: x <= y,
+            ">": lambda x, y: x > y, ">=": lambda x, y: x >= y,
+        }
+        for join_name in ("ijoin", "ljoin", "rjoin", "ojoin"):
+            for on, func in funcs_by_on.items():
+                for x, y in ((0, 0), ((0, 1), (0, 1))):
+                    self._assert_join_on(join_name, rows1, rows2, x, y, on,
+                                         func, col_types)
+            self._assert_join_on(join_name, rows1, rows2, 0, (0, 1),
+                                 "between", lambda x, y: y[0] <= x[0] <= y[1],
+                                 col_types)
+
+    def _assert_join_on(self, join_name, rows1, rows2, x, y, on, func,
+                        col_types=((int, str), (int, int, str))):
+        expected1 = data_from_rows(col_types[0], rows1)
+        expected2 = data_from_rows(col_types[1], rows2)
+        getattr(expected1[x], join_name)(expected2[y], func)
+        data1 = data_from_rows(col_types[0], rows1)
+        data2 = data_from_rows(col_types[1], rows2)
+        getattr(data1[x], join_name)(data2[y], on=on)
+
+        def columns(data):  # nan != nan
+            return [(column.name, column.col_type, list(map(repr, column)))
+                    for column in data._column_group]
+
+        self.assertEqual(columns(expected1), columns(data1),
+                         f"{join_name}, {on}")
+
+    def test_data_deadline(self):
+        rows = [("colA", "colB")] + [(i, str(i)) for i in
+                                     range(2 * CHECK_INTERVAL)]
+        data = data_from_rows((int, str), rows)
+        other = data_from_rows((int, str), rows)
+        start_script(0)
+        try:
+            with self.assertRaises(Cancelled):
+                data[0].ijoin(other[0], lambda x, y: x == y)
+            with self.assertRaises(Cancelled):
+                data[0].filter(lambda x: x % 2)
+        finally:
+            end_script()
+        self.assertEqual(data_from_rows((int, str), rows)._column_group,
+                         data._column_group)
+
+    def test_data_profile(self):
+        data = data_from_rows((int, str),
+                              [("colA", "colB"), (1, "a"), (2, "b"),
+                               (3, "c")])
+        data[0].filter(lambda x: x > 1)  # not recorded
+        enable_profiling(trace_memory=True)
+        try:
+            data[0].filter(lambda x: x > 2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                data.show()
+        finally:
+            disable_profiling()
+        data[0].update(lambda x: x + 1)  # not recorded
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            operation_records = data.profile()
+        self.assertEqual(["DataHandle.filter", "Data.show"],
+                         [record.name for record in operation_records])
+        self.assertEqual((2, 1), (operation_records[0].rows_in,
+                                  operation_records[0].rows_out))
+        self.assertIsNotNone(operation_records[0].peak_memory)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(f"{TOKEN}begin info", lines[0])
+        self.assertTrue(lines[2].startswith("DataHandle.filter"))
+
+    def test_data_profile_deferred(self):
+        column = Column.deferred("colA", int, mock.Mock(return_value=[1, 2]))
+        data = Data(ColumnGroup([column]), None)
+        enable_profiling(trace_memory=True)
+        try:
+            # Python 3.8
+            with mock.patch.object(tracemalloc, "reset_peak", None):
+                data[0].rename(["colB"])
+        finally:
+            disable_profiling()
+        column._load.assert_not_called()
+        with contextlib.redirect_stdout(io.StringIO()):
+            operation_record, = data.profile()
+        self.assertEqual((None, None), (operation_record.rows_in,
+                                        operation_record.rows_out))
+        self.assertIsNotNone(operation_record.peak_memory)
+
     def test_data_filter(self):
         data = data_from_rows((int, str, int),
                               [("colA", "colB", "colC"),
@@ -123,6 +1021,76 @@ class DataTest(unittest.TestCase):
         data[2].filter(lambda x: x > 30)
         print(data)
 
+    def test_data_exprs(self):
+        rows = [("colA", "colB", "colC"),
+                (1, "a", 10), (None, "b", 20), (2, "", 40), (3, "d", None)]
+        cases = [
+            ("filter", "c0 * 20 > c2 and c1 != ''",
+             lambda x, y, z: x is not None and z is not None and x * 20 > z
+                             and y != ''),
+            ("filter", "c0 is None or c2 >= 40",
+             lambda x, y, z: x is None or z is not None and z >= 40),
+            ("create", "c0 + c2",
+             lambda x, y, z: None if x is None or z is None else x + z),
+            ("create", "c0 == c2", lambda x, y, z: x == z),
+        ]
+        for op, expr, func in cases:
+            data = data_from_rows((int, str, int), rows)
+            expected = data_from_rows((int, str, int), rows)
+            if op == "filter":
+                data[:].filter_expr(expr)
+                expected[:].filter(func)
+            else:
+                data[:].create_expr(expr, "colD")
+                col_type = data._column_group[3].col_type
+                expected[:].create(func, "colD", col_type)
+            self.assertEqual(expected._column_group, data._column_group, expr)
+
+    def test_data_expr_overflow(self):
+        data = data_from_rows((float, float), [("colA", "colB"),
+                                               (1e308, 1e308), (1.0, 2.0)])
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            data[:].create_expr("c0 + c1", "colC")
+        self.assertEqual([float("inf"), 3.0], list(data._column_group[2]))
+
+    def test_data_expr_unknown_index(self):
+        data = data_from_rows((int, str), [("colA", "colB"), (1, "a")])
+        with self.assertRaises(ValueError):
+            data[0].filter_expr("c1 == 'a'")
+
+    def test_data_categorical(self):
+        rows = [("colA", "colB", "colC"),
+                ("x", "p", 1), ("y", "q", 2), (None, "p", 3), ("x", "q", 4),
+                ("z", "p", 5)]
+        other_rows = [("colA2", "colD"), ("x", 10), ("z", 20), ("w", 30)]
+
+        def operations(data, other_data):
+            data[0, 1].filter(lambda x, y: x != "y")
+            data[1, 2].rsort()
+            data[0].ljoin(other_data[0])
+            g = data[1].grouper()
+            g[2].agg("sum")
+            g[4].agg("count")
+            g.group()
+
+        data = data_from_rows((str, str, int), rows)
+        other_data = data_from_rows((str, int), other_rows)
+        operations(data, other_data)
+
+        encoded_data = data_from_rows((str, str, int), rows)
+        encoded_other_data = data_from_rows((str, int), other_rows)
+        for d in (encoded_data, encoded_other_data):
+            d._column_group[0].col_values = CategoricalValues.create(
+                d._column_group[0].col_values)
+        encoded_data._column_group[1].col_values = CategoricalValues.create(
+            encoded_data._column_group[1].col_values)
+        operations(encoded_data, encoded_other_data)
+
+        self.assertEqual(data._column_group, encoded_data._column_group)
+        self.assertIsInstance(encoded_data._column_group[0].col_values,
+                              CategoricalValues)
+
     def test_move_before(self):
         data = data_from_rows((int, str, int, str),
                               [("colA", "colB", "colC", "colD"),
@@ -171,6 +1139,85 @@ class DataTest(unittest.TestCase):
         data[0, 1].rsort()
         print(data)
 
+    def test_sort_nulls(self):
+        values = ["b", None, "a"]
+        for col_values in (values, CategoricalValues.create(values)):
+            data = Data(ColumnGroup([Column("colA", str, col_values)]), None)
+            with self.assertRaises(TypeError):
+                data[0].sort()
+
+        data = Data(ColumnGroup([Column(
+            "colA", str, CategoricalValues.create(["b", "c", "a"]))]), None)
+        data[0].sort()
+        self.assertEqual(["a", "b", "c"], list(data._column_group[0]))
+
+
+class UntouchableValues(Sequence):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, item):
+        raise AssertionError("Untouchable")
+
+
+class LazyDataTest(unittest.TestCase):
+    def _create_data(self):
+        return data_from_rows((int, str, int, str),
+                              [("colA", "colB", "colC", "colD"),
+                               (1, "a", 10, "aa"), (1, "b", 20, "bb"),
+                               (2, "c", 40, "cc"), (3, "d", 80, "dd")])
+
+    def test_lazy_as_eager(self):
+        def pipeline(data):
+            data[0, 2].create(lambda x, y: x + y, "colE", int, 1)
+            data[1].filter(lambda x: x < 80)
+            data[3].update(lambda x: x * 2)
+            data[4].rsort()
+            data[2].rename(["colB2"])
+            data[1, 3].filter(lambda x, y: x != 22)
+            data[0, 2, 3].select()
+            data[0].create(lambda x: -x, "colF")
+
+        expected = self._create_data()
+        pipeline(expected)
+        data = self._create_data()
+        pipeline(data.lazy())
+        self.assertEqual(self._create_data()._column_group,
+                         data._column_group)  # not collected
+        data = self._create_data()
+        lazy_data = data.lazy()
+        pipeline(lazy_data)
+        self.assertIs(data, lazy_data.collect())
+        self.assertEqual(expected._column_group, data._column_group)
+
+    def test_lazy_prunes_columns(self):
+        data = self._create_data()
+        data._column_group.columns.append(
+            Column("colX", None, UntouchableValues()))
+        lazy_data = data.lazy()
+        lazy_data[4, 0].create(lambda x, y: y, "colY")
+        lazy_data[0].filter(lambda x: x > 1)
+        lazy_data[4, 5].drop()
+        lazy_data.collect()
+        self.assertEqual([[2, 3], ["c", "d"], [40, 80], ["cc", "dd"]],
+                         [list(column) for column in data._column_group])
+
+    def test_lazy_collect_fails(self):
+        divisors = [0]
+        data = self._create_data()
+        lazy_data = data.lazy()
+        lazy_data[0].filter(lambda x: x > 1)
+        lazy_data[2].create(lambda x: x // divisors[0], "colE")
+        with self.assertRaises(ZeroDivisionError):
+            lazy_data.collect()
+        self.assertEqual(self._create_data()._column_group,
+                         data._column_group)
+
+        divisors[0] = 10
+        lazy_data.collect()
+        self.assertEqual([[2, 3], ["c", "d"], [40, 80], ["cc", "dd"], [4, 8]],
+                         [list(column) for column in data._column_group])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -42,7 +42,7 @@ class ExecutionEnvironment(private val executor: PythonExecutor,
     }
 
     fun restart() {
-        val newEnvironment = executor.start()
+        val newEnvironment = executor.restart()
         val oldProcess = process
         process = newEnvironment.process
         stdinWriter = newEnvironment.stdinWriter
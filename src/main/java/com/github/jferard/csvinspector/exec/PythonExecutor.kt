@@ -30,6 +30,25 @@ import kotlin.system.exitProcess
 
 class PythonExecutor(private val pythonExe: String, private val token: String,
                      private val eventBus: EventBus) {
+    /** An idle server, started in advance: a restart takes it */
+    private var standby: ExecutionEnvironment? = null
+
+    fun startStandby() {
+        if (standby == null) {
+            standby = start()
+        }
+    }
+
+    /** Take the standby server, and start the next one */
+    fun restart(): ExecutionEnvironment {
+        val startTime = System.nanoTime()
+        val environment = standby ?: start()
+        standby = null
+        println("restart python server: ${(System.nanoTime() - startTime) / 1000000} ms")
+        startStandby()
+        return environment
+    }
+
     fun start(): ExecutionEnvironment {
         val cmdarray = arrayOf(pythonExe, "-m", "csv_inspector", token)
         println("start python server: ${cmdarray.toList()}")
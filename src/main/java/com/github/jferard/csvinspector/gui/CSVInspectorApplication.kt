@@ -31,7 +31,9 @@ class CSVInspectorApplication : Application() {
         val token = generateToken()
         val eventBus = EventBus()
         val pythonExe = parameters.raw[0] ?: "python3.8"
-        val executionEnvironment = PythonExecutor(pythonExe, token, eventBus).start()
+        val executor = PythonExecutor(pythonExe, token, eventBus)
+        val executionEnvironment = executor.start()
+        executor.startStandby()
 
         val menuBarProvider = MenuBarProvider(eventBus)
         val gui = CSVInspectorGUIInitialProvider(eventBus, executionEnvironment, menuBarProvider,